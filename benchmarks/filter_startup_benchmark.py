@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+"""Measure the start time of the Pandoc filter executables.
+
+Pandoc launches md2pdf_pandoc_filter and md2pdf_pandoc_paragraph_filter as
+new Python processes, so their start time is paid on every conversion. Every
+filter module is imported in new processes, and the median time over a bare
+Python process is compared to the budget. The benchmark fails (exit code 1)
+if any filter goes over it.
+
+Usage:
+    python benchmarks/filter_startup_benchmark.py [<budget-ms>] [<repetitions>]
+"""
+from __future__ import print_function
+import os
+import subprocess
+import sys
+import time
+
+ROOT_DIRPATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Maximum start time (in milliseconds) of a filter, on top of the Python
+# interpreter start time.
+FILTER_STARTUP_BUDGET = 25
+
+FILTER_MODULES = ['pandoc_filters', 'paragraph_filters']
+
+
+def measure_startup_time(script, repetitions):
+    """Return the median time (in seconds) of running the given Python
+    script in a new process"""
+    startup_times = []
+    for repetition in range(repetitions):
+        start_time = time.time()
+        subprocess.check_call(
+            [sys.executable, '-c', script],
+            cwd=os.path.join(ROOT_DIRPATH, 'markdown_to_pdf')
+        )
+        startup_times.append(time.time() - start_time)
+    return sorted(startup_times)[len(startup_times) // 2]
+
+
+def main():
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else FILTER_STARTUP_BUDGET
+    repetitions = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    # Compile the modules first, as they are when md2pdf is installed.
+    measure_startup_time('import %s' % ', '.join(FILTER_MODULES), 1)
+
+    interpreter_time = measure_startup_time('pass', repetitions)
+    print('python:            %6.1f ms' % (1000 * interpreter_time))
+
+    over_budget = False
+    for filter_module in FILTER_MODULES:
+        filter_time = measure_startup_time('import %s' % filter_module, repetitions) - interpreter_time
+        print('%-18s +%6.1f ms (budget: %.1f ms)' % (filter_module + ':', 1000 * filter_time, budget))
+        if 1000 * filter_time > budget:
+            print('ERROR: %s start time is over budget' % filter_module, file=sys.stderr)
+            over_budget = True
+
+    if over_budget:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""Measure the import time of the hyphenate module and the words per second
+of hyphenate_word.
+
+The import time is measured in new processes, with an empty cache directory
+(the patterns are parsed and compiled) and with the compiled patterns
+already cached. The words per second are measured over the words of the
+markdown_examples files, with and without the memo of hyphenate_word.
+
+Usage:
+    python benchmarks/hyphenation_benchmark.py [<repetitions>]
+"""
+from __future__ import print_function
+import glob
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT_DIRPATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIRPATH, 'markdown_to_pdf'))
+
+import hyphenate
+
+
+IMPORT_TIME_SCRIPT = 'import time; start_time = time.time(); import hyphenate; print(time.time() - start_time)'
+
+
+def measure_import_time(cache_dirpath, clear_cache, repetitions):
+    """Return the median import time (in seconds) of the hyphenate module"""
+    environment = dict(os.environ, MD2PDF_CACHE_DIR=cache_dirpath)
+    import_times = []
+    for repetition in range(repetitions):
+        if clear_cache:
+            shutil.rmtree(cache_dirpath, ignore_errors=True)
+        import_times.append(float(subprocess.check_output(
+            [sys.executable, '-c', IMPORT_TIME_SCRIPT],
+            cwd=os.path.join(ROOT_DIRPATH, 'markdown_to_pdf'),
+            env=environment
+        )))
+    return sorted(import_times)[len(import_times) // 2]
+
+
+def get_example_words():
+    words = []
+    for markdown_filepath in glob.glob(os.path.join(ROOT_DIRPATH, 'markdown_examples', '*', '*.md')):
+        with open(markdown_filepath) as markdown_file:
+            words += re.findall(r'\w+', markdown_file.read().decode('utf-8'), re.UNICODE)
+    return words
+
+
+def measure_words_per_second(hyphenator, words, repetitions):
+    start_time = time.time()
+    for repetition in range(repetitions):
+        for word in words:
+            hyphenator.hyphenate_word(word)
+    return repetitions * len(words) / (time.time() - start_time)
+
+
+def main():
+    repetitions = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    cache_dirpath = tempfile.mkdtemp(prefix='md2pdf-hyphenation-benchmark-')
+    try:
+        print('import (patterns parsed):   %6.1f ms' % (1000 * measure_import_time(cache_dirpath, True, repetitions)))
+        measure_import_time(cache_dirpath, False, 1)
+        print('import (patterns compiled): %6.1f ms' % (1000 * measure_import_time(cache_dirpath, False, repetitions)))
+    finally:
+        shutil.rmtree(cache_dirpath, ignore_errors=True)
+
+    words = get_example_words()
+    compiled_patterns = hyphenate.hyphenator.compile()
+    for memo_name, memo_size in (('without memo', 0), ('with memo', hyphenate.HYPHENATION_MEMO_SIZE)):
+        hyphenator = hyphenate.Hyphenator.from_compiled(compiled_patterns, memo_size)
+        print('words: %d  %-12s  %9.0f words/s' % (
+            len(words), memo_name, measure_words_per_second(hyphenator, words, repetitions)
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""Measure the time saved by every xelatex pass compiled against the
+precompiled format of the static preamble (see latex_format).
+
+The LaTeX file of a synthetic corpus (see latex_shards_benchmark) is
+generated in a fresh build directory. Then the same number of xelatex passes
+is timed with and without the format, once the auxiliary files have
+converged. The time to dump the format, paid once per template version, is
+reported too. It requires xelatex and mylatexformat.
+
+The marker of template.tex is placed before the font setup, as XeTeX can not
+dump the fonts loaded by fontspec. To check whether more of the preamble can
+be precompiled, the same passes are timed with the marker moved after the
+hyperref setup (LATE_MARKER_LINE), if that format can be dumped.
+
+Usage:
+    python benchmarks/latex_format_benchmark.py [<files>] [<passes>]
+"""
+from __future__ import print_function
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT_DIRPATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIRPATH, 'markdown_to_pdf'))
+
+from markdown_to_pdf import build_monolitic_markdown_file, generate_pdf_from_markdown
+from latex_build import LATEX_BUILD_JOBNAME, run_xelatex
+from latex_format import LATEX_FORMAT_MARKER, get_latex_format
+from latex_shards_benchmark import generate_synthetic_corpus
+
+
+# Line of template.tex after which the marker is moved to time a larger
+# precompiled preamble: the end of the hyperref setup.
+LATE_MARKER_LINE = '\\urlstyle{same}'
+
+
+def write_late_marker_latex_file(latex_filepath, late_marker_latex_filepath):
+    """Write a copy of the given LaTeX file with the format marker moved
+    after LATE_MARKER_LINE"""
+    with open(latex_filepath, 'rb') as latex_file:
+        lines = latex_file.read().split('\n')
+    lines.remove(LATEX_FORMAT_MARKER)
+    late_marker_index = [line.startswith(LATE_MARKER_LINE) for line in lines].index(True)
+    lines.insert(late_marker_index + 1, LATEX_FORMAT_MARKER)
+    with open(late_marker_latex_filepath, 'wb') as late_marker_latex_file:
+        late_marker_latex_file.write('\n'.join(lines))
+
+
+def time_xelatex_passes(latex_filepath, build_dirpath, passes, latex_format_filepath=None):
+    """Return the average time of the given number of xelatex passes"""
+    start_time = time.time()
+    for _ in range(passes):
+        run_xelatex(latex_filepath, build_dirpath, latex_format_filepath)
+    return (time.time() - start_time) / passes
+
+
+def main():
+    files = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    passes = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+
+    temp_dirpath = tempfile.mkdtemp()
+    # The formats are dumped from scratch.
+    os.environ['MD2PDF_CACHE_DIR'] = os.path.join(temp_dirpath, 'cache')
+    try:
+        markdown_filepaths = generate_synthetic_corpus(temp_dirpath, files)
+        monolitic_markdown_filepath = os.path.join(temp_dirpath, 'monolitic.md')
+        build_monolitic_markdown_file(monolitic_markdown_filepath, markdown_filepaths, multiprocessing.cpu_count())
+
+        build_dirpath = os.path.join(temp_dirpath, 'build')
+        generate_pdf_from_markdown(
+            os.path.join(temp_dirpath, 'output.pdf'),
+            monolitic_markdown_filepath,
+            False,
+            build_dirpath=build_dirpath
+        )
+        latex_filepath = os.path.join(build_dirpath, LATEX_BUILD_JOBNAME + '.tex')
+
+        start_time = time.time()
+        latex_format_filepath = get_latex_format(latex_filepath)
+        dump_seconds = time.time() - start_time
+        if latex_format_filepath is None:
+            print('ERROR: the LaTeX preamble could not be precompiled', file=sys.stderr)
+            sys.exit(1)
+
+        without_format_seconds = time_xelatex_passes(latex_filepath, build_dirpath, passes)
+        with_format_seconds = time_xelatex_passes(latex_filepath, build_dirpath, passes, latex_format_filepath)
+
+        print('Synthetic corpus: %d files, %d passes' % (files, passes))
+        print('format dump:          %7.2f s (once per template version)' % dump_seconds)
+        print('pass without format:  %7.2f s' % without_format_seconds)
+        print('pass with format:     %7.2f s  saved: %5.2f s per pass' % (
+            with_format_seconds, without_format_seconds - with_format_seconds
+        ))
+
+        late_marker_latex_filepath = os.path.join(build_dirpath, 'late_marker.tex')
+        write_late_marker_latex_file(latex_filepath, late_marker_latex_filepath)
+        # Converges the auxiliary files of the copy.
+        run_xelatex(late_marker_latex_filepath, build_dirpath)
+        run_xelatex(late_marker_latex_filepath, build_dirpath)
+        late_marker_format_filepath = get_latex_format(late_marker_latex_filepath)
+        if late_marker_format_filepath is None:
+            print('marker after hyperref: the format can not be dumped')
+        else:
+            late_marker_seconds = time_xelatex_passes(
+                late_marker_latex_filepath, build_dirpath, passes, late_marker_format_filepath
+            )
+            print('marker after hyperref:%7.2f s  saved: %5.2f s per pass' % (
+                late_marker_seconds, without_format_seconds - late_marker_seconds
+            ))
+    finally:
+        shutil.rmtree(temp_dirpath)
+
+
+if __name__ == '__main__':
+    main()
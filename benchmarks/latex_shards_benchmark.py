@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+"""Measure how the PDF generation scales with the number of LaTeX shards.
+
+A synthetic corpus (files with sections, paragraphs, code blocks, tables and
+cross-file links) is converted to PDF from scratch with 1, 2, 4... shards,
+up to the number of cores. Every build uses a fresh build directory. It
+requires xelatex.
+
+Usage:
+    python benchmarks/latex_shards_benchmark.py [<files>]
+"""
+from __future__ import print_function
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT_DIRPATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIRPATH, 'markdown_to_pdf'))
+
+from markdown_to_pdf import build_monolitic_markdown_file, generate_pdf_from_markdown
+
+
+SYNTHETIC_SECTION = """
+## Section %(section)d of file %(file)d
+
+Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod
+tempor incididunt ut labore et dolore magna aliqua. Ut enim ad minim veniam,
+quis nostrud exercitation ullamco laboris nisi ut aliquip ex ea commodo
+consequat. See [the next file](file%(next_file)d.md) for details.
+
+```
+curl -X GET http://localhost:1026/v2/entities/%(file)d/attrs/%(section)d
+```
+
+| Attribute | Type | Description |
+|-----------|------|-------------|
+| temperature | Number | Temperature of the room %(section)d |
+| pressure | Number | Pressure of the room %(section)d |
+
+Duis aute irure dolor in reprehenderit in voluptate velit esse cillum dolore
+eu fugiat nulla pariatur. Excepteur sint occaecat cupidatat non proident,
+sunt in culpa qui officia deserunt mollit anim id est laborum.
+"""
+
+
+def generate_synthetic_corpus(dirpath, files, sections=8):
+    """Write the synthetic Markdown files into dirpath and return their
+    paths"""
+    markdown_filepaths = []
+    for file_index in range(files):
+        markdown_filepath = os.path.join(dirpath, 'file%d.md' % file_index)
+        with open(markdown_filepath, 'wb') as markdown_file:
+            markdown_file.write('# File %d\n' % file_index)
+            for section_index in range(sections):
+                markdown_file.write(SYNTHETIC_SECTION % {
+                    'file': file_index,
+                    'section': section_index,
+                    'next_file': (file_index + 1) % files
+                })
+        markdown_filepaths.append(markdown_filepath)
+    return markdown_filepaths
+
+
+def main():
+    files = int(sys.argv[1]) if len(sys.argv) > 1 else 120
+
+    temp_dirpath = tempfile.mkdtemp()
+    try:
+        markdown_filepaths = generate_synthetic_corpus(temp_dirpath, files)
+        monolitic_markdown_filepath = os.path.join(temp_dirpath, 'monolitic.md')
+        build_monolitic_markdown_file(monolitic_markdown_filepath, markdown_filepaths, multiprocessing.cpu_count())
+
+        shard_counts = [1]
+        while shard_counts[-1] * 2 <= multiprocessing.cpu_count():
+            shard_counts.append(shard_counts[-1] * 2)
+
+        results = []
+        for shards in shard_counts:
+            build_dirpath = os.path.join(temp_dirpath, 'build%d' % shards)
+            start_time = time.time()
+            generate_pdf_from_markdown(
+                os.path.join(temp_dirpath, 'output%d.pdf' % shards),
+                monolitic_markdown_filepath,
+                False,
+                build_dirpath=build_dirpath,
+                latex_shards=shards
+            )
+            results.append((shards, time.time() - start_time))
+
+        print('Synthetic corpus: %d files' % files)
+        for shards, seconds in results:
+            print('shards: %2d  time: %7.1f s  speedup: %4.2fx' % (shards, seconds, results[0][1] / seconds))
+    finally:
+        shutil.rmtree(temp_dirpath)
+
+
+if __name__ == '__main__':
+    main()
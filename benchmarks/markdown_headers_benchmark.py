@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""Measure how add_newlines_before_markdown_headers scales with the size of
+the Markdown content.
+
+Synthetic API reference pages (headers, setext headers, paragraphs, lists
+and code blocks) of 1k, 10k, 100k and 1M lines are processed, and the time
+per line is printed for each size. It should stay flat.
+
+Usage:
+    python benchmarks/markdown_headers_benchmark.py [<max-lines>]
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+
+ROOT_DIRPATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIRPATH, 'markdown_to_pdf'))
+
+from markdown_to_pdf import add_newlines_before_markdown_headers
+
+
+SYNTHETIC_ENTRY_LINES = u"""## GET /v2/entities/{entityId}
+Retrieve the entity with the given id.
+Attributes
+----------
+- `entityId`: id of the entity.
+- `type`: type of the entity.
+```
+# Not a header, this is code
+curl localhost:1026/v2/entities/Room1
+```
+Response
+========
+The entity, in JSON format.
+""".split(u'\n')
+
+
+def generate_synthetic_content(lines):
+    return u'\n'.join(
+        SYNTHETIC_ENTRY_LINES[line_index % len(SYNTHETIC_ENTRY_LINES)]
+        for line_index in range(lines)
+    )
+
+
+def main():
+    max_lines = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+
+    lines = 1000
+    while lines <= max_lines:
+        markdown_content = generate_synthetic_content(lines)
+        start_time = time.time()
+        add_newlines_before_markdown_headers(markdown_content)
+        seconds = time.time() - start_time
+        print('lines: %8d  time: %7.3f s  per line: %5.2f us' % (lines, seconds, 1000000 * seconds / lines))
+        lines *= 10
+
+
+if __name__ == '__main__':
+    main()
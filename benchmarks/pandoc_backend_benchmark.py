@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""Compare the per-call latency of the one-shot and server Pandoc backends.
+
+Every Markdown file of markdown_examples/user is converted from GFM to GFM
+with each backend.
+
+Usage:
+    python benchmarks/pandoc_backend_benchmark.py [<repetitions>]
+"""
+from __future__ import print_function
+import glob
+import os
+import sys
+import time
+
+ROOT_DIRPATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIRPATH, 'markdown_to_pdf'))
+
+from pandoc_backend import OneShotPandocBackend, ServerPandocBackend
+
+
+def benchmark_backend(backend, markdown_contents, repetitions):
+    """Return the latency (in seconds) of every conversion"""
+    latencies = []
+    for repetition in range(repetitions):
+        for markdown_content in markdown_contents:
+            start_time = time.time()
+            backend.convert(markdown_content, 'markdown_github', 'markdown_github')
+            latencies.append(time.time() - start_time)
+    return latencies
+
+
+def print_latencies(backend_name, latencies):
+    latencies = sorted(latencies)
+    print('%-8s calls: %4d  mean: %7.1f ms  median: %7.1f ms  max: %7.1f ms' % (
+        backend_name,
+        len(latencies),
+        1000 * sum(latencies) / len(latencies),
+        1000 * latencies[len(latencies) // 2],
+        1000 * latencies[-1]
+    ))
+
+
+def main():
+    repetitions = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+
+    markdown_filepaths = sorted(glob.glob(os.path.join(ROOT_DIRPATH, 'markdown_examples', 'user', '*.md')))
+    markdown_contents = []
+    for markdown_filepath in markdown_filepaths:
+        with open(markdown_filepath, 'rU') as markdown_file:
+            markdown_contents.append(markdown_file.read().decode('utf-8'))
+
+    print('Converting %d files %d times' % (len(markdown_contents), repetitions))
+
+    print_latencies('oneshot', benchmark_backend(OneShotPandocBackend(), markdown_contents, repetitions))
+
+    try:
+        server_backend = ServerPandocBackend.start()
+    except (RuntimeError, OSError) as error:
+        print('server   not available: %s' % error)
+        return
+
+    try:
+        print_latencies('server', benchmark_backend(server_backend, markdown_contents, repetitions))
+    finally:
+        server_backend.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""Compare the grid and LaTeX table backends on large tables.
+
+Synthetic data model tables (attribute, type, description and default
+value columns) of 100, 1000 and 5000 rows are converted to LaTeX with each
+backend, as md2pdf does it:
+
+* grid: translate_md_tables to a grid table, then Pandoc parses it and
+  writes the LaTeX table.
+* latex: translate_md_tables to a pipe table, then Pandoc parses it and the
+  md2pdf Pandoc filter renders the longtable.
+
+Usage:
+    python benchmarks/table_backend_benchmark.py [<max-rows>]
+"""
+from __future__ import print_function
+import json
+import os
+import sys
+import time
+
+ROOT_DIRPATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIRPATH, 'markdown_to_pdf'))
+
+import pypandoc
+from pandocfilters import walk
+from convert_md_tables import translate_md_tables
+from markdown_to_pdf import MD2PDF_INNER_FORMAT
+from pandoc_filters import pandoc_filter
+
+
+SYNTHETIC_ROWS = [
+    u'| `temperature` | Number | Temperature of the *room*, in Celsius degrees. | 21 |',
+    u'| `refRoomSensor` | Relationship | Id of the sensor measuring the room temperature and humidity. | |',
+    u'| `dateObserved` | DateTime | Date of the last observation, in ISO8601 UTC format. | `null` |',
+    u'| `status` | Text | One of `ok`, `degraded` or `broken` & 100% operational. | `ok` |',
+]
+
+
+def generate_synthetic_table(rows):
+    return u'\n'.join(
+        [u'| Attribute | Type | Description | Default |', u'|---|---|---|---:|'] +
+        [SYNTHETIC_ROWS[row_index % len(SYNTHETIC_ROWS)] for row_index in range(rows)]
+    ) + u'\n'
+
+
+def convert_with_grid_backend(markdown_content):
+    markdown_content = translate_md_tables(markdown_content, 'grid')
+    return pypandoc.convert_text(markdown_content, 'latex', format=MD2PDF_INNER_FORMAT)
+
+
+def convert_with_latex_backend(markdown_content):
+    os.environ['MD2PDF_TABLE_BACKEND'] = 'latex'
+    markdown_content = translate_md_tables(markdown_content, 'latex')
+    json_ast = json.loads(pypandoc.convert_text(markdown_content, 'json', format=MD2PDF_INNER_FORMAT))
+    return walk(json_ast, pandoc_filter, 'latex', {})
+
+
+def main():
+    max_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+
+    for rows in (100, 1000, 5000):
+        if rows > max_rows:
+            break
+        markdown_content = generate_synthetic_table(rows)
+        for backend_name, convert in (('grid', convert_with_grid_backend), ('latex', convert_with_latex_backend)):
+            start_time = time.time()
+            convert(markdown_content)
+            seconds = time.time() - start_time
+            print('rows: %5d  backend: %-5s  time: %7.3f s' % (rows, backend_name, seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+"""Index of the anchors of a md2pdf document and validation of its links.
+
+The md2pdf Pandoc filter turns every local link into a link to a LaTeX
+label, and defines a label for every file (see generate_file_section), every
+header and every HTML anchor (<a name="...">). Links to labels which do not
+exist are only reported by xelatex, as undefined references, after the whole
+document has been converted.
+
+Instead, the monolitic Markdown file is scanned here before running Pandoc:
+the labels which the filter will define are stored in a set, and every local
+link is resolved as the filter does (see update_local_link), so the broken
+links are found with a lookup per link. Lines inside code blocks are
+skipped, as Pandoc does not parse them.
+
+The index is saved with the monolitic Markdown file, and the Pandoc filter
+resolves the local links with it (see AnchorIndex.resolve_link). Its file is
+given to the filter in the ANCHOR_INDEX_METADATA_FIELD metadata field.
+"""
+import json
+import re
+
+from links_processing import (
+    ANCHOR_INDEX_METADATA_FIELD, generate_pandoc_header_slug, 
+    is_a_markdown_header, make_header_id_unique, process_link_destination, 
+    slugify_string
+)
+from line_preprocessor import is_a_code_fence
+
+
+# See generate_file_section.
+FILE_MARKER_REGEX = re.compile(r'^<md2pdf:file:(.*)/>$')
+
+# Header attributes ({#id .class}), which are not part of the header text.
+HEADER_ATTRIBUTES_REGEX = re.compile(r'[ \t]*\{[^{}]*\}$')
+
+# Same regexes as html_inline_filter.
+HTML_ANCHOR_REGEX = re.compile(r'<a[ \t]+name="([^"]*)"[ \t]*/?>', re.IGNORECASE)
+
+HTML_TAG_REGEX = re.compile(r'</?[a-zA-Z][^<>]*>')
+
+CODE_SPAN_REGEX = re.compile(r'(`+)(.+?)\1')
+
+# Links as written by Pandoc: [text](destination "title")
+LINK_REGEX = re.compile(r'(!?)\[((?:[^\[\]]|\[[^\[\]]*\])*)\]\(<?([^()\s<>]*)>?(?:\s+"[^"]*")?\)')
+
+BACKSLASH_ESCAPE_REGEX = re.compile(r'\\([^\w\s])')
+
+LIST_ITEM_REGEX = re.compile(r'^[ \t]*(?:[-*+]|\d+[.)]|#[.)])[ \t]+\S')
+
+
+def get_markdown_header_text(header_markdown):
+    """Return the text of the given Markdown header line as the filter gets
+    it (stringify): without markup, HTML, link destinations nor escapes. The
+    ATX hashes are removed by generate_pandoc_header_slug"""
+    header_markdown = HEADER_ATTRIBUTES_REGEX.sub('', header_markdown)
+    header_markdown = CODE_SPAN_REGEX.sub(lambda match: match.group(2).strip(), header_markdown)
+    header_markdown = LINK_REGEX.sub(lambda match: match.group(2), header_markdown)
+    header_markdown = HTML_TAG_REGEX.sub('', header_markdown)
+    return BACKSLASH_ESCAPE_REGEX.sub(r'\1', header_markdown)
+
+
+def get_indentation(line):
+    return len(line.expandtabs(4)) - len(line.lstrip(' \t').expandtabs(4))
+
+
+class AnchorIndex(object):
+    """Labels defined by the md2pdf Pandoc filter in a document and the local
+    links of the document"""
+    def __init__(self):
+        self.anchors = set()
+        self.used_header_ids = {}
+        # (markdown filepath, link destination, label linked)
+        self.links = []
+        # Label linked by (markdown filepath, link destination)
+        self.link_labels = {}
+
+    def add_file(self, markdown_filepath):
+        self.anchors.add(slugify_string(markdown_filepath))
+
+    def add_header(self, markdown_filepath, header_text):
+        # Headers with the same slug get suffixes, as in header_filter.
+        self.anchors.add(make_header_id_unique(
+            generate_pandoc_header_slug(markdown_filepath, header_text),
+            self.used_header_ids
+        ))
+
+    def add_html_anchor(self, markdown_filepath, anchor_name):
+        self.anchors.add(slugify_string(markdown_filepath) + slugify_string(anchor_name))
+
+    def add_link(self, markdown_filepath, link_destination):
+        """Store the given link if it is a local one"""
+        if len(link_destination) == 0:
+            return
+        label = process_link_destination(link_destination, markdown_filepath)
+        if label.startswith('#'):
+            self.links.append((markdown_filepath, link_destination, label[1:]))
+            self.link_labels[(markdown_filepath, link_destination)] = label[1:]
+
+    def resolve_link(self, markdown_filepath, link_destination):
+        """Return the destination of the given link in the document, as 
+        process_link_destination does: local links found by the index are 
+        looked up instead of slugified again"""
+        label = self.link_labels.get((markdown_filepath, link_destination))
+        if label is not None:
+            return '#' + label
+        return process_link_destination(link_destination, markdown_filepath)
+
+    def get_broken_links(self):
+        """Return the (markdown filepath, link destination) of the local links
+        to labels not defined in the document"""
+        return [
+            (markdown_filepath, link_destination)
+            for markdown_filepath, link_destination, label in self.links
+            if label not in self.anchors
+        ]
+
+    def save(self, filepath):
+        """Save the anchors and the links of the index to the given file (see
+        load_anchor_index)"""
+        with open(filepath, 'wb') as index_file:
+            json.dump({'anchors': sorted(self.anchors), 'links': self.links}, index_file)
+
+
+def load_anchor_index(filepath):
+    """Return the AnchorIndex saved to the given file (see AnchorIndex.save)"""
+    with open(filepath, 'rb') as index_file:
+        saved_index = json.load(index_file)
+
+    anchor_index = AnchorIndex()
+    anchor_index.anchors = set(saved_index['anchors'])
+    for markdown_filepath, link_destination, label in saved_index['links']:
+        anchor_index.links.append((markdown_filepath, link_destination, label))
+        anchor_index.link_labels[(markdown_filepath, link_destination)] = label
+    return anchor_index
+
+
+def build_anchor_index(markdown_content):
+    """Return the AnchorIndex of the given monolitic Markdown content (see
+    build_monolitic_markdown_file)"""
+    anchor_index = AnchorIndex()
+    markdown_filepath = ''
+
+    lines = markdown_content.split('\n')
+    inside_a_code_block = False
+    inside_an_indented_code_block = False
+    inside_a_list = False
+    previous_line = ''
+    # Lines of the current paragraph: Pandoc wraps the links in several
+    # lines.
+    paragraph_lines = []
+
+    for line_index, line in enumerate(lines):
+        if inside_a_code_block or is_a_code_fence(line):
+            add_paragraph_links(anchor_index, markdown_filepath, paragraph_lines)
+            inside_a_code_block = inside_a_code_block != is_a_code_fence(line)
+            previous_line = line
+            continue
+
+        if line.strip() == '':
+            add_paragraph_links(anchor_index, markdown_filepath, paragraph_lines)
+            previous_line = ''
+            continue
+
+        # Indented code blocks (as Pandoc writes the code blocks without
+        # attributes) start after an empty line, indented 4 spaces more than
+        # the list item they belong to (if any).
+        indentation = get_indentation(line)
+        if indentation >= (8 if inside_a_list else 4) and \
+                (inside_an_indented_code_block or previous_line == ''):
+            inside_an_indented_code_block = True
+            previous_line = line
+            continue
+        inside_an_indented_code_block = False
+
+        if LIST_ITEM_REGEX.match(line) is not None:
+            add_paragraph_links(anchor_index, markdown_filepath, paragraph_lines)
+            inside_a_list = True
+        elif indentation == 0 and previous_line == '':
+            inside_a_list = False
+
+        file_marker = FILE_MARKER_REGEX.match(line)
+        if file_marker is not None:
+            add_paragraph_links(anchor_index, markdown_filepath, paragraph_lines)
+            markdown_filepath = file_marker.group(1)
+            anchor_index.add_file(markdown_filepath)
+            previous_line = line
+            continue
+
+        # Same header rule as add_newlines_before_markdown_headers.
+        next_line = lines[line_index + 1] if line_index + 1 < len(lines) else ''
+        if is_a_markdown_header(line, next_line):
+            if line.startswith('#'):
+                add_paragraph_links(anchor_index, markdown_filepath, paragraph_lines)
+            anchor_index.add_header(markdown_filepath, get_markdown_header_text(line.strip()))
+
+        if '<' in line:
+            for anchor_match in HTML_ANCHOR_REGEX.finditer(line):
+                anchor_index.add_html_anchor(markdown_filepath, anchor_match.group(1))
+
+        paragraph_lines.append(line)
+        previous_line = line
+
+    add_paragraph_links(anchor_index, markdown_filepath, paragraph_lines)
+
+    return anchor_index
+
+
+def add_paragraph_links(anchor_index, markdown_filepath, paragraph_lines):
+    """Add the links of the given lines to the index and empty them"""
+    paragraph = '\n'.join(paragraph_lines)
+    del paragraph_lines[:]
+    if '](' not in paragraph:
+        return
+
+    for link_match in LINK_REGEX.finditer(CODE_SPAN_REGEX.sub('', paragraph)):
+        if link_match.group(1) != '!':
+            anchor_index.add_link(markdown_filepath, link_match.group(3))
+        # Links inside the text of the link (i.e. images).
+        for inner_link_match in LINK_REGEX.finditer(link_match.group(2)):
+            if inner_link_match.group(1) != '!':
+                anchor_index.add_link(markdown_filepath, inner_link_match.group(3))
@@ -0,0 +1,243 @@
+"""Local cache of the remote images of the documents.
+
+Before generating the PDF, every remote image is downloaded (in parallel) to
+a content-addressed directory, so Pandoc and LaTeX only use local files. 
+Cached images are revalidated with their ETag/Last-Modified headers in later
+builds, once they are older than ASSET_REVALIDATION_TTL. Images the server 
+definitively refuses (HTTP 4xx) are removed from the cache. In offline mode 
+only the images already cached are used.
+"""
+from __future__ import print_function
+import hashlib
+import httplib
+import json
+import os
+import socket
+import tempfile
+import time
+import urllib2
+import urlparse
+from multiprocessing.pool import ThreadPool
+
+from file_cache import FileCache, get_cache_dirpath, file_lock, DEFAULT_CACHE_MAX_SIZE
+from links_processing import print_warning
+
+
+# Seconds to wait for every download.
+ASSET_DOWNLOAD_TIMEOUT = 30
+
+# Maximum number of simultaneous downloads.
+ASSET_DOWNLOAD_MAX_CONNECTIONS = 8
+
+# Images bigger than this (in bytes) are not downloaded.
+ASSET_MAX_SIZE = 20 * 1024 * 1024
+
+# Seconds a downloaded (or revalidated) image is used without revalidating it.
+ASSET_REVALIDATION_TTL = 24 * 60 * 60
+
+# HTTP 4xx errors which may not happen again, so the cached image is kept.
+ASSET_TRANSIENT_HTTP_ERRORS = [408, 429]
+
+IMAGE_EXTENSIONS = ['.png', '.jpg', '.jpeg', '.gif', '.pdf', '.eps']
+
+IMAGE_CONTENT_TYPE_EXTENSIONS = {
+    'image/png': '.png',
+    'image/jpeg': '.jpg',
+    'image/gif': '.gif',
+    'application/pdf': '.pdf',
+    'application/postscript': '.eps',
+}
+
+# First bytes of the image formats, by extension.
+IMAGE_SIGNATURE_EXTENSIONS = [
+    ('\x89PNG\r\n\x1a\n', '.png'),
+    ('\xff\xd8\xff', '.jpg'),
+    ('GIF87a', '.gif'),
+    ('GIF89a', '.gif'),
+    ('%PDF', '.pdf'),
+    ('%!PS', '.eps'),
+]
+
+
+def get_asset_extension(url, content_type, data=''):
+    """Return the file extension for the given image URL and Content-Type.
+    If neither gives a known extension, it is guessed from the first bytes 
+    of the given image data"""
+    extension = os.path.splitext(urlparse.urlparse(url).path)[1].lower()
+    if extension in IMAGE_EXTENSIONS:
+        return extension
+
+    content_type = (content_type or '').split(';')[0].strip().lower()
+    if content_type in IMAGE_CONTENT_TYPE_EXTENSIONS:
+        return IMAGE_CONTENT_TYPE_EXTENSIONS[content_type]
+
+    for signature, extension in IMAGE_SIGNATURE_EXTENSIONS:
+        if data.startswith(signature):
+            return extension
+    return ''
+
+
+def is_definitive_http_error(error):
+    """Return True if the given download error (see download_asset_job) 
+    means the image is no longer available"""
+    return isinstance(error, urllib2.HTTPError) and \
+        400 <= error.code < 500 and error.code not in ASSET_TRANSIENT_HTTP_ERRORS
+
+
+def download_asset_job(job):
+    """Download the asset given by (url, cached_entry, timeout, max_size).
+
+    Return (url, download) where download is None if the cached entry is 
+    still valid (HTTP 304), a dictionary with the downloaded data and headers
+    or an exception if the download failed."""
+    url, cached_entry, timeout, max_size = job
+
+    request = urllib2.Request(url.encode('utf-8'))
+    if cached_entry is not None:
+        if cached_entry.get('etag'):
+            request.add_header('If-None-Match', cached_entry['etag'])
+        if cached_entry.get('last_modified'):
+            request.add_header('If-Modified-Since', cached_entry['last_modified'])
+
+    try:
+        response = urllib2.urlopen(request, timeout=timeout)
+        try:
+            data = response.read(max_size + 1)
+            headers = response.info()
+        finally:
+            response.close()
+    except urllib2.HTTPError as error:
+        if error.code == 304 and cached_entry is not None:
+            return url, None
+        return url, error
+    except (urllib2.URLError, httplib.HTTPException, socket.error, ValueError) as error:
+        return url, error
+
+    if len(data) > max_size:
+        return url, ValueError('Image bigger than %d bytes' % max_size)
+
+    return url, {
+        'data': data,
+        'etag': headers.getheader('ETag'),
+        'last_modified': headers.getheader('Last-Modified'),
+        'extension': get_asset_extension(url, headers.getheader('Content-Type'), data),
+    }
+
+
+class RemoteAssetCache(object):
+    """Content-addressed cache of remote assets.
+
+    The files are stored in a FileCache (named after the hash of their 
+    content) and a JSON index associates every URL to its file, to the 
+    headers needed for revalidating it and to the time it was last 
+    validated. Entries are not revalidated until they are older than ttl 
+    seconds.
+    """
+    def __init__(self, cache_dirpath, max_size=DEFAULT_CACHE_MAX_SIZE, ttl=ASSET_REVALIDATION_TTL):
+        self.files = FileCache(os.path.join(cache_dirpath, 'assets'), max_size)
+        self.index_filepath = os.path.join(cache_dirpath, 'assets_index.json')
+        self.ttl = ttl
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.index_filepath, 'rb') as index_file:
+                self.index = json.load(index_file)
+        except (IOError, ValueError):
+            self.index = {}
+
+    def save(self, updated_entries, removed_urls=()):
+        """Save the index with the given updated entries and without the
+        entries of the given URLs"""
+        with file_lock(self.index_filepath + '.lock'):
+            # Merge with the entries saved meanwhile by other processes.
+            self.load()
+            self.index.update(updated_entries)
+            for url in removed_urls:
+                self.index.pop(url, None)
+
+            index_fd, index_temp_filepath = tempfile.mkstemp(dir=os.path.dirname(self.index_filepath), prefix='.tmp-')
+            with os.fdopen(index_fd, 'wb') as index_file:
+                json.dump(self.index, index_file)
+            os.rename(index_temp_filepath, self.index_filepath)
+
+    def get_cached_entry(self, url):
+        """Return the index entry of the given URL if its file is cached"""
+        entry = self.index.get(url)
+        if entry is not None and os.path.isfile(self.files.get_entry_path(entry['key'])):
+            return entry
+        return None
+
+    def get_local_path(self, url):
+        """Return the path of the cached copy of the given URL (or None)"""
+        entry = self.get_cached_entry(url)
+        if entry is None:
+            return None
+        return self.files.get_entry_path(entry['key'])
+
+    def fetch(self, urls, offline=False, timeout=ASSET_DOWNLOAD_TIMEOUT, max_connections=ASSET_DOWNLOAD_MAX_CONNECTIONS):
+        """Download (or revalidate) the given URLs. Return a dictionary 
+        associating every URL available in the cache to its local path."""
+        urls = sorted(set(urls))
+        now = time.time()
+        jobs = []
+        # (url, None) keeps the cached copy of the URL.
+        downloads = []
+        for url in urls:
+            cached_entry = self.get_cached_entry(url)
+            if cached_entry is not None and (offline or now - cached_entry.get('time', 0) < self.ttl):
+                downloads.append((url, None))
+            elif not offline:
+                jobs.append((url, cached_entry, timeout, ASSET_MAX_SIZE))
+
+        if len(jobs) > 0:
+            pool = ThreadPool(min(max_connections, len(jobs)))
+            try:
+                downloads += pool.map(download_asset_job, jobs)
+            finally:
+                pool.close()
+                pool.join()
+        revalidated_urls = set(job[0] for job in jobs)
+
+        local_paths = {}
+        updated_entries = {}
+        removed_urls = []
+        for url, download in downloads:
+            if isinstance(download, dict):
+                key = hashlib.sha256(download['data']).hexdigest() + download['extension']
+                if not self.files.has(key):
+                    self.files.put(key, download['data'])
+                self.index[url] = updated_entries[url] = {
+                    'key': key,
+                    'etag': download['etag'],
+                    'last_modified': download['last_modified'],
+                    'time': now,
+                }
+            elif isinstance(download, Exception):
+                print_warning('Remote image could not be downloaded [%s] - %s' % (url.encode('utf-8'), download))
+                if is_definitive_http_error(download) and url in self.index:
+                    del self.index[url]
+                    removed_urls.append(url)
+            else:
+                # Still valid: mark it as recently used.
+                self.files.has(self.index[url]['key'])
+                if url in revalidated_urls:
+                    self.index[url] = updated_entries[url] = dict(self.index[url], time=now)
+
+            local_path = self.get_local_path(url)
+            if local_path is not None:
+                local_paths[url] = local_path
+
+        if len(updated_entries) > 0 or len(removed_urls) > 0:
+            self.save(updated_entries, removed_urls)
+        self.files.evict()
+
+        return local_paths
+
+
+def get_remote_asset_cache():
+    """Return the remote asset cache shared by md2pdf and its Pandoc filters"""
+    if get_remote_asset_cache.cache is None:
+        get_remote_asset_cache.cache = RemoteAssetCache(get_cache_dirpath())
+    return get_remote_asset_cache.cache
+get_remote_asset_cache.cache = None
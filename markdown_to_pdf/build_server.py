@@ -0,0 +1,338 @@
+"""HTTP API of the md2pdf build server (md2pdf serve).
+
+The server keeps a single md2pdf process running, so the Python interpreter,
+the Pandoc backend, the compiled regular expressions, the hyphenator and the
+caches are loaded once instead of once per PDF. Builds are queued and run by
+a fixed number of worker threads.
+
+API (JSON responses, except for the PDF):
+
+    POST   /jobs          Queue a build. The body is either a JSON object
+                          {"input": <configuration file>, "cover": <cover
+                          metadata file>} with paths of the server host, or
+                          a (gzipped) tarball of the project. For tarballs the
+                          configuration and cover files inside the tarball are
+                          given by the "input" (md2pdf.yml by default) and
+                          "cover" query parameters.
+                          Returns 202 and the job, or 503 if the queue is full
+    GET    /jobs          List the jobs
+    GET    /jobs/<id>     Return the job (status: queued, running, done or
+                          failed)
+    GET    /jobs/<id>/pdf Return the PDF of a done job
+    DELETE /jobs/<id>     Remove a finished job and its files
+"""
+from __future__ import print_function
+import BaseHTTPServer
+import io
+import json
+import os
+import Queue
+import shutil
+import SocketServer
+import tarfile
+import tempfile
+import threading
+import time
+import urlparse
+import uuid
+
+from links_processing import print_error
+
+
+BUILD_SERVER_DEFAULT_HOST = '127.0.0.1'
+BUILD_SERVER_DEFAULT_PORT = 8427
+
+# Maximum number of jobs waiting to be built.
+BUILD_SERVER_MAX_QUEUED_JOBS = 32
+
+# Maximum number of finished jobs kept. The oldest ones are removed (with
+# their PDF) when there are more.
+BUILD_SERVER_MAX_FINISHED_JOBS = 100
+
+# Maximum size (in bytes) of a request body.
+BUILD_SERVER_MAX_UPLOAD_SIZE = 256 * 1024 * 1024
+
+BUILD_JOB_STATUSES = ['queued', 'running', 'done', 'failed']
+
+
+class BuildJob(object):
+    """A PDF build requested to the server. Its files (the extracted tarball
+    and the PDF) are written to its own work directory"""
+
+    def __init__(self, input_conf_file, cover_metadata_file, workdir):
+        self.id = uuid.uuid4().hex
+        self.input_conf_file = input_conf_file
+        self.cover_metadata_file = cover_metadata_file
+        self.workdir = workdir
+        self.output_pdf_file = os.path.join(workdir, 'output.pdf')
+        self.status = 'queued'
+        self.error = None
+        self.created_time = time.time()
+        self.start_time = None
+        self.end_time = None
+
+    def to_json(self):
+        return {
+            'id': self.id,
+            'input': self.input_conf_file,
+            'cover': self.cover_metadata_file,
+            'status': self.status,
+            'error': self.error,
+            'created': self.created_time,
+            'started': self.start_time,
+            'finished': self.end_time,
+        }
+
+
+class BuildServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """HTTP server queueing the builds and running them in `workers`
+    threads.
+
+    build_function(input_conf_file, output_pdf_file, cover_metadata_file,
+    workdir) generates the PDF of a job, raising an exception if it fails.
+    idle_function() (if given) is called, holding jobs_lock, whenever the 
+    last queued job finishes and when the server is closed, so the state 
+    shared by the builds (i.e. caches) is cleaned up while no job uses it.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(
+        self, server_address, build_function, workdir, workers=1,
+        max_queued_jobs=BUILD_SERVER_MAX_QUEUED_JOBS,
+        max_finished_jobs=BUILD_SERVER_MAX_FINISHED_JOBS, idle_function=None
+    ):
+        BaseHTTPServer.HTTPServer.__init__(self, server_address, BuildRequestHandler)
+        self.build_function = build_function
+        self.idle_function = idle_function
+        self.workdir = workdir
+        self.max_finished_jobs = max_finished_jobs
+        self.jobs = {}
+        self.finished_job_ids = []
+        # Jobs queued or running.
+        self.pending_jobs = 0
+        self.jobs_lock = threading.Lock()
+        self.job_queue = Queue.Queue(max_queued_jobs)
+
+        self.workers = []
+        for index in range(workers):
+            worker = threading.Thread(target=self.run_worker, name='md2pdf-worker-%d' % index)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def create_job(self, input_conf_file=None, cover_metadata_file=None, tarball=None):
+        """Return a new job for the given configuration file, extracting
+        the given tarball file object (if any) into the job work directory.
+        The configuration and cover files are then relative to the tarball"""
+        job_workdir = tempfile.mkdtemp(prefix='job-', dir=self.workdir)
+        try:
+            if tarball is not None:
+                extract_tarball(tarball, job_workdir)
+                input_conf_file = os.path.join(job_workdir, input_conf_file or 'md2pdf.yml')
+                if cover_metadata_file is not None:
+                    cover_metadata_file = os.path.join(job_workdir, cover_metadata_file)
+
+            if input_conf_file is None or not os.path.isfile(input_conf_file):
+                raise ValueError('Input file [%s] not found' % input_conf_file)
+            if cover_metadata_file is not None and not os.path.isfile(cover_metadata_file):
+                raise ValueError('Cover metadata file [%s] not found' % cover_metadata_file)
+        except:
+            shutil.rmtree(job_workdir, ignore_errors=True)
+            raise
+
+        return BuildJob(input_conf_file, cover_metadata_file, job_workdir)
+
+    def queue_job(self, job):
+        """Queue the given job. Return False if the queue is full"""
+        with self.jobs_lock:
+            try:
+                self.job_queue.put_nowait(job)
+            except Queue.Full:
+                shutil.rmtree(job.workdir, ignore_errors=True)
+                return False
+            self.jobs[job.id] = job
+            self.pending_jobs += 1
+        return True
+
+    def get_job(self, job_id):
+        with self.jobs_lock:
+            return self.jobs.get(job_id)
+
+    def get_jobs(self):
+        with self.jobs_lock:
+            return sorted(self.jobs.values(), key=lambda job: job.created_time)
+
+    def remove_job(self, job_id):
+        """Remove the given finished job and its files. Return False if the
+        job is not found or not finished yet"""
+        with self.jobs_lock:
+            job = self.jobs.get(job_id)
+            if job is None or job.status not in ('done', 'failed'):
+                return False
+            del self.jobs[job_id]
+            self.finished_job_ids.remove(job_id)
+        shutil.rmtree(job.workdir, ignore_errors=True)
+        return True
+
+    def run_worker(self):
+        while True:
+            job = self.job_queue.get()
+            job.status = 'running'
+            job.start_time = time.time()
+            try:
+                self.build_function(
+                    job.input_conf_file, job.output_pdf_file,
+                    job.cover_metadata_file, job.workdir
+                )
+                self.finish_job(job, 'done')
+            except Exception as error:
+                print_error('Job [%s] failed - %s' % (job.id, error))
+                self.finish_job(job, 'failed', str(error))
+
+    def finish_job(self, job, status, error=None):
+        removed_jobs = []
+        with self.jobs_lock:
+            job.status = status
+            job.error = error
+            job.end_time = time.time()
+            self.finished_job_ids.append(job.id)
+            while len(self.finished_job_ids) > self.max_finished_jobs:
+                removed_jobs.append(self.jobs.pop(self.finished_job_ids.pop(0)))
+
+            self.pending_jobs -= 1
+            if self.pending_jobs == 0 and self.idle_function is not None:
+                try:
+                    self.idle_function()
+                except Exception as error:
+                    print_error('Cleaning up the idle server failed - %s' % error)
+        for removed_job in removed_jobs:
+            shutil.rmtree(removed_job.workdir, ignore_errors=True)
+
+
+class BuildRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """HTTP API of BuildServer (see the module documentation)"""
+
+    def send_json(self, status, content):
+        body = json.dumps(content)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_json(self, status, message):
+        self.send_json(status, {'error': message})
+
+    def get_path_parts(self):
+        return [part for part in urlparse.urlparse(self.path).path.split('/') if part]
+
+    def do_GET(self):
+        path_parts = self.get_path_parts()
+        if path_parts == ['jobs']:
+            self.send_json(200, [job.to_json() for job in self.server.get_jobs()])
+            return
+
+        if len(path_parts) not in (2, 3) or path_parts[0] != 'jobs' or path_parts[2:] not in ([], ['pdf']):
+            self.send_error_json(404, 'Not found')
+            return
+
+        job = self.server.get_job(path_parts[1])
+        if job is None:
+            self.send_error_json(404, 'Job [%s] not found' % path_parts[1])
+        elif len(path_parts) == 2:
+            self.send_json(200, job.to_json())
+        elif job.status != 'done':
+            self.send_error_json(409, 'Job [%s] is %s' % (job.id, job.status))
+        else:
+            with open(job.output_pdf_file, 'rb') as pdf_file:
+                pdf = pdf_file.read()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/pdf')
+            self.send_header('Content-Length', str(len(pdf)))
+            self.end_headers()
+            self.wfile.write(pdf)
+
+    def do_POST(self):
+        if self.get_path_parts() != ['jobs']:
+            self.send_error_json(404, 'Not found')
+            return
+
+        try:
+            content_length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            content_length = -1
+        if content_length < 0 or content_length > BUILD_SERVER_MAX_UPLOAD_SIZE:
+            self.send_error_json(413, 'Invalid request size')
+            return
+        body = self.rfile.read(content_length)
+
+        content_type = self.headers.get('Content-Type', '').split(';')[0].strip()
+        try:
+            if content_type == 'application/json':
+                try:
+                    request = json.loads(body)
+                    input_conf_file = request['input']
+                    cover_metadata_file = request.get('cover')
+                except (ValueError, KeyError, TypeError, AttributeError):
+                    raise ValueError('Invalid job request')
+                job = self.server.create_job(input_conf_file, cover_metadata_file)
+            else:
+                query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+                job = self.server.create_job(
+                    query.get('input', [None])[0], query.get('cover', [None])[0],
+                    io.BytesIO(body)
+                )
+        except ValueError as error:
+            self.send_error_json(400, str(error))
+            return
+
+        if not self.server.queue_job(job):
+            self.send_error_json(503, 'Too many queued jobs')
+            return
+
+        self.send_json(202, job.to_json())
+
+    def do_DELETE(self):
+        path_parts = self.get_path_parts()
+        if len(path_parts) != 2 or path_parts[0] != 'jobs':
+            self.send_error_json(404, 'Not found')
+        elif self.server.get_job(path_parts[1]) is None:
+            self.send_error_json(404, 'Job [%s] not found' % path_parts[1])
+        elif not self.server.remove_job(path_parts[1]):
+            self.send_error_json(409, 'Job [%s] is not finished' % path_parts[1])
+        else:
+            self.send_json(200, {'id': path_parts[1]})
+
+    def log_message(self, format, *args):
+        print('Build server: %s - %s' % (self.address_string(), format % args))
+
+
+def extract_tarball(tarball, dirpath):
+    """Extract the given (gzipped) tarball file object into dirpath. Raise
+    ValueError if it is invalid or has files outside dirpath"""
+    try:
+        with tarfile.open(fileobj=tarball, mode='r:*') as tar:
+            members = tar.getmembers()
+            for member in members:
+                member_path = os.path.realpath(os.path.join(dirpath, member.name))
+                if not member_path.startswith(os.path.realpath(dirpath) + os.sep) or \
+                        not (member.isfile() or member.isdir()):
+                    raise ValueError('Invalid tarball member [%s]' % member.name)
+            tar.extractall(dirpath, members)
+    except tarfile.TarError as error:
+        raise ValueError('Invalid tarball - %s' % error)
+
+
+def run_build_server(server_address, build_function, workdir, workers=1, idle_function=None):
+    """Serve the build API on the given (host, port) address until 
+    interrupted (see BuildServer)"""
+    server = BuildServer(server_address, build_function, workdir, workers, idle_function=idle_function)
+    print('Build server listening on http://%s:%d/jobs (press Ctrl+C to stop)' % server.server_address[:2])
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if idle_function is not None:
+            with server.jobs_lock:
+                idle_function()
@@ -3,61 +3,167 @@
 import subprocess
 import sys
 import os
+import re
+import json
+import tempfile
+from distutils.spawn import find_executable
 
+from file_cache import get_cache_dirpath, file_lock
 
 
+# Executables required by md2pdf (see check_all_requirements).
+REQUIRED_TOOLS = ['pandoc', 'pdftk', 'xelatex']
 
-def check_all_requirements():
-    is_pandoc_installed()
-    is_pdftk_installed()
-    is_xelatex_installed()
-    #is_false_installed()
-    
-    pass
+# Minimum Pandoc version providing the "pandoc server" command.
+PANDOC_SERVER_MIN_VERSION = (3, 0)
 
 
+def check_all_requirements(pandoc_backend_name='oneshot'):
+    """Abort if any of the required tools is not correctly installed, or if
+    the installed Pandoc can not run the given Pandoc backend (see 
+    pandoc_backend)"""
+    for tool in REQUIRED_TOOLS:
+        check_tool_installed(tool)
+    check_pandoc_backend_supported(pandoc_backend_name)
 
-def is_pandoc_installed():
-    FNULL = open(os.devnull, 'w')
-    try:
-        subprocess.check_call(["pandoc","--version"],stdout=FNULL, stderr=subprocess.STDOUT)
-    except Exception as e:
-        print "Aborted: pandoc is not correctly installed."
+
+def check_pandoc_backend_supported(pandoc_backend_name):
+    """Abort if the server Pandoc backend is requested and the installed 
+    Pandoc has no server. The "auto" backend falls back to one Pandoc 
+    process per conversion instead"""
+    if pandoc_backend_name == 'server' and get_pandoc_version_number() < PANDOC_SERVER_MIN_VERSION:
+        print "Aborted: --pandoc-backend=server requires Pandoc >= %s (installed: %s). Use --pandoc-backend=oneshot or auto." % (
+            '.'.join(str(number) for number in PANDOC_SERVER_MIN_VERSION), get_pandoc_version()
+        )
         sys.exit(1)
-        FNULL.close()
 
-    FNULL.close()
-def is_pdftk_installed():
-    FNULL = open(os.devnull, 'w')
+
+class ToolchainCache(object):
+    """Persistent cache (a JSON file) of the versions printed by the tools,
+    by path of their executable. An entry is valid while the executable
+    keeps its modification time and size, so tools are run with --version
+    only when they are installed or updated"""
+    def __init__(self, cache_filepath):
+        self.cache_filepath = cache_filepath
+        self.tools = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.cache_filepath, 'rb') as cache_file:
+                self.tools = json.load(cache_file)
+        except (IOError, ValueError):
+            self.tools = {}
+
+    def get(self, tool_filepath, tool_stat):
+        """Return the cached version of the given executable (a str) or None
+        if it is not cached or it has changed"""
+        tool = self.tools.get(tool_filepath)
+        if tool is None or tool['mtime'] != tool_stat.st_mtime or tool['size'] != tool_stat.st_size:
+            return None
+        return tool['version'].encode('utf-8')
+
+    def update(self, tool_filepath, tool_stat, version):
+        """Store the version of the given executable and save the cache"""
+        with file_lock(self.cache_filepath + '.lock'):
+            # Merge with the entries saved meanwhile by other processes.
+            self.load()
+
+            self.tools[tool_filepath] = {
+                'mtime': tool_stat.st_mtime,
+                'size': tool_stat.st_size,
+                'version': version.decode('utf-8', 'replace')
+            }
+            # Forget the tools removed.
+            for cached_tool_filepath in list(self.tools.keys()):
+                if not os.path.isfile(cached_tool_filepath):
+                    del self.tools[cached_tool_filepath]
+
+            cache_dirpath = os.path.dirname(self.cache_filepath)
+            cache_fd, cache_temp_filepath = tempfile.mkstemp(dir=cache_dirpath, prefix='.tmp-')
+            with os.fdopen(cache_fd, 'wb') as cache_file:
+                json.dump(self.tools, cache_file)
+            os.rename(cache_temp_filepath, self.cache_filepath)
+
+
+def get_toolchain_cache():
+    if get_toolchain_cache.cache is None:
+        get_toolchain_cache.cache = ToolchainCache(
+            os.path.join(get_cache_dirpath(), 'toolchain.json')
+        )
+    return get_toolchain_cache.cache
+get_toolchain_cache.cache = None
+
+
+def get_tool_version(tool):
+    """Return the first line printed by \"<tool> --version\" or None if the
+    tool is not installed or fails. The version is cached (see
+    ToolchainCache)"""
+    tool_filepath = find_executable(tool)
+    if tool_filepath is None:
+        return None
+
+    tool_real_filepath = os.path.realpath(tool_filepath)
     try:
-        subprocess.check_call(["pdftk","--version"],stdout=FNULL, stderr=subprocess.STDOUT)
-    except Exception as e:
-        print "Aborted: pdftk is not correctly installed."
-        sys.exit(1)
-        FNULL.close()
+        tool_stat = os.stat(tool_real_filepath)
+    except OSError:
+        return None
 
-    FNULL.close()
+    version = get_toolchain_cache().get(tool_real_filepath, tool_stat)
+    if version is not None:
+        return version
 
+    try:
+        version_output = subprocess.check_output([tool_filepath, '--version'], stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    version_lines = [line.strip() for line in version_output.splitlines() if line.strip()]
+    version = version_lines[0] if len(version_lines) > 0 else ''
 
-def is_xelatex_installed():
-    FNULL = open(os.devnull, 'w')
     try:
-        subprocess.check_call(["xelatex","--version"],stdout=FNULL, stderr=subprocess.STDOUT)
-    except Exception as e:
-        print "Aborted: xelatex is not correctly installed."
-        sys.exit(1)
-        FNULL.close()
+        get_toolchain_cache().update(tool_real_filepath, tool_stat, version)
+    except (IOError, OSError):
+        # The cache directory is not writable: tools are probed every time.
+        pass
+    return version
 
-    FNULL.close()
 
+def get_pandoc_version():
+    """Return the version string printed by \"pandoc --version\" """
+    if get_pandoc_version.version is None:
+        get_pandoc_version.version = get_tool_version('pandoc')
+        if get_pandoc_version.version is None:
+            raise OSError('Pandoc is not correctly installed')
 
-def is_false_installed():
-    FNULL = open(os.devnull, 'w')
-    try:
-        subprocess.check_call(["false_program","--version"],stdout=FNULL, stderr=subprocess.STDOUT)
-    except Exception as e:
-        print "Aborted: false_program is not correctly installed"
+    return get_pandoc_version.version
+get_pandoc_version.version = None
+
+
+def get_pandoc_version_number():
+    """Return the Pandoc version as a tuple of integers (ie. (1, 15, 1))"""
+    version_match = re.search(r'(\d+(?:\.\d+)*)', get_pandoc_version())
+    if version_match is None:
+        return ()
+    return tuple(int(number) for number in version_match.group(1).split('.'))
+
+
+def check_tool_installed(tool):
+    if get_tool_version(tool) is None:
+        print "Aborted: %s is not correctly installed." % tool
         sys.exit(1)
-        FNULL.close()
 
-    FNULL.close()
\ No newline at end of file
+
+def is_pandoc_installed():
+    check_tool_installed('pandoc')
+
+
+def is_pdftk_installed():
+    check_tool_installed('pdftk')
+
+
+def is_xelatex_installed():
+    check_tool_installed('xelatex')
+
+
+def is_false_installed():
+    check_tool_installed('false_program')
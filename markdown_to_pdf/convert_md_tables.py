@@ -1,13 +1,27 @@
 from __future__ import print_function
+import os
 import re
 from sys import platform
 import math
-from hyphenate import *
 
 
+# Backends rendering the tables: 'grid' converts them to grid tables, so
+# Pandoc computes the column widths, and 'latex' keeps them as pipe tables,
+# rendered as LaTeX longtables by the Pandoc filter (see latex_tables).
+TABLE_BACKENDS = ['grid', 'latex']
 
-def translate_md_tables(markdown_content):
-    """ Convert github tables to grid tables"""
+
+def get_table_backend():
+    """Return the table backend, set with the MD2PDF_TABLE_BACKEND
+    environment variable ('grid' by default)"""
+    return os.environ.get('MD2PDF_TABLE_BACKEND') or 'grid'
+
+
+def translate_md_tables(markdown_content, table_backend=None):
+    """ Convert github tables to grid tables (or to pipe tables with the
+    'latex' table backend)"""
+    if table_backend is None:
+        table_backend = get_table_backend()
 
     lines = markdown_content.split('\n')
 
@@ -33,7 +47,10 @@ def translate_md_tables(markdown_content):
                 continue
 
         if table:
-            readed_lines += generate_md_table(candidate_header, separator, table_lines)
+            if table_backend == 'latex':
+                readed_lines += generate_md_pipe_table(candidate_header, separator, table_lines)
+            else:
+                readed_lines += generate_md_table(candidate_header, separator, table_lines)
         elif candidate_header is not None:
             readed_lines.append(candidate_header)
 
@@ -69,23 +86,31 @@ def split_row_columns(row,n_header_columns=0):
     return columns
 
 
-def generate_md_table(header, header_separator, rows):
-
-    
-    n_cols = count_row_columns(header)
-    table=[]
-    if count_row_columns(header_separator) != n_cols:
+def have_matching_separator(header, header_separator):
+    """Return True if the given table header and separator have the same
+    number of columns. Otherwise, print the error"""
+    if count_row_columns(header_separator) != count_row_columns(header):
         print(
             (
                 'Mismatched number of columns between header (%d)' +
                 'and separator (%d) in table\n' +
                 '  Table header: [%s]\n'
             ) % (
-                n_cols,
+                count_row_columns(header),
                 count_row_columns(header_separator),
                 header
             )
         )
+        return False
+    return True
+
+
+def generate_md_table(header, header_separator, rows):
+
+    
+    n_cols = count_row_columns(header)
+    table=[]
+    if not have_matching_separator(header, header_separator):
         return [header]+[header_separator]+rows
 
     
@@ -105,7 +130,22 @@ def generate_md_table(header, header_separator, rows):
     return create_table_as_rows(table, col_lengths)
 
 
-    
+
+def generate_md_pipe_table(header, header_separator, rows):
+    """Return the lines of the given table as a pipe table. Its column
+    widths and hyphenation are done by the Pandoc filter (parsing the
+    \\BreakableChar{} commands of every cell is most of the time Pandoc
+    spends on a grid table)"""
+    n_cols = count_row_columns(header)
+    if not have_matching_separator(header, header_separator):
+        return [header]+[header_separator]+rows
+
+    return (
+        [header, header_separator] +
+        ['|' + '|'.join(split_row_columns(row,n_cols)) + '|' for row in rows]
+    )
+
+
 def fix_col_length(table, col_lengths):
     new_table = []
     for row in table:
@@ -172,7 +212,9 @@ def add_breakable_char(element):
         
         return process_breakable_with_html(element)
 
-    #try hypenathion using a libray
+    #try hypenathion using a libray (imported here because loading the
+    # patterns slows down the start of md2pdf and its Pandoc filters)
+    from hyphenate import hyphenate_word
     subelements = hyphenate_word(element)
 
     if isinstance(subelements, basestring):
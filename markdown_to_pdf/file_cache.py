@@ -0,0 +1,209 @@
+import os
+import errno
+import hashlib
+import tempfile
+import contextlib
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where caches are not locked.
+    fcntl = None
+
+
+# Maximum size (in bytes) of each persistent cache before evicting entries.
+DEFAULT_CACHE_MAX_SIZE = 256 * 1024 * 1024
+
+
+def get_cache_dirpath():
+    """Return the directory where md2pdf stores its persistent caches
+
+    It can be set with the MD2PDF_CACHE_DIR environment variable. Otherwise
+    the XDG cache directory of the user is used."""
+    if os.environ.get('MD2PDF_CACHE_DIR'):
+        return os.environ['MD2PDF_CACHE_DIR']
+
+    xdg_cache_dirpath = os.environ.get(
+        'XDG_CACHE_HOME',
+        os.path.join(os.path.expanduser('~'), '.cache')
+    )
+    return os.path.join(xdg_cache_dirpath, 'md2pdf')
+
+
+def make_dirs(dirpath):
+    """Create the given directory (and its parents) if it does not exist.
+    Concurrent md2pdf processes may create it at the same time"""
+    if os.path.isdir(dirpath):
+        return
+    try:
+        os.makedirs(dirpath)
+    except OSError as exception:
+        # Created meanwhile by another process.
+        if exception.errno != errno.EEXIST:
+            raise
+
+
+@contextlib.contextmanager
+def file_lock(lock_filepath):
+    """Hold an exclusive lock on the given file (created if needed) while the
+    context runs, so concurrent md2pdf processes sharing a cache or a build 
+    directory wait for each other"""
+    if fcntl is None:
+        yield
+        return
+
+    lock_dirpath = os.path.dirname(lock_filepath)
+    if lock_dirpath != '':
+        make_dirs(lock_dirpath)
+
+    with open(lock_filepath, 'ab') as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def generate_cache_key(*parts):
+    """Return a key identifying the given strings (content-addressed)"""
+    key_hash = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, unicode):
+            part = part.encode('utf-8')
+        key_hash.update(hashlib.sha256(part).digest())
+    return key_hash.hexdigest()
+
+
+class FileCache(object):
+    """Persistent cache storing each entry in a file named after its key.
+
+    The modification time of the entries is updated when they are read, so 
+    evict() removes the least recently used entries first.
+    """
+    def __init__(self, cache_dirpath, max_size=DEFAULT_CACHE_MAX_SIZE):
+        self.cache_dirpath = cache_dirpath
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+        make_dirs(cache_dirpath)
+
+    def get_entry_path(self, key):
+        return os.path.join(self.cache_dirpath, key)
+
+    def get(self, key):
+        """Return the data stored for the given key or None if not cached"""
+        entry_path = self.get_entry_path(key)
+        try:
+            with open(entry_path, 'rb') as entry_file:
+                data = entry_file.read()
+            os.utime(entry_path, None)
+        except (IOError, OSError):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return data
+
+    def has(self, key):
+        """Return True if there is an entry for the given key"""
+        entry_path = self.get_entry_path(key)
+        try:
+            os.utime(entry_path, None)
+        except OSError:
+            self.misses += 1
+            return False
+
+        self.hits += 1
+        return True
+
+    def put(self, key, data):
+        """Store the given data (a byte string) for the given key"""
+        # Write to a temporal file first and rename it, so a half written 
+        # entry is never read.
+        entry_fd, entry_temp_path = tempfile.mkstemp(dir=self.cache_dirpath, prefix='.tmp-')
+        with os.fdopen(entry_fd, 'wb') as entry_file:
+            entry_file.write(data)
+        os.rename(entry_temp_path, self.get_entry_path(key))
+
+    def evict(self):
+        """Remove the least recently used entries until the cache size is not 
+        greater than max_size"""
+        with file_lock(self.cache_dirpath + '.lock'):
+            self.evict_entries()
+
+    def evict_entries(self):
+        entries = []
+        cache_size = 0
+        for entry_name in os.listdir(self.cache_dirpath):
+            entry_path = os.path.join(self.cache_dirpath, entry_name)
+            try:
+                entry_stat = os.stat(entry_path)
+            except OSError:
+                continue
+            entries.append((entry_stat.st_mtime, entry_stat.st_size, entry_path))
+            cache_size += entry_stat.st_size
+
+        for entry_mtime, entry_size, entry_path in sorted(entries):
+            if cache_size <= self.max_size:
+                break
+            try:
+                os.remove(entry_path)
+            except OSError:
+                pass
+            cache_size -= entry_size
+
+
+class MemoryCache(object):
+    """In-memory cache with the same interface as FileCache, optionally
+    backed by another (persistent) cache.
+
+    evict() removes the entries which were not used since the previous 
+    eviction, so only the entries of the last build are kept in memory.
+
+    It can be shared by the threads building several documents (see 
+    build_batch).
+    """
+    def __init__(self, backing_cache=None):
+        self.backing_cache = backing_cache
+        self.entries = {}
+        self.used_keys = set()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Return the data stored for the given key or None if not cached"""
+        with self.lock:
+            data = self.entries.get(key)
+            if data is None and self.backing_cache is not None:
+                data = self.backing_cache.get(key)
+                if data is not None:
+                    self.entries[key] = data
+
+            if data is None:
+                self.misses += 1
+                return None
+
+            self.used_keys.add(key)
+            self.hits += 1
+            return data
+
+    def put(self, key, data):
+        """Store the given data (a byte string) for the given key"""
+        with self.lock:
+            self.entries[key] = data
+            self.used_keys.add(key)
+            if self.backing_cache is not None:
+                self.backing_cache.put(key, data)
+
+    def evict(self):
+        """Remove the entries not used since the previous eviction"""
+        with self.lock:
+            for key in set(self.entries) - self.used_keys:
+                del self.entries[key]
+            self.used_keys = set()
+
+            if self.backing_cache is not None:
+                self.backing_cache.evict()
@@ -14,36 +14,78 @@
     This Python code is in the public domain.
 """
 
+import collections
+import marshal
+import os
 import re
+import threading
 
 __version__ = '1.0.20070709'
 
+# Version of the compiled patterns format (see Hyphenator.compile).
+COMPILED_PATTERNS_FORMAT = 1
+
+# Maximum number of words whose pieces are remembered by hyphenate_word.
+HYPHENATION_MEMO_SIZE = 10000
+
 class Hyphenator:
-    def __init__(self, patterns, exceptions=''):
-        self.tree = {}
+    def __init__(self, patterns, exceptions='', memo_size=HYPHENATION_MEMO_SIZE):
+        # The patterns are kept in a flat dict instead of a tree: every
+        # pattern (without its points) and every prefix of a pattern is a key,
+        # whose value is the string of points of the pattern (empty for the
+        # prefixes which are not patterns). Digit strings are much faster to
+        # load than lists of numbers (see compile).
+        self.patterns = {}
         for pattern in patterns.split():
             self._insert_pattern(pattern)
     
         self.exceptions = {}
         for ex in exceptions.split():
             # Convert the hyphenated pattern into a point array for use later.
-            self.exceptions[ex.replace('-', '')] = [0] + [ int(h == '-') for h in re.split(r"[a-z]", ex) ]
+            self.exceptions[ex.replace('-', '')] = '0' + ''.join([ str(int(h == '-')) for h in re.split(r"[a-z]", ex) ])
+
+        self.memo_size = memo_size
+        self.memo = collections.OrderedDict()
+        self.memo_lock = threading.Lock()
                 
     def _insert_pattern(self, pattern):
         # Convert the a pattern like 'a1bc3d4' into a string of chars 'abcd'
-        # and a list of points [ 1, 0, 3, 4 ].
-        chars = re.sub('[0-9]', '', pattern)
-        points = [ int(d or 0) for d in re.split("[.a-z]", pattern) ]
+        # and a string of points '01034'.
+        chars = ''
+        points = ['0']
+        for c in pattern:
+            if c.isdigit():
+                points[-1] = c
+            else:
+                chars += c
+                points.append('0')
 
-        # Insert the pattern into the tree.  Each character finds a dict
-        # another level down in the tree, and leaf nodes have the list of
-        # points.
-        t = self.tree
-        for c in chars:
-            if c not in t:
-                t[c] = {}
-            t = t[c]
-        t[None] = points
+        for length in range(1, len(chars)):
+            self.patterns.setdefault(chars[:length], '')
+        self.patterns[chars] = ''.join(points)
+
+    def compile(self):
+        """ Return the patterns and exceptions as a byte string, loaded
+            much faster than the patterns are parsed (see from_compiled).
+        """
+        return marshal.dumps((COMPILED_PATTERNS_FORMAT, self.patterns, self.exceptions))
+
+    @classmethod
+    def from_compiled(cls, compiled_patterns, memo_size=HYPHENATION_MEMO_SIZE):
+        """ Return the Hyphenator of the given compiled patterns. Raise
+            ValueError if they are not valid.
+        """
+        try:
+            compiled_format, patterns, exceptions = marshal.loads(compiled_patterns)
+        except (EOFError, TypeError, ValueError):
+            raise ValueError('Invalid compiled hyphenation patterns')
+        if compiled_format != COMPILED_PATTERNS_FORMAT:
+            raise ValueError('Invalid compiled hyphenation patterns')
+
+        hyphenator = cls('', '', memo_size)
+        hyphenator.patterns = patterns
+        hyphenator.exceptions = exceptions
+        return hyphenator
         
     def hyphenate_word(self, word):
         """ Given a word, returns a list of pieces, broken at the possible
@@ -52,34 +94,82 @@ class Hyphenator:
         # Short words aren't hyphenated.
         if len(word) <= 4:
             return [word]
+
+        with self.memo_lock:
+            pieces = self.memo.pop(word, None)
+            if pieces is not None:
+                # Most recently used words are kept at the end.
+                self.memo[word] = pieces
+                return list(pieces)
+
+        pieces = self._hyphenate_word(word)
+
+        if self.memo_size > 0:
+            with self.memo_lock:
+                self.memo[word] = tuple(pieces)
+                if len(self.memo) > self.memo_size:
+                    self.memo.popitem(last=False)
+        return pieces
+
+    def _hyphenate_word(self, word):
         # If the word is an exception, get the stored points.
         if word.lower() in self.exceptions:
             points = self.exceptions[word.lower()]
         else:
             work = '.' + word.lower() + '.'
-            points = [0] * (len(work)+1)
+            points = ['0'] * (len(work)+1)
+            get_pattern_points = self.patterns.get
             for i in range(len(work)):
-                t = self.tree
-                for c in work[i:]:
-                    if c in t:
-                        t = t[c]
-                        if None in t:
-                            p = t[None]
-                            for j in range(len(p)):
-                                points[i+j] = max(points[i+j], p[j])
-                    else:
+                for j in range(i + 1, len(work) + 1):
+                    p = get_pattern_points(work[i:j])
+                    if p is None:
                         break
+                    if p:
+                        for k, d in enumerate(p, i):
+                            # Single digits compare as their numbers.
+                            if d > points[k]:
+                                points[k] = d
             # No hyphens in the first two chars or the last two.
-            points[1] = points[2] = points[-2] = points[-3] = 0
+            points[1] = points[2] = points[-2] = points[-3] = '0'
 
         # Examine the points to build the pieces list.
         pieces = ['']
         for c, p in zip(word, points[2:]):
             pieces[-1] += c
-            if p % 2:
+            if p in '13579':
                 pieces.append('')
         return pieces
 
+
+def load_hyphenator(patterns, exceptions):
+    """ Return the Hyphenator of the given patterns and exceptions. They are
+        compiled once and kept in the md2pdf cache directory, so the next
+        processes load them instead of parsing them again.
+    """
+    from file_cache import FileCache, generate_cache_key, get_cache_dirpath
+
+    key = generate_cache_key(patterns, exceptions, str(COMPILED_PATTERNS_FORMAT), str(marshal.version))
+    try:
+        cache = FileCache(os.path.join(get_cache_dirpath(), 'hyphenation'))
+        compiled_patterns = cache.get(key)
+    except (IOError, OSError):
+        cache = compiled_patterns = None
+
+    if compiled_patterns is not None:
+        try:
+            return Hyphenator.from_compiled(compiled_patterns)
+        except ValueError:
+            pass
+
+    hyphenator = Hyphenator(patterns, exceptions)
+    if cache is not None:
+        try:
+            cache.put(key, hyphenator.compile())
+        except (IOError, OSError):
+            # Read-only cache directory: the patterns are parsed every time.
+            pass
+    return hyphenator
+
 patterns = (
 # Knuth and Liang's original hyphenation patterns from classic TeX.
 # In the public domain.
@@ -507,7 +597,7 @@ presents project projects reci-procity re-cog-ni-zance ref-or-ma-tion
 ret-ri-bu-tion ta-ble
 """
 
-hyphenator = Hyphenator(patterns, exceptions)
+hyphenator = load_hyphenator(patterns, exceptions)
 hyphenate_word = hyphenator.hyphenate_word
 
 del patterns
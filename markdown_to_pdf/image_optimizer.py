@@ -0,0 +1,190 @@
+"""Optional downscaling and recompression of the images of the documents.
+
+Images with more pixels than needed for printing them at the given DPI are
+downscaled, keeping their size in the page, and recompressed. The results 
+are cached by content hash, so every image is processed only once across 
+builds. It requires Pillow (PIL).
+"""
+from __future__ import print_function
+import json
+import math
+import os
+import tempfile
+import time
+
+from file_cache import FileCache, generate_cache_key, get_cache_dirpath
+
+
+DEFAULT_IMAGE_DPI = 150
+
+# Width (in inches) of the text in the PDF pages: letter paper with 1in 
+# margins (see latex_configuration/sphinx/sphinx.sty).
+PAGE_TEXT_WIDTH = 6.5
+
+# DPI assumed by LaTeX for images without resolution information.
+LATEX_DEFAULT_IMAGE_DPI = 72
+
+OPTIMIZABLE_IMAGE_EXTENSIONS = ['.png', '.jpg', '.jpeg']
+
+# Changing the optimization algorithm invalidates the cached images.
+IMAGE_OPTIMIZER_VERSION = '1'
+
+JPEG_QUALITY = 85
+
+
+def get_pil_image_module():
+    """Return the PIL Image module or None if Pillow is not installed.
+    Imported on first use because Pillow is slow to import"""
+    if get_pil_image_module.module is None:
+        try:
+            from PIL import Image
+        except ImportError:
+            Image = False
+        get_pil_image_module.module = Image
+    return get_pil_image_module.module or None
+get_pil_image_module.module = None
+
+
+def is_image_optimization_available():
+    return get_pil_image_module() is not None
+
+
+def optimize_image(image_path, optimized_image_path, dpi):
+    """Write the given image downscaled (if it has more pixels than needed 
+    for showing it at the given DPI) and recompressed to optimized_image_path"""
+    Image = get_pil_image_module()
+    image = Image.open(image_path)
+    image_format = image.format
+    image_width, image_height = image.size
+
+    original_dpi = image.info.get('dpi', (LATEX_DEFAULT_IMAGE_DPI,))[0] or LATEX_DEFAULT_IMAGE_DPI
+    # LaTeX shows images at their natural size, but never wider than the text.
+    shown_width = min(image_width / float(original_dpi), PAGE_TEXT_WIDTH)
+    max_image_width = int(math.ceil(shown_width * dpi))
+
+    save_options = {}
+    if image_width > max_image_width:
+        scale = max_image_width / float(image_width)
+        image = image.resize(
+            (max_image_width, max(1, int(round(image_height * scale)))),
+            Image.ANTIALIAS
+        )
+        # Keep the natural size of the image in the page.
+        save_options['dpi'] = (original_dpi * scale, original_dpi * scale)
+    elif 'dpi' in image.info:
+        save_options['dpi'] = image.info['dpi']
+
+    if image_format == 'JPEG':
+        save_options['quality'] = JPEG_QUALITY
+    save_options['optimize'] = True
+
+    image.save(optimized_image_path, image_format, **save_options)
+
+
+class ImageOptimizer(object):
+    """Optimize images caching the results.
+
+    When an optimized image is not smaller than the original, an empty 
+    \"<key>.original\" entry is cached so the original image is used.
+    Every processed image is reported (as a JSON line) to report_filepath.
+    """
+    def __init__(self, cache_dirpath, dpi=DEFAULT_IMAGE_DPI, report_filepath=None):
+        self.images = FileCache(cache_dirpath)
+        self.dpi = dpi
+        self.report_filepath = report_filepath
+
+    def get_optimized_image_path(self, image_path):
+        """Return the path of the optimized version of the given image, or 
+        the given path if it can not be optimized"""
+        extension = os.path.splitext(image_path)[1].lower()
+        if extension not in OPTIMIZABLE_IMAGE_EXTENSIONS or not os.path.isfile(image_path):
+            return image_path
+
+        start_time = time.time()
+        with open(image_path, 'rb') as image_file:
+            image_data = image_file.read()
+        key = generate_cache_key(image_data, str(self.dpi), IMAGE_OPTIMIZER_VERSION) + extension
+
+        cached = True
+        if self.images.has(key):
+            optimized_image_path = self.images.get_entry_path(key)
+        elif self.images.has(key + '.original'):
+            optimized_image_path = image_path
+        else:
+            cached = False
+            optimized_image_path = self.optimize(image_path, key)
+
+        self.report(image_path, len(image_data), os.path.getsize(optimized_image_path), time.time() - start_time, cached)
+
+        return optimized_image_path
+
+    def optimize(self, image_path, key):
+        """Optimize the given image, caching the result under the given key.
+        Return the path of the image to use"""
+        temp_fd, temp_image_path = tempfile.mkstemp(suffix=os.path.splitext(key)[1])
+        os.close(temp_fd)
+        try:
+            optimize_image(image_path, temp_image_path, self.dpi)
+            with open(temp_image_path, 'rb') as temp_image_file:
+                optimized_image_data = temp_image_file.read()
+        except (IOError, ValueError):
+            optimized_image_data = None
+        finally:
+            os.remove(temp_image_path)
+
+        if optimized_image_data is not None and len(optimized_image_data) < os.path.getsize(image_path):
+            self.images.put(key, optimized_image_data)
+            return self.images.get_entry_path(key)
+
+        self.images.put(key + '.original', '')
+        return image_path
+
+    def close(self):
+        """Evict the least recently used images from the cache. Called at
+        the end of the build, once the optimized images were used"""
+        self.images.evict()
+
+    def report(self, image_path, original_size, optimized_size, seconds, cached):
+        if self.report_filepath is None:
+            return
+        with open(self.report_filepath, 'ab') as report_file:
+            report_file.write(json.dumps({
+                'image': image_path,
+                'original_size': original_size,
+                'optimized_size': optimized_size,
+                'seconds': seconds,
+                'cached': cached
+            }) + '\n')
+
+
+def get_image_optimizer():
+    """Return the ImageOptimizer configured by md2pdf through the 
+    MD2PDF_IMAGE_DPI and MD2PDF_IMAGE_REPORT environment variables, or None
+    if image optimization is disabled"""
+    if get_image_optimizer.optimizer is None and os.environ.get('MD2PDF_IMAGE_DPI') and is_image_optimization_available():
+        get_image_optimizer.optimizer = ImageOptimizer(
+            os.path.join(get_cache_dirpath(), 'images'),
+            int(os.environ['MD2PDF_IMAGE_DPI']),
+            os.environ.get('MD2PDF_IMAGE_REPORT')
+        )
+    return get_image_optimizer.optimizer
+get_image_optimizer.optimizer = None
+
+
+def read_image_optimization_report(report_filepath):
+    """Return (images, cached images, bytes saved, seconds spent) from the 
+    given report file"""
+    images = cached_images = saved_bytes = 0
+    seconds = 0.0
+    try:
+        with open(report_filepath, 'rb') as report_file:
+            for line in report_file:
+                image_report = json.loads(line)
+                images += 1
+                cached_images += int(image_report['cached'])
+                saved_bytes += image_report['original_size'] - image_report['optimized_size']
+                seconds += image_report['seconds']
+    except IOError:
+        pass
+
+    return images, cached_images, saved_bytes, seconds
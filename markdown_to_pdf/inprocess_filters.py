@@ -0,0 +1,59 @@
+"""Run the md2pdf Pandoc filters inside the running Python process.
+
+Pandoc launches every filter (--filter) as a new Python interpreter. Instead,
+md2pdf can ask Pandoc for the JSON AST, apply the filters here and feed the
+modified AST back to Pandoc.
+"""
+import json
+import threading
+
+from json_ast import filter_json_ast, get_json_ast_meta
+import pandoc_filters
+import paragraph_filters
+
+
+# Filters which can be run in-process, by the name of their executable.
+INPROCESS_FILTERS = {
+    'md2pdf_pandoc_filter': pandoc_filters.pandoc_filter,
+    'md2pdf_pandoc_paragraph_filter': paragraph_filters.pandoc_filter,
+}
+
+# The filters keep their state in module globals, so documents built in
+# different threads (see --batch) are filtered one at a time.
+INPROCESS_FILTERS_LOCK = threading.Lock()
+
+
+def apply_json_filters(json_ast, filters, format, metadata=None):
+    """Apply the given filters to the given Pandoc JSON AST (a string)
+
+    Arguments:
+    json_ast - Pandoc JSON AST
+    filters - list of filter executable names (see INPROCESS_FILTERS)
+    format - target format, passed to the filters as Pandoc does
+    metadata - fields (name: Pandoc metadata value) added to the metadata 
+    of the document while the filters run, as Pandoc does with --metadata.
+    They are not kept in the filtered AST
+    """
+    return json.dumps(apply_document_filters(json.loads(json_ast), filters, format, metadata))
+
+
+def apply_document_filters(document, filters, format, metadata=None):
+    """Apply the given filters to the given (decoded) Pandoc JSON AST and
+    return the filtered AST (see apply_json_filters)"""
+    metadata = metadata or {}
+    get_json_ast_meta(document).update(metadata)
+
+    with INPROCESS_FILTERS_LOCK:
+        pandoc_filters.reset_filter_state()
+        for filter_name in filters:
+            document = filter_json_ast(
+                document,
+                INPROCESS_FILTERS[filter_name],
+                format
+            )
+
+    for field in metadata:
+        get_json_ast_meta(document).pop(field, None)
+
+    return document
+
@@ -0,0 +1,177 @@
+"""Assembly of the Pandoc JSON AST of a document from the ASTs of its files.
+
+Every file section of the monolitic Markdown file (see generate_file_section)
+is parsed on its own, and its JSON AST is cached by content, so Pandoc only
+parses the Markdown of the files which changed. The ASTs of the sections are
+concatenated in document order, file markers included, and the md2pdf
+filters are applied to the merged AST.
+
+The sections are parsed without automatic header identifiers, which must be
+unique in the whole document: they are generated after merging the ASTs, as
+Pandoc generates them when it parses the monolitic Markdown file.
+
+Cross-file links, notes and header identifiers are then not handled by a
+single Pandoc parse of the document, so it is only used when enabled (see
+is_incremental_parsing_enabled).
+"""
+import os
+import sys
+import json
+from pandocfilters import walk
+
+
+def is_incremental_parsing_enabled():
+    """Return True if the files of the documents are parsed one by one and
+    their ASTs merged, as set with the MD2PDF_INCREMENTAL_PARSING 
+    environment variable. Otherwise Pandoc parses the monolitic Markdown 
+    file"""
+    return os.environ.get('MD2PDF_INCREMENTAL_PARSING') == '1'
+
+
+def get_json_ast_meta(json_ast):
+    """Return the metadata of the given (decoded) Pandoc JSON AST"""
+    if isinstance(json_ast, list):
+        return json_ast[0]['unMeta']
+    else:
+        return json_ast['meta']
+
+
+def get_json_ast_blocks(json_ast):
+    """Return the blocks of the given (decoded) Pandoc JSON AST"""
+    if isinstance(json_ast, list):
+        return json_ast[1]
+    else:
+        return json_ast['blocks']
+
+
+def merge_json_asts(json_asts):
+    """Return the (decoded) Pandoc JSON AST with the blocks of the given
+    ones, in order. The metadata of the first AST defining a field is kept,
+    as Pandoc does with the metadata blocks of a document"""
+    meta = {}
+    blocks = []
+    for json_ast in reversed(json_asts):
+        meta.update(get_json_ast_meta(json_ast))
+
+    for json_ast in json_asts:
+        blocks += get_json_ast_blocks(json_ast)
+
+    if len(json_asts) > 0 and isinstance(json_asts[0], list):
+        return [{'unMeta': meta}, blocks]
+
+    merged_json_ast = {'meta': meta, 'blocks': blocks}
+    if len(json_asts) > 0:
+        merged_json_ast['pandoc-api-version'] = json_asts[0]['pandoc-api-version']
+    return merged_json_ast
+
+
+def add_missing_contents(element):
+    """Give an empty content to the elements of the given (decoded) Pandoc 
+    JSON AST which have none. Pandoc omits the 'c' key of the elements 
+    without content (i.e. Space) since Pandoc 1.16, and walk and stringify 
+    of pandocfilters 1.2 fail on them. The AST is changed in place and 
+    returned"""
+    if isinstance(element, list):
+        for child in element:
+            add_missing_contents(child)
+    elif isinstance(element, dict):
+        if 't' in element and 'c' not in element:
+            element['c'] = []
+        for child in element.values():
+            add_missing_contents(child)
+    return element
+
+
+def filter_json_ast(json_ast, action, format):
+    """Apply the given pandocfilters action to the given (decoded) Pandoc
+    JSON AST, whatever the Pandoc version, and return the filtered AST"""
+    return walk(add_missing_contents(json_ast), action, format, get_json_ast_meta(json_ast))
+
+
+def run_json_filter(action):
+    """Run the given pandocfilters action as a Pandoc filter: filter the JSON
+    AST read from stdin and write it to stdout. toJSONFilter of 
+    pandocfilters 1.2 only reads the JSON AST of Pandoc before 1.18"""
+    json_ast = json.loads(sys.stdin.read())
+    format = sys.argv[1] if len(sys.argv) > 1 else ''
+    json.dump(filter_json_ast(json_ast, action, format), sys.stdout)
+
+
+def stringify_without_notes(element):
+    """Return the text of the given Pandoc JSON AST element without its
+    notes, as Pandoc gets it to generate header identifiers. Elements 
+    without content (i.e. Space) have no 'c' key since Pandoc 1.16"""
+    if isinstance(element, list):
+        return u''.join(stringify_without_notes(child) for child in element)
+    elif not isinstance(element, dict):
+        return u''
+
+    key = element.get('t')
+    if key == 'Str':
+        return element['c']
+    elif key in ('Code', 'Math'):
+        return element['c'][1]
+    elif key in ('Space', 'SoftBreak', 'LineBreak'):
+        return u' '
+    elif key in ('Note', 'RawInline'):
+        return u''
+    return stringify_without_notes(element.get('c'))
+
+
+def get_headers(element):
+    """Return the values of the headers inside the given Pandoc JSON AST
+    element, in document order"""
+    headers = []
+    if isinstance(element, list):
+        for child in element:
+            headers += get_headers(child)
+    elif isinstance(element, dict):
+        if element.get('t') == 'Header':
+            headers.append(element['c'])
+        else:
+            for child in element.values():
+                headers += get_headers(child)
+    return headers
+
+
+def generate_header_identifier(header_content):
+    """Return the identifier generated by Pandoc (auto_identifiers extension)
+    for a header with the given content (a list of inlines), before making
+    it unique. Pandoc keeps the label of the notes of the header ([^1] gives
+    "1"), which is not in the AST, so the notes are removed here. The LaTeX
+    labels of the headers are generated by the md2pdf filter anyway (see
+    header_filter)"""
+    header_text = stringify_without_notes(header_content).lower()
+    header_text = u''.join(
+        character for character in header_text
+        if character.isalnum() or character in u'_-. '
+    )
+    header_identifier = u'-'.join(header_text.split())
+
+    # Identifiers start with a letter.
+    for index, character in enumerate(header_identifier):
+        if character.isalpha():
+            return header_identifier[index:]
+    return u''
+
+
+def make_header_identifiers_unique(json_ast):
+    """Give to the headers without identifier of the given (decoded) Pandoc
+    JSON AST the unique identifier Pandoc would give them: the one generated
+    from their content, followed by the first -<number> suffix not used yet.
+    Explicit identifiers are kept"""
+    used_identifiers = set()
+
+    for header in get_headers(get_json_ast_blocks(json_ast)):
+        attributes = header[1]
+        if attributes[0] == '':
+            header_identifier = generate_header_identifier(header[2]) or u'section'
+            if header_identifier in used_identifiers:
+                suffix = 1
+                while u'%s-%d' % (header_identifier, suffix) in used_identifiers:
+                    suffix += 1
+                header_identifier = u'%s-%d' % (header_identifier, suffix)
+            attributes[0] = header_identifier
+        used_identifiers.add(attributes[0])
+
+    return json_ast
@@ -0,0 +1,104 @@
+"""Incremental compilation of LaTeX documents with xelatex.
+
+The LaTeX document is compiled in a persistent build directory, so the
+auxiliary files (.aux, .toc, .out...) of the previous build are reused.
+xelatex is run again only while those files change, so an unchanged
+document needs a single pass.
+"""
+from __future__ import print_function
+import os
+from subprocess import call
+
+from file_cache import generate_cache_key
+from links_processing import print_warning
+
+
+# Files written by xelatex which are read by the next pass.
+LATEX_AUX_EXTENSIONS = ['.aux', '.toc', '.out', '.lof', '.lot']
+
+# Maximum number of xelatex passes, in case the auxiliary files never
+# converge (i.e. a TOC entry moving to another page back and forth).
+LATEX_MAX_PASSES = 5
+
+LATEX_BUILD_JOBNAME = 'document'
+
+
+def get_latex_aux_state(build_dirpath, jobname=LATEX_BUILD_JOBNAME):
+    """Return a dictionary with the hash of every auxiliary file of the
+    given job (None for missing files)"""
+    aux_state = {}
+    for extension in LATEX_AUX_EXTENSIONS:
+        aux_filepath = os.path.join(build_dirpath, jobname + extension)
+        try:
+            with open(aux_filepath, 'rb') as aux_file:
+                aux_state[extension] = generate_cache_key(aux_file.read())
+        except IOError:
+            aux_state[extension] = None
+    return aux_state
+
+
+def remove_latex_aux_files(build_dirpath, jobname=LATEX_BUILD_JOBNAME):
+    for extension in LATEX_AUX_EXTENSIONS:
+        aux_filepath = os.path.join(build_dirpath, jobname + extension)
+        if os.path.exists(aux_filepath):
+            os.remove(aux_filepath)
+
+
+def run_xelatex(latex_filepath, build_dirpath, latex_format_filepath=None):
+    """Run a single xelatex pass over the given file, writing the results
+    into build_dirpath. If latex_format_filepath is given, the file is 
+    compiled against that precompiled format (see latex_format)"""
+    xelatex_options = ['-interaction=nonstopmode', '-halt-on-error']
+    if latex_format_filepath is not None:
+        xelatex_options.append('-fmt=' + latex_format_filepath)
+
+    with open(os.devnull, 'wb') as devnull:
+        xelatex_call_return_value = call(
+            ['xelatex'] + xelatex_options + ['-output-directory', build_dirpath, latex_filepath],
+            stdout=devnull
+        )
+
+    if xelatex_call_return_value != 0:
+        raise RuntimeError(
+            (
+                'Conversion to PDF failed - ' +\
+                'xelatex failed with code: (%d). See [%s] for details'
+            ) % (
+                xelatex_call_return_value,
+                os.path.join(
+                    build_dirpath,
+                    os.path.splitext(os.path.basename(latex_filepath))[0] + '.log'
+                )
+            )
+        )
+
+
+def compile_latex_incrementally(latex_filepath, build_dirpath, max_passes=LATEX_MAX_PASSES, latex_format_filepath=None):
+    """Compile the given LaTeX file (which must be in build_dirpath) reusing
+    the auxiliary files of previous builds, against the given precompiled
+    format if any (see run_xelatex). Return the number of xelatex passes 
+    run"""
+    jobname = os.path.splitext(os.path.basename(latex_filepath))[0]
+
+    passes = 0
+    while True:
+        aux_state = get_latex_aux_state(build_dirpath, jobname)
+        try:
+            run_xelatex(latex_filepath, build_dirpath, latex_format_filepath)
+        except RuntimeError:
+            # A failed pass may leave truncated auxiliary files, which would
+            # break the next build.
+            remove_latex_aux_files(build_dirpath, jobname)
+            raise
+        passes += 1
+
+        if get_latex_aux_state(build_dirpath, jobname) == aux_state:
+            break
+
+        if passes >= max_passes:
+            print_warning(
+                'LaTeX auxiliary files did not converge after %d passes' % passes
+            )
+            break
+
+    return passes
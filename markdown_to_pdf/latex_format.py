@@ -0,0 +1,180 @@
+"""Precompiled LaTeX formats of the static preamble of md2pdf documents.
+
+Every xelatex pass reads the preamble of the document again, loading all its
+packages. The preamble generated from template.tex up to the
+\\csname endofdump\\endcsname marker is the same for most documents, so it
+is dumped once to a format (.fmt) with mylatexformat, which is stored in the
+cache directory, and the documents are compiled against it: xelatex loads
+the format and skips the preamble up to the marker. Without a format the
+marker does nothing, so the same LaTeX file compiles either way.
+
+XeTeX can not dump the fonts and font mappings set up with fontspec, so the
+template loads the packages which do not depend on the fonts (listings,
+longtable, graphicx...) before the marker, and only the font setup and the
+packages depending on it (microtype, hyperref and the Sphinx styles) after
+it. Formats are stored by the content of
+the static preamble and the xelatex version, together with the files read
+to dump them (see xelatex -recorder): a format is dumped again if any of
+those files changes (i.e. a package was updated).
+"""
+from __future__ import print_function
+import json
+import os
+import shutil
+import tempfile
+from subprocess import call
+
+from file_cache import get_cache_dirpath, make_dirs, file_lock, generate_cache_key
+from check_requirements import get_tool_version
+from links_processing import print_warning
+
+
+# Command ending the static preamble (see mylatexformat). It is undefined,
+# so \relax, when the document is not compiled against a format.
+LATEX_FORMAT_MARKER = '\\csname endofdump\\endcsname'
+
+LATEX_FORMATS_DIRNAME = 'latex_formats'
+
+
+def is_latex_format_enabled():
+    """Return True if the documents are compiled against a precompiled
+    format, as set with the MD2PDF_LATEX_FORMAT environment variable"""
+    return os.environ.get('MD2PDF_LATEX_FORMAT') == '1'
+
+
+def get_static_preamble(latex_content):
+    """Return the static preamble of the given LaTeX document (up to the
+    format marker) or None if it has no marker in its preamble"""
+    marker_index = latex_content.find(LATEX_FORMAT_MARKER)
+    if marker_index < 0:
+        return None
+
+    begin_index = latex_content.find('\\begin{document}')
+    if begin_index >= 0 and begin_index < marker_index:
+        return None
+
+    return latex_content[:marker_index]
+
+
+def read_recorded_inputs(recorder_filepath, excluded_filepaths=()):
+    """Return the files read by xelatex, as listed in the given recorder
+    file (.fls), with their modification time and size"""
+    excluded_filepaths = set(os.path.realpath(filepath) for filepath in excluded_filepaths)
+    inputs = {}
+    working_dirpath = ''
+    with open(recorder_filepath, 'rb') as recorder_file:
+        for line in recorder_file:
+            command, _, filepath = line.rstrip('\r\n').partition(' ')
+            if command == 'PWD':
+                working_dirpath = filepath
+            elif command == 'INPUT':
+                filepath = os.path.realpath(os.path.join(working_dirpath, filepath))
+                if filepath in excluded_filepaths or filepath in inputs:
+                    continue
+                try:
+                    file_stat = os.stat(filepath)
+                except OSError:
+                    continue
+                inputs[filepath] = [file_stat.st_mtime, file_stat.st_size]
+    return inputs
+
+
+def is_latex_format_record_valid(record):
+    """Return True if none of the files read to dump the format of the
+    given record (see dump_latex_format) changed"""
+    for filepath, (mtime, size) in record['inputs'].items():
+        try:
+            file_stat = os.stat(filepath)
+        except OSError:
+            return False
+        if file_stat.st_mtime != mtime or file_stat.st_size != size:
+            return False
+    return True
+
+
+def dump_latex_format(latex_filepath, formats_dirpath, format_name):
+    """Dump the static preamble of the given LaTeX file to the format
+    <format_name>.fmt in formats_dirpath, and save its record
+    (<format_name>.json): whether the format was dumped and the files read
+    to dump it. Return True if the format was dumped"""
+    dump_dirpath = tempfile.mkdtemp(dir=formats_dirpath, prefix='.tmp-')
+    try:
+        with open(os.devnull, 'wb') as devnull:
+            xelatex_call_return_value = call(
+                [
+                    'xelatex', '-ini', '-interaction=nonstopmode', '-halt-on-error',
+                    '-recorder', '-jobname=' + format_name, '-output-directory', dump_dirpath,
+                    '&xelatex', 'mylatexformat.ltx', os.path.abspath(latex_filepath)
+                ],
+                stdout=devnull
+            )
+
+        dumped = xelatex_call_return_value == 0 and \
+            os.path.exists(os.path.join(dump_dirpath, format_name + '.fmt'))
+        try:
+            inputs = read_recorded_inputs(
+                os.path.join(dump_dirpath, format_name + '.fls'),
+                [latex_filepath]
+            )
+        except IOError:
+            inputs = {}
+
+        if dumped:
+            os.rename(
+                os.path.join(dump_dirpath, format_name + '.fmt'),
+                os.path.join(formats_dirpath, format_name + '.fmt')
+            )
+        else:
+            # Kept to find out why the format could not be dumped.
+            dump_log_filepath = os.path.join(dump_dirpath, format_name + '.log')
+            if os.path.exists(dump_log_filepath):
+                os.rename(dump_log_filepath, os.path.join(formats_dirpath, format_name + '.log'))
+
+        record_filepath = os.path.join(formats_dirpath, format_name + '.json')
+        with open(os.path.join(dump_dirpath, 'record.json'), 'wb') as record_file:
+            json.dump({'dumped': dumped, 'inputs': inputs}, record_file)
+        os.rename(os.path.join(dump_dirpath, 'record.json'), record_filepath)
+    finally:
+        shutil.rmtree(dump_dirpath, ignore_errors=True)
+
+    return dumped
+
+
+def get_latex_format(latex_filepath):
+    """Return the filepath (without extension) of the precompiled format of
+    the static preamble of the given LaTeX file, dumping it if it does not
+    exist or it is stale. Return None if the file has no static preamble or
+    its format can not be dumped"""
+    with open(latex_filepath, 'rb') as latex_file:
+        static_preamble = get_static_preamble(latex_file.read())
+    if static_preamble is None:
+        return None
+
+    formats_dirpath = os.path.join(get_cache_dirpath(), LATEX_FORMATS_DIRNAME)
+    make_dirs(formats_dirpath)
+    format_name = generate_cache_key(static_preamble, get_tool_version('xelatex') or '')
+    format_filepath = os.path.join(formats_dirpath, format_name)
+
+    # Builds sharing the cache wait for the format being dumped.
+    with file_lock(formats_dirpath + '.lock'):
+        try:
+            with open(format_filepath + '.json', 'rb') as record_file:
+                record = json.load(record_file)
+        except (IOError, ValueError):
+            record = None
+
+        if record is None or not is_latex_format_record_valid(record):
+            print('Precompiling LaTeX preamble...')
+            dumped = dump_latex_format(latex_filepath, formats_dirpath, format_name)
+            if not dumped:
+                print_warning(
+                    'LaTeX preamble could not be precompiled - See [%s] for details' %
+                    (format_filepath + '.log')
+                )
+            print('Precompiling LaTeX preamble...%s' % ('OK' if dumped else 'FAILED'))
+        else:
+            dumped = record['dumped']
+
+    if not dumped or not os.path.exists(format_filepath + '.fmt'):
+        return None
+    return format_filepath
@@ -0,0 +1,205 @@
+"""Cache of the LaTeX fragments of the files of a md2pdf document.
+
+Pandoc converts the whole document to LaTeX on every build, although most of
+its files did not change. Instead, the (already filtered) Pandoc JSON AST of
+the document is split at the file markers (see generate_file_section) and
+every file is converted to a LaTeX fragment, which is cached by content. The
+LaTeX document is then assembled from template.tex and the fragments, so
+Pandoc only converts the files which changed.
+
+The md2pdf filter is applied to the whole AST before splitting it, so the
+labels of the headers are unique in the whole document, as in a full
+conversion, and the sections are numbered by LaTeX itself. The template
+variables which depend on the content (i.e. "tables" if there are tables)
+are printed by the fragment template in the first line of every fragment
+and set for the whole document.
+"""
+from __future__ import print_function
+import os
+import json
+from subprocess import Popen, PIPE
+from multiprocessing.pool import ThreadPool
+
+from pandocfilters import RawBlock
+
+from file_cache import generate_cache_key
+from check_requirements import get_pandoc_version
+from json_ast import get_json_ast_blocks, stringify_without_notes
+from anchor_index import FILE_MARKER_REGEX
+from version import __version__
+
+
+LATEX_FRAGMENT_TEMPLATE_FILEPATH = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)),
+    'latex_configuration',
+    'fragment_template.tex'
+)
+
+# First line of the fragments, followed by the template variables set by
+# Pandoc (see fragment_template.tex).
+LATEX_FRAGMENT_HEADER = '%md2pdf-fragment:'
+
+# Body of the document rendered with template.tex, replaced by the fragments.
+LATEX_BODY_PLACEHOLDER = '%md2pdf-body'
+
+
+def is_a_file_marker_block(block):
+    """Return True if the given block of a Pandoc JSON AST is a file marker
+    (see generate_file_section)"""
+    if block['t'] not in ('Para', 'Plain'):
+        return False
+
+    inlines = block['c']
+    if len(inlines) == 1 and inlines[0]['t'] == 'RawInline':
+        return FILE_MARKER_REGEX.match(inlines[0]['c'][1]) is not None
+
+    # Newer Pandoc versions parse the marker as text.
+    return len(inlines) > 0 and inlines[0]['t'] == 'Str' and \
+        FILE_MARKER_REGEX.match(stringify_without_notes(inlines)) is not None
+
+
+def replace_json_ast_blocks(json_ast, blocks):
+    """Return a copy of the given (decoded) Pandoc JSON AST with the given
+    blocks"""
+    if isinstance(json_ast, list):
+        return [json_ast[0], blocks]
+
+    json_ast = dict(json_ast)
+    json_ast['blocks'] = blocks
+    return json_ast
+
+
+def split_json_ast(json_ast):
+    """Return the (decoded) Pandoc JSON ASTs of the files of the given
+    document AST: its blocks split before every file marker. The metadata is
+    kept in every AST"""
+    files_blocks = [[]]
+    for block in get_json_ast_blocks(json_ast):
+        if is_a_file_marker_block(block) and len(files_blocks[-1]) > 0:
+            files_blocks.append([])
+        files_blocks[-1].append(block)
+
+    return [replace_json_ast_blocks(json_ast, file_blocks) for file_blocks in files_blocks]
+
+
+def run_pandoc(pandoc_options, pandoc_input):
+    """Run Pandoc with the given options over the given input and return
+    its output"""
+    pandoc_process = Popen(["pandoc"] + pandoc_options, stdin=PIPE, stdout=PIPE)
+    pandoc_output = pandoc_process.communicate(pandoc_input)[0]
+
+    if pandoc_process.returncode != 0:
+        raise RuntimeError(
+            (
+                'Conversion to LaTeX failed - ' +\
+                'Pandoc failed with code: (%d)'
+            ) % pandoc_process.returncode
+        )
+
+    return pandoc_output
+
+
+def get_fragment_pandoc_options(pandoc_options):
+    """Return the Pandoc options converting a file of a document converted
+    with the given options (see generate_latex_document) to a fragment"""
+    return pandoc_options + [
+        "--to", "latex", "--standalone", "--template", LATEX_FRAGMENT_TEMPLATE_FILEPATH
+    ]
+
+
+def get_latex_fragments_cache_key(pandoc_options):
+    """Return the part of the key of the fragments in the cache which does
+    not depend on their content: the templates, the Pandoc options and the
+    versions of md2pdf (and its filters) and Pandoc"""
+    template_contents = []
+    for template_filepath in [LATEX_FRAGMENT_TEMPLATE_FILEPATH, pandoc_options[pandoc_options.index("--template") + 1]]:
+        with open(template_filepath, 'rb') as template_file:
+            template_contents.append(template_file.read())
+
+    return generate_cache_key(
+        '\0'.join(pandoc_options), __version__, get_pandoc_version(), *template_contents
+    )
+
+
+def parse_latex_fragment(fragment):
+    """Return the template variables and the LaTeX body of the given
+    fragment (see fragment_template.tex)"""
+    header, _, body = fragment.partition('\n')
+    if not header.startswith(LATEX_FRAGMENT_HEADER):
+        raise RuntimeError('Invalid LaTeX fragment: "%s"' % header)
+
+    return header[len(LATEX_FRAGMENT_HEADER):].split(), body.rstrip('\n')
+
+
+def build_latex_fragments(json_ast, pandoc_options, jobs=1, cache=None):
+    """Return the LaTeX fragments (see parse_latex_fragment) of the files of
+    the given (decoded and filtered) Pandoc JSON AST.
+
+    Arguments:
+    json_ast - Pandoc JSON AST of the document
+    pandoc_options - Pandoc options converting the document to LaTeX
+    jobs - number of Pandoc conversions run at the same time
+    cache - FileCache where the fragments are stored. Only the files whose
+    fragment is not in the cache are converted by Pandoc.
+    """
+    print('Converting files to LaTeX...')
+
+    fragment_pandoc_options = get_fragment_pandoc_options(pandoc_options)
+    files_json = [json.dumps(file_json_ast) for file_json_ast in split_json_ast(json_ast)]
+
+    fragments = [None] * len(files_json)
+    if cache is not None:
+        options_cache_key = get_latex_fragments_cache_key(fragment_pandoc_options)
+        cache_keys = [generate_cache_key(file_json, options_cache_key) for file_json in files_json]
+        for index, cache_key in enumerate(cache_keys):
+            fragments[index] = cache.get(cache_key)
+
+    pending_indexes = [index for index, fragment in enumerate(fragments) if fragment is None]
+
+    def convert_file(index):
+        return run_pandoc(fragment_pandoc_options, files_json[index])
+
+    # Pandoc runs in its own process, so threads are enough.
+    if jobs > 1 and len(pending_indexes) > 1:
+        pool = ThreadPool(min(jobs, len(pending_indexes)))
+        try:
+            converted_fragments = pool.map(convert_file, pending_indexes)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        converted_fragments = map(convert_file, pending_indexes)
+
+    for index, fragment in zip(pending_indexes, converted_fragments):
+        fragments[index] = fragment
+        if cache is not None:
+            cache.put(cache_keys[index], fragment)
+
+    print('Converting files to LaTeX...OK (%d cached)' % (len(files_json) - len(pending_indexes)))
+
+    return [parse_latex_fragment(fragment) for fragment in fragments]
+
+
+def generate_latex_document(latex_filepath, json_ast, pandoc_options, jobs=1, cache=None):
+    """Write to the given file the LaTeX document Pandoc generates from the
+    given (decoded and filtered) Pandoc JSON AST with the given options,
+    assembled from the fragments of its files (see build_latex_fragments)"""
+    fragments = build_latex_fragments(json_ast, pandoc_options, jobs, cache)
+
+    template_variables = set()
+    for fragment_variables, fragment_body in fragments:
+        template_variables.update(fragment_variables)
+
+    document_pandoc_options = list(pandoc_options)
+    for template_variable in sorted(template_variables):
+        document_pandoc_options += ["-V", template_variable]
+
+    # Only the metadata of the document is converted here.
+    latex_document = run_pandoc(
+        document_pandoc_options + ["--to", "latex", "--standalone"],
+        json.dumps(replace_json_ast_blocks(json_ast, [RawBlock('latex', LATEX_BODY_PLACEHOLDER)]))
+    )
+    latex_body = '\n\n'.join(fragment_body for fragment_variables, fragment_body in fragments if fragment_body != '')
+
+    with open(latex_filepath, 'wb') as latex_file:
+        latex_file.write(latex_document.replace(LATEX_BODY_PLACEHOLDER, latex_body, 1))
@@ -0,0 +1,399 @@
+"""Parallel compilation of LaTeX documents split in shards.
+
+Every file of a md2pdf document starts on a new page (see
+generate_file_section), so the LaTeX document is split at those boundaries
+in shards (groups of consecutive files) which are compiled in parallel,
+every one with its own xelatex process. Shards are compiled again until
+their auxiliary files converge, exactly as xelatex passes of the whole
+document:
+
+- every shard starts with the counters (page, section, figure...) at the
+  values in which the previous shard ended.
+- every shard reads the labels of all the shards, so cross-file links are
+  resolved, and the first shard (title and TOC) reads the TOC entries of
+  all of them.
+
+The auxiliary files of the shards are then merged into the auxiliary files
+of the whole document, so a single xelatex pass over the whole document
+produces the PDF with the global TOC, page numbers and links (see
+compile_latex_with_merged_aux_files). Only that pass is not parallel.
+"""
+from __future__ import print_function
+import json
+import os
+import re
+from multiprocessing.pool import ThreadPool
+
+from file_cache import generate_cache_key
+from latex_build import *
+from links_processing import print_warning
+
+
+# Counters kept between consecutive shards.
+LATEX_SHARD_COUNTERS = [
+    'page', 'part', 'chapter', 'section', 'subsection', 'subsubsection',
+    'paragraph', 'subparagraph', 'figure', 'table', 'footnote', 'equation',
+    'lstlisting'
+]
+
+# Every file section starts with a \newpage followed by its \anchor.
+LATEX_SECTION_BOUNDARY_REGEX = re.compile(
+    r'^\\newpage[ \t]*\n(?:[ \t]*\n)*\\anchor\{[^}\n]*\}',
+    re.MULTILINE
+)
+
+# Written by the shards to their .aux files: counter name, value at the end
+# of the shard, and 1 if the counter was reset inside the shard (i.e. the
+# subsection counter after a new section).
+LATEX_SHARD_COUNTER_REGEX = re.compile(r'^\\mdtopdfcounter\{([^}]*)\}\{(-?\d+)\}\{([01])\}$')
+
+LATEX_ABSPAGE_REGEX = re.compile(r'^\\gdef \\@abspage@last\{(\d+)\}$')
+
+LATEX_BOOKMARK_REGEX = re.compile(r'^(\\BOOKMARK .*% )\d+$')
+
+# Inserted before \begin{document} in every shard.
+LATEX_SHARD_SETUP = r"""
+\makeatletter
+\providecommand\mdtopdfcounter[3]{}
+\let\mdtopdf@stpelt\@stpelt
+\def\@stpelt#1{\global\expandafter\let\csname mdtopdf@reset@#1\endcsname\@empty\mdtopdf@stpelt{#1}}
+\AtEndDocument{\clearpage\@for\mdtopdf@counter:=%s\do{\@ifundefined{c@\mdtopdf@counter}{}{\immediate\write\@auxout{\string\mdtopdfcounter{\mdtopdf@counter}{\the\value{\mdtopdf@counter}}{\@ifundefined{mdtopdf@reset@\mdtopdf@counter}{0}{1}}}}}}
+\makeatother
+""" % ','.join(LATEX_SHARD_COUNTERS)
+
+LATEX_SHARDS_DIRNAME = 'shards'
+
+
+def split_latex_document(latex_content):
+    """Split the given LaTeX document in (preamble, front matter, file
+    sections, end), or return None if it has no file sections. The front
+    matter is the content between \\begin{document} and the first file
+    section"""
+    begin_index = latex_content.find('\\begin{document}')
+    end_index = latex_content.rfind('\\end{document}')
+    if begin_index < 0 or end_index < begin_index:
+        return None
+
+    boundaries = [
+        match.start() for match in
+        LATEX_SECTION_BOUNDARY_REGEX.finditer(latex_content, begin_index, end_index)
+    ]
+    if len(boundaries) == 0:
+        return None
+
+    return (
+        latex_content[:begin_index],
+        latex_content[begin_index + len('\\begin{document}'):boundaries[0]],
+        [
+            latex_content[start:end] for start, end in
+            zip(boundaries, boundaries[1:] + [end_index])
+        ],
+        latex_content[end_index:]
+    )
+
+
+def group_latex_sections(sections, shards):
+    """Group consecutive sections in (at most) the given number of shards of
+    similar size"""
+    groups = []
+    group = []
+    group_size = 0
+    remaining_size = sum(len(section) for section in sections)
+
+    for index, section in enumerate(sections):
+        group.append(section)
+        group_size += len(section)
+
+        remaining_shards = shards - len(groups)
+        remaining_sections = len(sections) - index - 1
+        if remaining_shards > 1 and remaining_sections > 0 and (
+            group_size * remaining_shards >= remaining_size or
+            remaining_sections < remaining_shards
+        ):
+            groups.append(''.join(group))
+            remaining_size -= group_size
+            group = []
+            group_size = 0
+
+    groups.append(''.join(group))
+    return groups
+
+
+def get_shard_jobname(index):
+    return 'shard%d' % index
+
+
+def generate_latex_shard(preamble, body, start_counters):
+    """Generate a LaTeX document with the given preamble and body, starting
+    with the given counter values"""
+    return (
+        preamble + LATEX_SHARD_SETUP + '\\begin{document}\n' +
+        ''.join(
+            '\\setcounter{%s}{%d}\n' % (name, value)
+            for name, value in sorted(start_counters.items())
+        ) +
+        body + '\n\\end{document}\n'
+    )
+
+
+def read_latex_aux_files(dirpath, jobname):
+    """Return a dictionary with the content of every existing auxiliary
+    file of the given job"""
+    aux_contents = {}
+    for extension in LATEX_AUX_EXTENSIONS:
+        aux_filepath = os.path.join(dirpath, jobname + extension)
+        if os.path.isfile(aux_filepath):
+            with open(aux_filepath, 'rb') as aux_file:
+                aux_contents[extension] = aux_file.read()
+    return aux_contents
+
+
+def write_latex_aux_files(dirpath, jobname, aux_contents):
+    remove_latex_aux_files(dirpath, jobname)
+    for extension, aux_content in aux_contents.items():
+        with open(os.path.join(dirpath, jobname + extension), 'wb') as aux_file:
+            aux_file.write(aux_content)
+
+
+def read_shard_counters(aux_content):
+    """Return a dictionary with the (value, reset) pairs written by a shard
+    to its .aux file"""
+    counters = {}
+    for line in aux_content.splitlines():
+        match = LATEX_SHARD_COUNTER_REGEX.match(line)
+        if match is not None:
+            counters[match.group(1)] = (int(match.group(2)), match.group(3) == '1')
+    return counters
+
+
+def get_shards_start_counters(used_start_counters, end_counters):
+    """Return the counter values every shard should start with, given the
+    values each shard started with in the last compilation and the values
+    it ended with (see read_shard_counters)"""
+    start_counters = [{}]
+    for index in range(len(end_counters) - 1):
+        counters = {}
+        for name, (value, reset) in end_counters[index].items():
+            if reset or name not in start_counters[index]:
+                counters[name] = value
+            else:
+                # Counters not set by md2pdf start with the LaTeX defaults.
+                used_value = used_start_counters[index].get(name, 1 if name == 'page' else 0)
+                counters[name] = start_counters[index][name] + value - used_value
+        start_counters.append(counters)
+    return start_counters
+
+
+def merge_latex_aux_files(shard_aux_contents):
+    """Merge the auxiliary files of the shards into the ones of the whole
+    document"""
+    merged_aux_contents = {}
+    for extension in LATEX_AUX_EXTENSIONS:
+        shard_lines = [
+            aux_contents[extension].splitlines() for aux_contents in shard_aux_contents
+            if extension in aux_contents
+        ]
+        if len(shard_lines) == 0:
+            continue
+
+        if extension == '.aux':
+            merged_lines = merge_latex_aux_lines(shard_lines)
+        elif extension == '.out':
+            # Bookmarks are numbered in a comment.
+            merged_lines = []
+            for line in sum(shard_lines, []):
+                merged_lines.append(LATEX_BOOKMARK_REGEX.sub(
+                    lambda match: match.group(1) + str(len(merged_lines) + 1), line
+                ))
+        else:
+            merged_lines = sum(shard_lines, [])
+
+        merged_aux_contents[extension] = ''.join(line + '\n' for line in merged_lines)
+
+    return merged_aux_contents
+
+
+def merge_latex_aux_lines(shard_lines):
+    """Merge the lines of the .aux files of the shards. The lines written by
+    the preamble are common to all the shards, so they are kept once"""
+    abspages = None
+    for index, lines in enumerate(shard_lines):
+        filtered_lines = []
+        for line in lines:
+            abspage_match = LATEX_ABSPAGE_REGEX.match(line)
+            if abspage_match is not None:
+                abspages = (abspages or 0) + int(abspage_match.group(1))
+            elif LATEX_SHARD_COUNTER_REGEX.match(line) is None:
+                filtered_lines.append(line)
+        shard_lines[index] = filtered_lines
+
+    header_length = 0
+    while all(
+        header_length < len(lines) and lines[header_length] == shard_lines[0][header_length]
+        for lines in shard_lines
+    ):
+        header_length += 1
+
+    merged_lines = shard_lines[0][:header_length]
+    for lines in shard_lines:
+        merged_lines += lines[header_length:]
+
+    if abspages is not None:
+        merged_lines.append('\\gdef \\@abspage@last{%d}' % abspages)
+
+    return merged_lines
+
+
+def run_xelatex_job(job):
+    """Run run_xelatex with the given (latex_filepath, build_dirpath,
+    latex_format_filepath) arguments, as passed by Pool.map"""
+    latex_filepath, build_dirpath, latex_format_filepath = job
+    run_xelatex(latex_filepath, build_dirpath, latex_format_filepath)
+
+
+def compile_latex_shards(latex_filepath, build_dirpath, shards, max_rounds=LATEX_MAX_PASSES, latex_format_filepath=None):
+    """Compile the given LaTeX document (which must be in build_dirpath) in
+    (at most) the given number of parallel shards, until their auxiliary
+    files converge. The merged auxiliary files are written to build_dirpath.
+    The shards share the preamble of the document, so they are compiled
+    against its precompiled format if given (see latex_format).
+    Return the number of rounds of parallel compilations (0 if the
+    document could not be split) and whether the auxiliary files converged"""
+    with open(latex_filepath, 'rb') as latex_file:
+        document = split_latex_document(latex_file.read())
+    if document is None:
+        return 0, False
+
+    preamble, front, sections, end = document
+    bodies = [front] + group_latex_sections(sections, shards)
+
+    jobname = os.path.splitext(os.path.basename(latex_filepath))[0]
+    shards_dirpath = os.path.join(build_dirpath, LATEX_SHARDS_DIRNAME)
+
+    # Start with the results of the previous build.
+    aux_contents = read_latex_aux_files(build_dirpath, jobname)
+    start_counters = load_shards_start_counters(shards_dirpath, len(bodies))
+
+    pool = ThreadPool(len(bodies))
+    try:
+        for rounds in range(1, max_rounds + 1):
+            jobs = []
+            for index, body in enumerate(bodies):
+                shard_latex_filepath = os.path.join(shards_dirpath, get_shard_jobname(index) + '.tex')
+                with open(shard_latex_filepath, 'wb') as shard_latex_file:
+                    shard_latex_file.write(generate_latex_shard(preamble, body, start_counters[index]))
+                write_latex_aux_files(shards_dirpath, get_shard_jobname(index), aux_contents)
+                jobs.append((shard_latex_filepath, shards_dirpath, latex_format_filepath))
+
+            pool.map(run_xelatex_job, jobs)
+
+            shard_aux_contents = [
+                read_latex_aux_files(shards_dirpath, get_shard_jobname(index))
+                for index in range(len(bodies))
+            ]
+            new_start_counters = get_shards_start_counters(
+                start_counters,
+                [read_shard_counters(shard_aux.get('.aux', '')) for shard_aux in shard_aux_contents]
+            )
+            new_aux_contents = merge_latex_aux_files(shard_aux_contents)
+
+            converged = (new_start_counters == start_counters and new_aux_contents == aux_contents)
+            start_counters = new_start_counters
+            aux_contents = new_aux_contents
+            if converged:
+                break
+    finally:
+        pool.close()
+        pool.join()
+
+    write_latex_aux_files(build_dirpath, jobname, aux_contents)
+    save_shards_start_counters(shards_dirpath, start_counters)
+
+    return rounds, converged
+
+
+def load_shards_start_counters(shards_dirpath, shards):
+    try:
+        with open(os.path.join(shards_dirpath, 'counters.json'), 'rb') as counters_file:
+            start_counters = json.load(counters_file)
+    except (IOError, ValueError):
+        start_counters = []
+
+    if len(start_counters) != shards:
+        return [{}] * shards
+    return [
+        dict((str(name), value) for name, value in counters.items())
+        for counters in start_counters
+    ]
+
+
+def save_shards_start_counters(shards_dirpath, start_counters):
+    with open(os.path.join(shards_dirpath, 'counters.json'), 'wb') as counters_file:
+        json.dump(start_counters, counters_file)
+
+
+def compile_latex_with_merged_aux_files(latex_filepath, build_dirpath, latex_format_filepath=None):
+    """Run a single xelatex pass over the given document, which reads the
+    auxiliary files merged from its shards (see compile_latex_shards). If
+    the pass changes them (the shards were not laid out as the whole
+    document), it is compiled again until they converge. Return the number
+    of xelatex passes"""
+    jobname = os.path.splitext(os.path.basename(latex_filepath))[0]
+
+    aux_state = get_latex_aux_state(build_dirpath, jobname)
+    try:
+        run_xelatex(latex_filepath, build_dirpath, latex_format_filepath)
+    except RuntimeError:
+        # A failed pass may leave truncated auxiliary files, which would
+        # break the next build.
+        remove_latex_aux_files(build_dirpath, jobname)
+        raise
+
+    if get_latex_aux_state(build_dirpath, jobname) == aux_state:
+        return 1
+
+    print_warning('LaTeX auxiliary files of the shards differ from the ones of the whole document')
+    return 1 + compile_latex_incrementally(latex_filepath, build_dirpath, latex_format_filepath=latex_format_filepath)
+
+
+def compile_latex_in_shards(latex_filepath, build_dirpath, shards, latex_format_filepath=None):
+    """Compile the given LaTeX document (which must be in build_dirpath)
+    computing its auxiliary files in parallel shards (see
+    compile_latex_shards), against the given precompiled format if any.
+    Once the shards converge, the whole document is compiled in a single
+    pass. Shards are skipped if the document did not change since the last
+    build. Return the number of rounds of parallel compilations and the number of
+    xelatex passes over the whole document"""
+    with open(latex_filepath, 'rb') as latex_file:
+        latex_hash = generate_cache_key(latex_file.read())
+
+    shards_dirpath = os.path.join(build_dirpath, LATEX_SHARDS_DIRNAME)
+    if not os.path.exists(shards_dirpath):
+        os.makedirs(shards_dirpath)
+    latex_hash_filepath = os.path.join(shards_dirpath, 'document.sha256')
+    try:
+        with open(latex_hash_filepath, 'rb') as latex_hash_file:
+            previous_latex_hash = latex_hash_file.read()
+        os.remove(latex_hash_filepath)
+    except (IOError, OSError):
+        previous_latex_hash = None
+
+    rounds = 0
+    converged = False
+    if latex_hash != previous_latex_hash:
+        try:
+            rounds, converged = compile_latex_shards(latex_filepath, build_dirpath, shards, latex_format_filepath=latex_format_filepath)
+        except (RuntimeError, EnvironmentError) as error:
+            # The whole document is compiled anyway, which reports its errors.
+            print_warning('Parallel compilation failed, compiling the whole document - %s' % error)
+            remove_latex_aux_files(build_dirpath, os.path.splitext(os.path.basename(latex_filepath))[0])
+
+    if converged:
+        passes = compile_latex_with_merged_aux_files(latex_filepath, build_dirpath, latex_format_filepath)
+    else:
+        passes = compile_latex_incrementally(latex_filepath, build_dirpath, latex_format_filepath=latex_format_filepath)
+
+    with open(latex_hash_filepath, 'wb') as latex_hash_file:
+        latex_hash_file.write(latex_hash)
+
+    return rounds, passes
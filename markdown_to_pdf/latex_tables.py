@@ -0,0 +1,234 @@
+"""Rendering of Pandoc tables as LaTeX longtables (--table-backend=latex).
+
+With the grid table backend, every GitHub table is converted to a padded
+grid table (see convert_md_tables) which Pandoc parses to get the column
+widths. With the LaTeX backend, tables are kept as pipe tables, and the
+md2pdf Pandoc filter renders them as longtable environments, with column
+widths proportional to the visible text of the columns.
+
+The text of the cells is hyphenated here with add_breakable_char, as the
+grid table backend does in the Markdown content.
+
+Only tables with simple cells (text, code, links, emphasis...) are rendered;
+Pandoc renders the others as usual.
+"""
+import re
+from pandocfilters import stringify
+from convert_md_tables import add_breakable_char
+
+
+# Fraction of the column width used by the table (the rest is used by the
+# space between columns).
+TABLE_WIDTH = 0.97
+
+# Visible length of a column above which it is considered as long as any
+# other long column, so a single long cell does not squeeze the rest.
+TABLE_COLUMN_MAX_LENGTH = 60
+
+# Minimum visible length given to a column (i.e. for empty columns).
+TABLE_COLUMN_MIN_LENGTH = 4
+
+LATEX_SPECIAL_CHARACTERS = {
+    '\\': '\\textbackslash{}',
+    '{': '\\{',
+    '}': '\\}',
+    '$': '\\$',
+    '%': '\\%',
+    '&': '\\&',
+    '#': '\\#',
+    '_': '\\_',
+    '^': '\\^{}',
+    '~': '\\textasciitilde{}',
+    '[': '{[}',
+    ']': '{]}',
+    '<': '\\textless{}',
+    '>': '\\textgreater{}',
+    '|': '\\textbar{}',
+}
+LATEX_SPECIAL_CHARACTERS_REGEX = re.compile(
+    '[' + re.escape(''.join(LATEX_SPECIAL_CHARACTERS.keys())) + ']'
+)
+
+BREAKABLE_CHAR = '\\BreakableChar{}'
+
+LATEX_ALIGNMENTS = {
+    'AlignDefault': '\\raggedright',
+    'AlignLeft': '\\raggedright',
+    'AlignRight': '\\raggedleft',
+    'AlignCenter': '\\centering',
+}
+
+# Inline elements rendered as the LaTeX command applied to their content.
+LATEX_INLINE_COMMANDS = {
+    'Emph': '\\emph',
+    'Strong': '\\textbf',
+    'Superscript': '\\textsuperscript',
+    'Subscript': '\\textsubscript',
+    'SmallCaps': '\\textsc',
+}
+
+
+class UnsupportedTable(Exception):
+    """Raised for tables which can not be rendered as longtables"""
+
+
+def escape_latex(text):
+    return LATEX_SPECIAL_CHARACTERS_REGEX.sub(
+        lambda match: LATEX_SPECIAL_CHARACTERS[match.group()],
+        text
+    )
+
+
+def escape_breakable_latex(text):
+    """Return the given text escaped for LaTeX, with breakable characters
+    (see add_breakable_char)"""
+    return BREAKABLE_CHAR.join(
+        escape_latex(piece) for piece in add_breakable_char(text).split(BREAKABLE_CHAR)
+    )
+
+
+def inlines_to_latex(inlines):
+    """Return the LaTeX of the given Pandoc inline elements"""
+    return ''.join(inline_to_latex(inline) for inline in inlines)
+
+
+def inline_to_latex(inline):
+    key = inline['t']
+    value = inline.get('c')
+
+    if key == 'Str':
+        return escape_breakable_latex(value)
+    elif key in ('Space', 'SoftBreak'):
+        return ' '
+    elif key == 'LineBreak':
+        return '\\newline{}'
+    elif key == 'Code':
+        return '\\texttt{%s}' % escape_latex(value[1])
+    elif key in LATEX_INLINE_COMMANDS:
+        return '%s{%s}' % (LATEX_INLINE_COMMANDS[key], inlines_to_latex(value))
+    elif key == 'Strikeout':
+        return inlines_to_latex(value)
+    elif key == 'Span':
+        return inlines_to_latex(value[1])
+    elif key == 'Quoted':
+        if value[0]['t'] == 'SingleQuote':
+            return '`%s\'' % inlines_to_latex(value[1])
+        return '``%s\'\'' % inlines_to_latex(value[1])
+    elif key == 'Math':
+        if value[0]['t'] == 'DisplayMath':
+            return '\\[%s\\]' % value[1]
+        return '$%s$' % value[1]
+    elif key == 'RawInline':
+        if value[0] in ('tex', 'latex'):
+            return value[1]
+        return ''
+    elif key == 'Link':
+        # Pandoc < 1.16 links have no attributes.
+        link_inlines, link_target = value[-2:]
+        url = link_target[0]
+        if url.startswith('#'):
+            return '\\hyperref[%s]{%s}' % (url[1:], inlines_to_latex(link_inlines))
+        return '\\href{%s}{%s}' % (
+            re.sub(r'([%#\\])', r'\\\1', url),
+            inlines_to_latex(link_inlines)
+        )
+    else:
+        raise UnsupportedTable('Unsupported table element [%s]' % key)
+
+
+def blocks_to_latex(blocks):
+    """Return the LaTeX of the given Pandoc blocks of a table cell"""
+    paragraphs = []
+    for block in blocks:
+        if block['t'] not in ('Plain', 'Para'):
+            raise UnsupportedTable('Unsupported table element [%s]' % block['t'])
+        paragraphs.append(inlines_to_latex(block['c']))
+    return '\\par '.join(paragraphs)
+
+
+def get_table_cells(table):
+    """Return the alignments, the header cells and the rows of cells (as
+    lists of blocks) of the given Pandoc Table element value"""
+    if len(table) == 5:
+        # Pandoc < 2.10: caption, alignments, widths, header, rows.
+        caption, alignments, widths, header, rows = table
+        if len(caption) > 0:
+            raise UnsupportedTable('Table with caption')
+        return [alignment['t'] for alignment in alignments], header, rows
+
+    # Pandoc >= 2.10: attributes, caption, column specs, head, bodies, foot.
+    attributes, caption, column_specs, head, bodies, foot = table
+    if len(caption[1]) > 0 or len(foot[1]) > 0:
+        raise UnsupportedTable('Table with caption or foot')
+
+    def get_row_cells(row):
+        cells = []
+        for cell_attributes, alignment, row_span, column_span, blocks in row[1]:
+            if row_span != 1 or column_span != 1:
+                raise UnsupportedTable('Table with merged cells')
+            cells.append(blocks)
+        return cells
+
+    head_rows = [get_row_cells(row) for row in head[1]]
+    if len(head_rows) > 1:
+        raise UnsupportedTable('Table with several header rows')
+
+    rows = []
+    for body in bodies:
+        rows += [get_row_cells(row) for row in body[2] + body[3]]
+
+    return (
+        [column_spec[0]['t'] for column_spec in column_specs],
+        head_rows[0] if len(head_rows) > 0 else [],
+        rows
+    )
+
+
+def get_column_widths(rows, columns):
+    """Return the width (as a fraction of the column width) of every column
+    of the given rows of cells, proportional to their visible text"""
+    column_lengths = [TABLE_COLUMN_MIN_LENGTH] * columns
+    for row in rows:
+        for column, cell in enumerate(row[:columns]):
+            column_lengths[column] = max(
+                column_lengths[column],
+                min(len(stringify(cell)), TABLE_COLUMN_MAX_LENGTH)
+            )
+
+    total_length = float(sum(column_lengths))
+    table_width = TABLE_WIDTH - 0.02 * (columns - 1)
+    return [table_width * column_length / total_length for column_length in column_lengths]
+
+
+def table_to_latex(table):
+    """Return the given Pandoc Table element value as a LaTeX longtable, or
+    None if it can not be rendered (Pandoc must render it then)"""
+    try:
+        alignments, header, rows = get_table_cells(table)
+        columns = len(alignments)
+        if columns == 0:
+            return None
+
+        widths = get_column_widths([header] + rows, columns)
+        column_latex_alignments = [LATEX_ALIGNMENTS.get(alignment, '\\raggedright') for alignment in alignments]
+
+        def row_to_latex(row):
+            row = list(row[:columns]) + [[]] * (columns - len(row))
+            return ' & '.join(
+                '%s %s' % (column_latex_alignments[column], blocks_to_latex(cell))
+                for column, cell in enumerate(row)
+            ) + ' \\tabularnewline'
+
+        latex_lines = [
+            '\\begin{longtable}[]{@{}%s@{}}' % ''.join('p{%.3f\\columnwidth}' % width for width in widths),
+            '\\toprule'
+        ]
+        if any(len(cell) > 0 for cell in header):
+            latex_lines += [row_to_latex(header), '\\midrule']
+        latex_lines.append('\\endhead')
+        latex_lines += [row_to_latex(row) for row in rows]
+        latex_lines += ['\\bottomrule', '\\end{longtable}']
+    except UnsupportedTable:
+        return None
+
+    return '\n'.join(latex_lines)
@@ -0,0 +1,148 @@
+"""Line oriented preprocessing of the Markdown files.
+
+The fixes applied to every Markdown file before and after its normalization
+with Pandoc (see preprocess_markdown_content) are done here in a single pass
+over the lines of the file, instead of one pass over the whole content per
+fix. Lines inside fenced code blocks are kept as they are.
+
+Every fix gives the same result as the function of markdown_to_pdf or
+links_processing it replaces (i.e. fix_img_in_new_line), except inside code
+blocks.
+"""
+import re
+
+
+# Unicode spaces replaced with normal spaces (see fix_empty_lines).
+UNICODE_SPACES_REGEX = re.compile(u'[\u2000-\u200a]')
+
+# Indentation removed from code fences (see fix_blanck_spaces_before_code_tag).
+CODE_FENCE_INDENTATION_REGEX = re.compile(r'^ {1,3}(?=```)')
+
+# See remove_ids_from_a.
+A_ID_REGEX = re.compile(r'(\<a[^\>]*)(?P<id>id *= *((\'.*\')|(".*")))(.*\>)', re.IGNORECASE)
+
+# Line ending with an image (see fix_new_line_after_img).
+IMAGE_AT_END_REGEX = re.compile(r'!\[[^\[\]]*\]\([^\(\)]*\)$')
+
+# See prevent_latex_images_floating.
+IMAGE_REGEX = re.compile(r'!\[(.*)\]\((.*)\)')
+
+# Line ending with a LaTeX anchor (see separate_latex_anchors).
+LATEX_ANCHOR_AT_END_REGEX = re.compile(r'\\anchor{.*}$')
+
+# Line ending with a HTML anchor (see collapse_anchors_before_titles).
+HTML_ANCHOR_AT_END_REGEX = re.compile(
+    r'(?P<anchor><a name="[^\"]+"(?:(?:><\/a>)|(?:\/?>)))[ \t]*$',
+    re.IGNORECASE
+)
+
+
+def is_a_code_fence(line):
+    """Return True if the given line opens or closes a code block (as
+    add_newlines_before_markdown_headers detects them)"""
+    return '```' in line and line.lstrip().startswith('```')
+
+
+def is_a_setext_underline(line):
+    return line[:1] in ('=', '-')
+
+
+def fix_markdown_lines(markdown_content):
+    """Apply to the given Markdown content, before its normalization with
+    Pandoc, the fixes of fix_empty_lines, fix_blanck_spaces_before_code_tag,
+    remove_ids_from_a, fix_html_before_title, fix_img_in_new_line and
+    fix_new_line_after_img"""
+    markdown_content = UNICODE_SPACES_REGEX.sub(u' ', markdown_content)
+
+    lines = markdown_content.split('\n')
+    last_line_index = len(lines) - 1
+    output_lines = []
+    previous_line = None
+    inside_a_code_block = False
+
+    for line_index, line in enumerate(lines):
+        if is_a_code_fence(line):
+            if line[:1] == ' ':
+                line = CODE_FENCE_INDENTATION_REGEX.sub('', line)
+            inside_a_code_block = not inside_a_code_block
+            if not inside_a_code_block:
+                output_lines.append(line)
+                previous_line = line
+                continue
+        elif inside_a_code_block:
+            output_lines.append(line)
+            previous_line = line
+            continue
+        elif line.strip(' \t') == '':
+            line = ''
+        elif '<' in line:
+            line = A_ID_REGEX.sub(r'\1\6', line)
+
+        # Images, and titles after HTML, must be separated with an empty
+        # line from the previous line (the start and end of the file count
+        # as lines).
+        if (
+            previous_line is not None and (previous_line != '' or line_index == 1) and 
+            (line != '' or line_index == last_line_index)
+        ):
+            if (
+                ('![' in line and line.lstrip(' \t').startswith('![')) or
+                (previous_line.endswith(')') and IMAGE_AT_END_REGEX.search(previous_line) is not None) or
+                (previous_line.endswith('>') and line.startswith('#'))
+            ):
+                output_lines.append('')
+
+        output_lines.append(line)
+        previous_line = line
+
+    return '\n'.join(output_lines)
+
+
+def fix_normalized_markdown_lines(markdown_content):
+    """Apply to the given Markdown content, after its normalization with
+    Pandoc, the fixes of prevent_latex_images_floating,
+    separate_latex_anchors and collapse_anchors_before_titles"""
+    lines = markdown_content.split('\n')
+    output_lines = []
+    inside_a_code_block = False
+    line_index = 0
+
+    while line_index < len(lines):
+        line = lines[line_index]
+        line_index += 1
+
+        code_fence = is_a_code_fence(line)
+        if inside_a_code_block or code_fence:
+            output_lines.append(line)
+            inside_a_code_block = inside_a_code_block != code_fence
+            continue
+
+        if '![' in line:
+            line = IMAGE_REGEX.sub(r'![\1](\2)\\ ', line)
+
+        # Consecutive LaTeX anchors must be separated with an empty line.
+        if (
+            line.startswith('\\anchor') and len(output_lines) > 0 and
+            LATEX_ANCHOR_AT_END_REGEX.search(output_lines[-1]) is not None
+        ):
+            output_lines.append('')
+
+        # HTML anchors before a (setext) title are moved to the title line.
+        anchor = HTML_ANCHOR_AT_END_REGEX.search(line) if '<' in line else None
+        if anchor is not None:
+            title_index = line_index
+            while title_index < len(lines) and lines[title_index] == '':
+                title_index += 1
+
+            if title_index + 1 < len(lines) and not is_a_code_fence(lines[title_index]) and \
+                    is_a_setext_underline(lines[title_index + 1]):
+                line = line[:anchor.end('anchor')] + IMAGE_REGEX.sub(r'![\1](\2)\\ ', lines[title_index])
+                line_index = title_index + 1
+            elif title_index > line_index and title_index < len(lines) and \
+                    is_a_setext_underline(lines[title_index]):
+                line = line[:anchor.end('anchor')]
+                line_index = title_index
+
+        output_lines.append(line)
+
+    return '\n'.join(output_lines)
@@ -1,9 +1,19 @@
 from __future__ import print_function
-from markdown.extensions.toc import slugify
 import os
 import re
-from urllib2 import urlopen, HTTPError
 import sys
+import unicodedata
+
+
+# Characters removed from the slugs (see slugify).
+SLUG_INVALID_CHARACTERS_REGEX = re.compile(r'[^\w\s-]')
+
+# Maximum number of slugs memoized by slugify_string.
+SLUG_MEMO_SIZE = 100000
+
+# Metadata field giving the Pandoc filter the anchor index of the document
+# (see anchor_index).
+ANCHOR_INDEX_METADATA_FIELD = 'md2pdf-anchor-index'
 
 
 def print_warning(*objs):
@@ -19,11 +29,47 @@ def make_image_path_absolute(image_path,markdown_filepath):
     markdown_absolute_filepath = os.path.join(os.getcwd(), os.path.dirname(markdown_filepath))
 
     if not is_an_url(image_path):
-        image_path = os.path.join(markdown_absolute_filepath, image_path)
+        image_path = get_optimized_image_path(os.path.join(markdown_absolute_filepath, image_path))
 
     return image_path
 
 
+def get_optimized_image_path(image_path):
+    """Return the optimized version of the given local image if image 
+    optimization is enabled (see image_optimizer). Otherwise the image path
+    is returned"""
+    if not os.environ.get('MD2PDF_IMAGE_DPI'):
+        return image_path
+
+    # Imported here because image optimization is optional.
+    from image_optimizer import get_image_optimizer
+
+    image_optimizer = get_image_optimizer()
+    if image_optimizer is None:
+        return image_path
+    return image_optimizer.get_optimized_image_path(image_path)
+
+
+def get_prefetched_image_path(image_path):
+    """Return the local copy of the given remote image if it has been 
+    downloaded (see asset_cache). Otherwise the image path is returned"""
+    if not is_an_url(image_path):
+        return image_path
+
+    # Imported here because asset_cache imports this module.
+    from asset_cache import get_remote_asset_cache
+
+    local_image_path = get_remote_asset_cache().get_local_path(normalize_remote_url(image_path))
+    if local_image_path is None:
+        return image_path
+    return get_optimized_image_path(local_image_path)
+
+
+def is_offline_mode():
+    """Return True if md2pdf is run in offline mode (without network)"""
+    return os.environ.get('MD2PDF_OFFLINE') == '1'
+
+
 def print_image_not_found(image_path):
     return '\\textcolor{red}{Image Not Found \\texttt{%s}}' % image_path.replace('&','\\&').replace('%', '\\%').replace('_', '\\_')
 
@@ -36,11 +82,11 @@ def is_image_broken(image_path):
         if not is_an_url(image_path):
             if not os.path.isfile(image_path):
                 return True
+        elif is_offline_mode():
+            print_warning("Remote image not available in offline mode: " + image_path.encode('utf-8'))
+            return True
         else:
-            url = image_path.split(' ')[0]
-            if not url.startswith('http'):
-                url = 'http://' + url
-            if not exists_url(url):
+            if not exists_url(normalize_remote_url(image_path)):
                 return True
 
         return False
@@ -49,6 +95,14 @@ def is_image_broken(image_path):
         return True
 
 
+def normalize_remote_url(remote_path):
+    """Return the URL requested for the given remote image path"""
+    url = remote_path.split(' ')[0]
+    if not url.startswith('http'):
+        url = 'http://' + url
+    return url
+
+
 def collapse_anchors_before_titles(markdown_content):
     anchor_regex = r'(?P<anchor><a name="[^\"]+"(?:(?:><\/a>)|(?:\/?>)))'
     
@@ -126,13 +180,37 @@ def make_header_id_unique(header_id, used_ids):
     return unique_header_id
 
 
+def slugify(value, separator):
+    """Slugify the given unicode string, to make it URL friendly.
+
+    Same as markdown.extensions.toc.slugify (Python-Markdown 2.6). Importing
+    Python-Markdown took most of the start time of the Pandoc filters."""
+    value = unicodedata.normalize('NFKD', value).encode('ascii', 'ignore')
+    value = SLUG_INVALID_CHARACTERS_REGEX.sub('', value.decode('ascii')).strip().lower()
+    return re.sub(r'[%s\s]+' % separator, separator, value)
+
+
 def slugify_string(string):
-    """slugify_string the given string"""
+    """slugify_string the given string. The slugs are memoized, as the same
+    file paths and headers are slugified for every link to them"""
+    # str and unicode strings are equal if they are ASCII, but their slugs
+    # have their type.
+    memo_key = (type(string), string)
+    slug = slugify_string.memo.get(memo_key)
+    if slug is not None:
+        return slug
+
     try:
        
-       return slugify(string.decode('utf-8'), '-').encode('utf-8', 'ignore').replace('_', '-')
+       slug = slugify(string.decode('utf-8'), '-').encode('utf-8', 'ignore').replace('_', '-')
     except UnicodeEncodeError as e:
-        return slugify(string, '-').replace('_','-')
+        slug = slugify(string, '-').replace('_','-')
+
+    if len(slugify_string.memo) >= SLUG_MEMO_SIZE:
+        slugify_string.memo.clear()
+    slugify_string.memo[memo_key] = slug
+    return slug
+slugify_string.memo = {}
 
 
 def remove_code_from_line(line):
@@ -154,11 +232,17 @@ def generate_latex_label(label_id):
 
 
 def exists_url(url):
-    try:
-        urlopen(url.encode('utf-8')).code
-        return True
-    except HTTPError:
-        return False
+    """Return True if the given URL exists. The status checked before 
+    running Pandoc (see url_checker.prefetch_url_statuses) is used if it is 
+    cached"""
+    # Imported here because url_checker imports this module.
+    from url_checker import get_url_status_cache, check_url
+
+    url_status = get_url_status_cache().get(url)
+    if url_status is not None:
+        return url_status
+
+    return check_url(url)
 
 
 def remove_ids_from_a(content):
@@ -167,14 +251,12 @@ def remove_ids_from_a(content):
 
 def is_a_markdown_header(line, next_line):
     """Return the nesting level of the Markdown header in markdown_line (if any)"""
-    if len(line.strip()) > 0:
-        i = 0
-        while(i < len(line) and line[i] == '#'):
-            i += 1
-        if i > 0:
+    stripped_line = line.strip()
+    if len(stripped_line) > 0:
+        if line[0] == '#':
             return True
 
-        if line.strip()[0] != '-' and len(next_line) > 0:
-           return re.match('={2,}|-{2,}', next_line) is not None
+        if stripped_line[0] != '-' and len(next_line) > 0:
+           return next_line.startswith('==') or next_line.startswith('--')
           
     return False
@@ -0,0 +1,57 @@
+-- Normalizes GFM content in a single Pandoc process.
+--
+-- It reproduces the chain of conversions done by 
+-- normalize_markdown_content_with_pandoc_chain (markdown_to_pdf.py): 
+--   1. markdown_github -> markdown_github (md2pdf_pandoc_paragraph_filter)
+--   2. markdown_github+all_symbols_escapable -> idem
+--   3. MD2PDF_INNER_FORMAT -> markdown_github
+-- Pandoc must be run with "--from markdown_github --to markdown_github" and
+-- the inner format given in the "md2pdf-inner-format" metadata field.
+-- Requires Pandoc >= 2.17 (pandoc.write).
+
+
+-- Removes the trailing backslash of the given Str element (if any). Same
+-- behaviour as paragraph_filters.pandoc_filter.
+local function remove_trailing_backslash(element)
+  local text = element.text
+  if text:sub(-1) == '\\' and utf8.len(text) > 2 then
+    element.text = text:sub(1, -2)
+  end
+end
+
+
+local function fix_paragraph_line_breaks(para)
+  local new_elements = {}
+
+  if #para.content == 0 then
+    return nil
+  end
+
+  for _, element in ipairs(para.content) do
+    if element.t == 'LineBreak' and #new_elements > 1 then
+      if new_elements[#new_elements].t == 'Str' then
+        remove_trailing_backslash(new_elements[#new_elements])
+      end
+    end
+    table.insert(new_elements, element)
+  end
+
+  if new_elements[#new_elements].t == 'Str' then
+    remove_trailing_backslash(new_elements[#new_elements])
+  end
+
+  return pandoc.Para(new_elements)
+end
+
+
+function Pandoc(doc)
+  local inner_format = pandoc.utils.stringify(doc.meta['md2pdf-inner-format'])
+
+  doc = doc:walk({ Para = fix_paragraph_line_breaks })
+
+  local markdown = pandoc.write(doc, 'markdown_github')
+  doc = pandoc.read(markdown, 'markdown_github+all_symbols_escapable')
+
+  markdown = pandoc.write(doc, 'markdown_github+all_symbols_escapable')
+  return pandoc.read(markdown, inner_format)
+end
@@ -1,21 +1,40 @@
 #!/usr/bin/env python
 
 from __future__ import print_function
-import yaml
 from subprocess import call, Popen
 import os
 import re
 import shutil
-import pypandoc
 import string
 import errno
 import getopt
 import tempfile
+import itertools
+import json
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 
 from convert_md_tables import *
 from links_processing import *
 from check_requirements import *
+from file_cache import *
+from version import __version__
+from inprocess_filters import apply_json_filters, apply_document_filters
+from pandoc_backend import *
+from image_optimizer import *
+from latex_build import *
+from latex_shards import compile_latex_in_shards
+from latex_format import is_latex_format_enabled, get_latex_format
+from watch import get_filepaths_state, wait_for_changes
+from line_preprocessor import fix_markdown_lines, fix_normalized_markdown_lines
+from anchor_index import build_anchor_index
+from json_ast import is_incremental_parsing_enabled, merge_json_asts, make_header_identifiers_unique
+from latex_fragments import generate_latex_document
+
+# yaml, pypandoc, build_server, url_checker and asset_cache (urllib2) are
+# imported by the functions using them: importing them took most of the
+# start time of md2pdf.
 
 # We need Pandoc to convert from GFM to Markdown with some extensions added
 # and other removed. This global set the Markdown format with its extensions.
@@ -25,12 +44,36 @@ MD2PDF_INNER_FORMAT = \
     '-startnum' +\
     '-fancy_lists'
 
+# Version of the preprocessing, part of the key of the preprocessed files in
+# the cache. Increase it when the preprocessing changes, so the files
+# preprocessed before are preprocessed again.
+PREPROCESSING_VERSION = '1'
+
+# Format of the Pandoc JSON ASTs of the files: header identifiers are 
+# generated after merging them (see json_ast).
+JSON_AST_FORMAT = MD2PDF_INNER_FORMAT + '-auto_identifiers'
+
+# Lua filter which normalizes the Markdown content in a single Pandoc process
+# and the minimum Pandoc version able to run it.
+NORMALIZE_MARKDOWN_LUA_FILTER = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)),
+    'lua_filters',
+    'normalize_markdown.lua'
+)
+NORMALIZE_MARKDOWN_LUA_FILTER_PANDOC_VERSION = (2, 17)
+
+# URLs of the Markdown content, and their unescaped < and > characters (see
+# fix_special_characters_inside_links).
+URL_REGEX = re.compile(r'https?://[^ \n]*', re.IGNORECASE)
+URL_SPECIAL_CHARACTER_REGEX = re.compile(r'([^\\])(?P<character>[<>])')
+
 
 def get_markdown_filepaths(configuration_filepath):
     """Return a list of markdown file paths from the given configuration file"""
     markdown_filepaths = []
     configuration_dirpath = os.path.dirname(configuration_filepath)
     
+    import yaml
     with open(configuration_filepath, 'rU') as configuration_file:
          configuration_file_content = yaml.load(configuration_file)
 
@@ -52,6 +95,7 @@ def convert_md_filepaths_from_RTD_format(configuration_filepath):
     file_paths=[]
     prefix=""
 
+    import yaml
     with open(configuration_filepath, 'rU') as configuration_file:
          configuration_file_content = yaml.load(configuration_file)
 
@@ -92,72 +136,318 @@ def create_file_order_list(elements):
 
     return paths
 
-def build_monolitic_markdown_file(monolitic_markdown_filepath, markdown_filepaths):
-    with open(monolitic_markdown_filepath, 'wb') as monolitic_markdown_file:
-        for markdown_filepath in markdown_filepaths:
-            temp_file = os.path.join(tempfile.gettempdir(),'temp_md_m2pdf.md')
-            
-            print('Processing file [%s] ...' % markdown_filepath)
-            with open(markdown_filepath, 'rU') as markdown_file:
-                markdown_content = markdown_file.read().decode('utf-8')
-                
-                markdown_content = fix_empty_lines(markdown_content)
+def read_markdown_file(markdown_filepath):
+    """Return the content of the given Markdown file (as a byte string)"""
+    with open(markdown_filepath, 'rU') as markdown_file:
+        return markdown_file.read()
+
+
+def preprocess_markdown_file(markdown_filepath):
+    """Return the Markdown content of the given file ready to be included in
+    the monolitic Markdown file"""
+    return preprocess_markdown_content(read_markdown_file(markdown_filepath).decode('utf-8'))
+
 
-                markdown_content = fix_blanck_spaces_before_code_tag(markdown_content)
+def preprocess_markdown_content(markdown_content, pandoc_backend=None):
+    """Return the given Markdown content ready to be included in the 
+    monolitic Markdown file"""
+    # fix_empty_lines, fix_blanck_spaces_before_code_tag, remove_ids_from_a,
+    # fix_html_before_title, fix_img_in_new_line and fix_new_line_after_img
+    # in a single pass.
+    markdown_content = fix_markdown_lines(markdown_content)
 
-                markdown_content = remove_ids_from_a(markdown_content)
+    markdown_content = normalize_markdown_content(markdown_content, pandoc_backend)
 
-                markdown_content = fix_html_before_title(markdown_content)
-                markdown_content = fix_img_in_new_line(markdown_content)
-                
-                markdown_content = fix_new_line_after_img(markdown_content)
+    markdown_content = fix_special_characters_inside_links(markdown_content)
 
-                markdown_content = pypandoc.convert(markdown_content, 'markdown_github', format='markdown_github', filters=['md2pdf_pandoc_paragraph_filter'])
+    markdown_content = add_newlines_before_markdown_headers( markdown_content )
 
-                markdown_content = pypandoc.convert(markdown_content, 'markdown_github+all_symbols_escapable', format='markdown_github+all_symbols_escapable')
-                
-                markdown_content = pypandoc.convert(markdown_content, 'markdown_github', format=MD2PDF_INNER_FORMAT)
+    # prevent_latex_images_floating, separate_latex_anchors and 
+    # collapse_anchors_before_titles in a single pass.
+    markdown_content = fix_normalized_markdown_lines(markdown_content)
 
-                markdown_content = fix_special_characters_inside_links(markdown_content)
-   
-                markdown_content = prevent_latex_images_floating(markdown_content)
+    markdown_content = translate_md_tables(markdown_content)
 
-                markdown_content = add_newlines_before_markdown_headers( markdown_content )
+    return markdown_content
 
-                markdown_content = separate_latex_anchors(markdown_content)
 
-                markdown_content = collapse_anchors_before_titles(markdown_content)
-                
-                markdown_content = translate_md_tables(markdown_content)
+def normalize_markdown_content(markdown_content, pandoc_backend=None):
+    """Normalize the given GFM content using Pandoc.
 
-                file_latex_label = generate_latex_anchor(slugify_string(markdown_filepath))
+    When the installed Pandoc and the backend support it, the whole 
+    normalization is done by a single Pandoc process running 
+    NORMALIZE_MARKDOWN_LUA_FILTER. Otherwise the chain of Pandoc conversions
+    is used. Both give the same result.
 
-                # This "file marker" is appended at the beginning of the 
-                # contents of every file so the filepath is passed to the
-                # Pandoc filter which need it for links processing.
-                file_marker = '<md2pdf:file:%s/>' % markdown_filepath
+    Arguments:
+    markdown_content - GFM content
+    pandoc_backend - Pandoc backend (see pandoc_backend) running the 
+    conversions (by default, a new Pandoc process is launched for each one)
+    """
+    if pandoc_backend is None:
+        pandoc_backend = OneShotPandocBackend()
+
+    if pandoc_backend.supports_lua_filters and get_pandoc_version_number() >= NORMALIZE_MARKDOWN_LUA_FILTER_PANDOC_VERSION:
+        return pandoc_backend.convert(
+            markdown_content,
+            'markdown_github',
+            'markdown_github',
+            extra_args=[
+                '--lua-filter', NORMALIZE_MARKDOWN_LUA_FILTER,
+                '--metadata', 'md2pdf-inner-format=' + MD2PDF_INNER_FORMAT
+            ]
+        )
+    else:
+        return normalize_markdown_content_with_pandoc_chain(markdown_content, pandoc_backend)
 
-                monolitic_markdown_file.write( ("\n" + file_marker + "\n\n\\newpage\n\n" + file_latex_label + "\n\n" + markdown_content + "\n").encode('UTF-8'))
 
-                print('Processing file [%s] ...OK' % markdown_filepath)
+def normalize_markdown_content_with_pandoc_chain(markdown_content, pandoc_backend=None):
+    """Normalize the given GFM content using a chain of Pandoc conversions"""
+    if pandoc_backend is None:
+        pandoc_backend = OneShotPandocBackend()
 
+    markdown_content = pandoc_backend.convert(markdown_content, 'markdown_github', 'markdown_github', filters=['md2pdf_pandoc_paragraph_filter'])
+
+    markdown_content = pandoc_backend.convert(markdown_content, 'markdown_github+all_symbols_escapable', 'markdown_github+all_symbols_escapable')
+
+    return pandoc_backend.convert(markdown_content, 'markdown_github', MD2PDF_INNER_FORMAT)
+
+
+def preprocess_markdown_file_job(job):
+    """Preprocess the (markdown_filepath, markdown_content, pandoc_backend)
+    tuple given.
+
+    Errors are re-raised as a RuntimeError naming the file, so the main 
+    process can report which file failed when running in a worker process."""
+    markdown_filepath, markdown_content, pandoc_backend = job
+    try:
+        return preprocess_markdown_content(markdown_content.decode('utf-8'), pandoc_backend)
+    except Exception as error:
+        raise RuntimeError(
+            'Processing file [%s] failed - %s' % (markdown_filepath, error)
+        )
+
+
+def get_preprocessing_cache_key(markdown_content):
+    """Return the key of the preprocessed content of the given Markdown 
+    content in the preprocessing cache"""
+    return generate_cache_key(
+        markdown_content, __version__, PREPROCESSING_VERSION, get_pandoc_version(), get_table_backend()
+    )
+
+
+def preprocess_markdown_files(markdown_filepaths, jobs=1, cache=None, pandoc_backend=None):
+    """Preprocess the given Markdown files which are not in the cache yet,
+    and store the results in the cache. Files with the same content are 
+    preprocessed once. Files which fail are skipped, so their error is 
+    reported by build_monolitic_markdown_file. Return the number of files 
+    preprocessed"""
+    pending_jobs = {}
+    for markdown_filepath in markdown_filepaths:
+        try:
+            markdown_content = read_markdown_file(markdown_filepath)
+        except IOError:
+            continue
+        cache_key = get_preprocessing_cache_key(markdown_content)
+        if cache_key not in pending_jobs and cache.get(cache_key) is None:
+            pending_jobs[cache_key] = (markdown_filepath, markdown_content, pandoc_backend)
+
+    if jobs > 1 and len(pending_jobs) > 1:
+        pool = multiprocessing.Pool(min(jobs, len(pending_jobs)))
+        pending_results = pool.imap_unordered(preprocess_markdown_files_job, pending_jobs.items())
+    else:
+        pool = None
+        pending_results = itertools.imap(preprocess_markdown_files_job, pending_jobs.items())
+
+    preprocessed_files = 0
+    try:
+        for cache_key, markdown_content in pending_results:
+            if markdown_content is not None:
+                cache.put(cache_key, markdown_content.encode('utf-8'))
+                preprocessed_files += 1
+    except:
+        if pool is not None:
+            pool.terminate()
+        raise
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    return preprocessed_files
+
+
+def preprocess_markdown_files_job(cache_key_and_job):
+    """Preprocess the (cache_key, job) tuple given (see 
+    preprocess_markdown_file_job). Return the cache key with the 
+    preprocessed content, or None if it failed"""
+    cache_key, job = cache_key_and_job
+    try:
+        return (cache_key, preprocess_markdown_file_job(job))
+    except RuntimeError:
+        return (cache_key, None)
+
+
+def generate_file_section(markdown_filepath, markdown_content):
+    """Return the section of the monolitic Markdown file for the given file"""
+    file_latex_label = generate_latex_anchor(slugify_string(markdown_filepath))
+
+    # This "file marker" is appended at the beginning of the 
+    # contents of every file so the filepath is passed to the
+    # Pandoc filter which need it for links processing.
+    file_marker = '<md2pdf:file:%s/>' % markdown_filepath
+
+    return "\n" + file_marker + "\n\n\\newpage\n\n" + file_latex_label + "\n\n" + markdown_content + "\n"
+
+
+def build_monolitic_markdown_file(monolitic_markdown_filepath, markdown_filepaths, jobs=1, cache=None, pandoc_backend=None):
+    """Preprocess the given Markdown files and join them in a single file.
+
+    Arguments:
+    monolitic_markdown_filepath - filepath of the output Markdown file
+    markdown_filepaths - list of Markdown files, in document order
+    jobs - number of processes used for preprocessing the files. The output
+    is the same whatever the number of jobs.
+    cache - FileCache where the preprocessed contents are stored. Files whose
+    content is found in the cache are not preprocessed again.
+    pandoc_backend - Pandoc backend (see pandoc_backend) running the 
+    per-file conversions.
+
+    Return the sections of the monolitic Markdown file (see 
+    generate_file_section), in document order.
+    """
+    markdown_contents = [read_markdown_file(markdown_filepath) for markdown_filepath in markdown_filepaths]
+    preprocessed_contents = {}
+
+    if cache is not None:
+        cache_keys = [
+            get_preprocessing_cache_key(markdown_content)
+            for markdown_content in markdown_contents
+        ]
+        for index, cache_key in enumerate(cache_keys):
+            cached_content = cache.get(cache_key)
+            if cached_content is not None:
+                preprocessed_contents[index] = cached_content.decode('utf-8')
+
+    pending_jobs = [
+        (markdown_filepath, markdown_contents[index], pandoc_backend)
+        for index, markdown_filepath in enumerate(markdown_filepaths)
+        if index not in preprocessed_contents
+    ]
+
+    if jobs > 1 and len(pending_jobs) > 1:
+        pool = multiprocessing.Pool(min(jobs, len(pending_jobs)))
+        # imap returns the results in the same order as pending_jobs.
+        pending_results = pool.imap(preprocess_markdown_file_job, pending_jobs)
+    else:
+        pool = None
+        pending_results = itertools.imap(preprocess_markdown_file_job, pending_jobs)
+
+    markdown_sections = []
+    try:
+        with open(monolitic_markdown_filepath, 'wb') as monolitic_markdown_file:
+            for index, markdown_filepath in enumerate(markdown_filepaths):
+                print('Processing file [%s] ...' % markdown_filepath)
+
+                if index in preprocessed_contents:
+                    markdown_content = preprocessed_contents[index]
+                    processing_status = 'OK (cached)'
+                else:
+                    markdown_content = next(pending_results)
+                    processing_status = 'OK'
+                    if cache is not None:
+                        cache.put(cache_keys[index], markdown_content.encode('utf-8'))
+
+                markdown_sections.append(generate_file_section(markdown_filepath, markdown_content))
+                monolitic_markdown_file.write(markdown_sections[-1].encode('UTF-8'))
+
+                print('Processing file [%s] ...%s' % (markdown_filepath, processing_status))
+    except:
+        if pool is not None:
+            pool.terminate()
+        raise
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    return markdown_sections
+
+
+def get_json_ast_cache_key(markdown_section):
+    """Return the key of the Pandoc JSON AST of the given section of the 
+    monolitic Markdown file in the cache"""
+    return generate_cache_key(markdown_section, __version__, get_pandoc_version(), JSON_AST_FORMAT)
 
-def fix_special_characters_inside_links(markdown_content):
-    pattern_url = r'(?P<prev>.*?)(?P<url>https?://[^ \n]*)(?P<last>.*)'
-    pattern = r'([^\\])(?P<character>[<>])'
 
+def build_json_ast(markdown_sections, jobs=1, cache=None, pandoc_backend=None):
+    """Return the (decoded) Pandoc JSON AST of the monolitic Markdown file
+    with the given sections, assembled from the ASTs of every section (see
+    json_ast).
+
+    Arguments:
+    markdown_sections - sections of the monolitic Markdown file (see 
+    build_monolitic_markdown_file)
+    jobs - number of Pandoc conversions run at the same time
+    cache - FileCache where the ASTs are stored. Only the sections whose AST
+    is not in the cache are parsed by Pandoc.
+    pandoc_backend - Pandoc backend (see pandoc_backend) running the conversions.
+    """
+    if pandoc_backend is None:
+        pandoc_backend = OneShotPandocBackend()
+
+    print('Parsing files...')
+
+    section_json_asts = [None] * len(markdown_sections)
+    if cache is not None:
+        cache_keys = [get_json_ast_cache_key(markdown_section) for markdown_section in markdown_sections]
+        for index, cache_key in enumerate(cache_keys):
+            section_json_asts[index] = cache.get(cache_key)
+
+    pending_indexes = [index for index, section_json_ast in enumerate(section_json_asts) if section_json_ast is None]
+
+    def parse_section(index):
+        return pandoc_backend.convert_text(markdown_sections[index], 'json', JSON_AST_FORMAT).encode('utf-8')
+
+    # Pandoc runs in its own process, so threads are enough.
+    if jobs > 1 and len(pending_indexes) > 1:
+        pool = ThreadPool(min(jobs, len(pending_indexes)))
+        try:
+            parsed_json_asts = pool.map(parse_section, pending_indexes)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        parsed_json_asts = map(parse_section, pending_indexes)
+
+    for index, section_json_ast in zip(pending_indexes, parsed_json_asts):
+        section_json_asts[index] = section_json_ast
+        if cache is not None:
+            cache.put(cache_keys[index], section_json_ast)
+
+    json_ast = make_header_identifiers_unique(
+        merge_json_asts([json.loads(section_json_ast) for section_json_ast in section_json_asts])
+    )
+
+    print('Parsing files...OK (%d cached)' % (len(markdown_sections) - len(pending_indexes)))
+
+    return json_ast
+
+
+def fix_special_characters_inside_links(markdown_content):
+    """Escape the < and > characters inside the URLs of the given Markdown
+    content (scanned from left to right in a single pass)"""
     if markdown_content is None:
         return ''
-    
-    result = re.search(pattern_url,markdown_content,re.IGNORECASE | re.DOTALL)
 
-    if result:
-        return (fix_special_characters_inside_links(result.group('prev')) + 
-                re.sub(pattern,'\\1\\'+re.escape('\\2'),result.group('url')) +
-                fix_special_characters_inside_links(result.group('last')) )
+    return URL_REGEX.sub(escape_url_special_characters, markdown_content)
 
-    else:
-        return markdown_content
+
+def escape_url_special_characters(url_match):
+    url = url_match.group()
+    if '<' in url or '>' in url:
+        return URL_SPECIAL_CHARACTER_REGEX.sub(r'\1\\\2', url)
+    return url
 
 def fix_blanck_spaces_before_code_tag(markdown_content):
 
@@ -207,31 +497,31 @@ def fix_empty_lines(markdown_content):
 
 
 def add_newlines_before_markdown_headers(markdown_content):
-    markdown_lines = markdown_content.split('\n')
-    markdown_output_content = ""
+    return '\n'.join(
+        generate_lines_with_newlines_before_markdown_headers(markdown_content.split('\n'))
+    )
+
+
+def generate_lines_with_newlines_before_markdown_headers(markdown_lines):
+    """Yield the given Markdown lines with two empty lines before every 
+    header outside code blocks. Time and memory are linear in the number
+    of lines"""
     inside_a_code_block = False
-    used_ids = {}
-    line_index = 0
+    markdown_lines = iter(markdown_lines)
+    markdown_line = next(markdown_lines, None)
+
+    while markdown_line is not None:
+        next_markdown_line = next(markdown_lines, None)
 
-    for markdown_line in markdown_lines:
-      
         if markdown_line.lstrip().startswith('```'):
             inside_a_code_block = not inside_a_code_block
 
-        if not inside_a_code_block:
-            if (line_index + 1) < len(markdown_lines):
-                next_markdown_line = markdown_lines[line_index+1]
-            else:
-                next_markdown_line = ''
-
-            if is_a_markdown_header(markdown_line,next_markdown_line):
-                markdown_output_content += "\n\n"
+        if not inside_a_code_block and is_a_markdown_header(markdown_line, next_markdown_line or ''):
+            yield ''
+            yield ''
 
-        markdown_output_content += markdown_line
-        markdown_output_content += "\n"
-        line_index += 1
-
-    return markdown_output_content[:-1]
+        yield markdown_line
+        markdown_line = next_markdown_line
 
 
 def prevent_latex_images_floating(markdown_content):
@@ -252,12 +542,98 @@ def prevent_latex_images_floating(markdown_content):
     return re.sub(original_regex, new_regex, markdown_content)
 
 
-def generate_pdf_from_markdown(pdf_filepath, markdown_filepath,developer_mode):
+def prefetch_remote_images(markdown_filepath, offline=False):
+    """Download the remote images of the given Markdown file to the local 
+    asset cache, so the Pandoc filter replaces them with their local copies.
+    In offline mode only the images already cached are used.
+
+    Return a dictionary associating each URL available to its local copy."""
+    # Imported here because urllib2 is slow to import (see the imports above).
+    from url_checker import find_remote_urls
+    from asset_cache import get_remote_asset_cache
+
+    print('Downloading remote images...')
+
+    with open(markdown_filepath, 'rb') as markdown_file:
+        image_urls = set(find_remote_urls(markdown_file.read().decode('utf-8')))
+
+    local_image_paths = get_remote_asset_cache().fetch(image_urls, offline)
+
+    print('Downloading remote images...OK (%d of %d available)' % (len(local_image_paths), len(image_urls)))
+
+    return local_image_paths
+
+
+def check_remote_urls(markdown_filepath, include_links=False, excluded_urls=()):
+    """Check concurrently the remote images (and links, if include_links) of
+    the given Markdown file, so the Pandoc filter finds their status cached.
+    Broken links are reported."""
+    from url_checker import prefetch_url_statuses
+
+    print('Checking remote URLs...')
+
+    with open(markdown_filepath, 'rb') as markdown_file:
+        url_statuses = prefetch_url_statuses(markdown_file.read().decode('utf-8'), include_links, excluded_urls)
+
+    if include_links:
+        for url, exists in sorted(url_statuses.iteritems()):
+            if exists is None:
+                print_warning('Remote URL could not be checked [%s]' % url.encode('utf-8'))
+            elif not exists:
+                print_warning('Remote URL not found [%s]' % url.encode('utf-8'))
+
+    print('Checking remote URLs...OK (%d URLs)' % len(url_statuses))
+
+
+def check_local_links(markdown_filepath, anchor_index_filepath=None):
+    """Report the links of the given monolitic Markdown file to files, headers
+    or anchors which are not in the document (see anchor_index), before 
+    LaTeX reports them as undefined references. The anchor index is saved to
+    anchor_index_filepath (if given) for the Pandoc filter. Return the 
+    broken links."""
+    print('Checking local links...')
+
+    with open(markdown_filepath, 'rb') as markdown_file:
+        anchor_index = build_anchor_index(markdown_file.read().decode('utf-8'))
+    if anchor_index_filepath is not None:
+        anchor_index.save(anchor_index_filepath)
+
+    broken_links = anchor_index.get_broken_links()
+    for link_filepath, link_destination in broken_links:
+        print_warning(
+            'Broken link [%s] in file [%s]' % 
+            (link_destination.encode('utf-8'), link_filepath.encode('utf-8'))
+        )
+
+    print('Checking local links...OK (%d links, %d broken)' % (len(anchor_index.links), len(broken_links)))
+
+    return broken_links
+
+
+def generate_pdf_from_markdown(pdf_filepath, markdown_filepath,developer_mode, inprocess_filters=False, build_dirpath=None, latex_shards=1, json_ast=None, latex_fragments_cache=None, jobs=1, anchor_index_filepath=None):
     """Generate a PDF from the given Markdown file using Pandoc
 
     Arguments:
     pdf_filepath - filepath of the output PDF file
-    markdown_filepath - filepath of the Markdown input file"""
+    markdown_filepath - filepath of the Markdown input file
+    inprocess_filters - apply md2pdf_pandoc_filter in this process to the 
+    Pandoc JSON AST instead of launching it as an executable
+    build_dirpath - if given, Pandoc only generates the LaTeX file, which is
+    compiled by xelatex in this directory reusing the auxiliary files of 
+    previous builds (see latex_build)
+    latex_shards - if greater than 1, the LaTeX file is compiled in (at most)
+    this number of parallel shards (see latex_shards). It requires 
+    build_dirpath
+    json_ast - if given, the (decoded) Pandoc JSON AST of the Markdown file
+    (see build_json_ast), which Pandoc reads instead of parsing the Markdown
+    file again
+    latex_fragments_cache - if given, the LaTeX file is assembled from the 
+    LaTeX of every file, which is stored in this FileCache (see 
+    latex_fragments). It requires build_dirpath and json_ast
+    jobs - number of files converted to LaTeX at the same time
+    anchor_index_filepath - if given, the file of the anchor index of the 
+    document (see check_local_links), which the Pandoc filter resolves the 
+    local links with"""
     dir_name = os.path.dirname(pdf_filepath)
     if not os.path.exists(dir_name):
         os.makedirs(dir_name)
@@ -267,19 +643,59 @@ def generate_pdf_from_markdown(pdf_filepath, markdown_filepath,developer_mode):
 
     pandoc_options = ["--template", os.path.join(latex_config_dir, 'template.tex'), "--latex-engine=xelatex", 
                       "--toc", "--toc-depth=3", "--listings", "-H", latex_code_sections_config_path, 
-                      "--from", MD2PDF_INNER_FORMAT, "--filter", "md2pdf_pandoc_filter", "--number-sections",
+                      "--number-sections",
                       "-V", 'papersize:"letterpaper"', "-V", 'fontsize:"10pt"', "-V", 'styfolder:{}'.format(latex_config_dir)]
 
+    if get_table_backend() == 'latex':
+        # The tables are raw LaTeX longtables, so Pandoc does not know the
+        # template must load longtable and booktabs.
+        pandoc_options += ["-V", "tables"]
+
+    # The index is given to the filter in the metadata of the document, but
+    # it is not kept in the filtered AST, so the LaTeX fragments of the 
+    # files do not depend on the work directory.
+    filter_metadata = {}
+    filter_metadata_options = []
+    if anchor_index_filepath is not None:
+        filter_metadata[ANCHOR_INDEX_METADATA_FIELD] = {'t': 'MetaString', 'c': anchor_index_filepath}
+        filter_metadata_options = ["--metadata", ANCHOR_INDEX_METADATA_FIELD + '=' + anchor_index_filepath]
+
+    if json_ast is not None:
+        pandoc_input_filepath = os.path.splitext(markdown_filepath)[0] + '.json'
+        with open(pandoc_input_filepath, 'wb') as json_ast_file:
+            # The fragments are converted from the filtered AST.
+            if inprocess_filters or latex_fragments_cache is not None:
+                json_ast = apply_document_filters(json_ast, ['md2pdf_pandoc_filter'], 'latex', filter_metadata)
+            json.dump(json_ast, json_ast_file)
+        pandoc_options += ["--from", "json"]
+        if not inprocess_filters and latex_fragments_cache is None:
+            pandoc_options += ["--filter", "md2pdf_pandoc_filter"] + filter_metadata_options
+    elif inprocess_filters:
+        # Pandoc reads the already filtered JSON AST instead of the Markdown.
+        import pypandoc
+        json_ast = pypandoc.convert(markdown_filepath, 'json', format=MD2PDF_INNER_FORMAT)
+        pandoc_input_filepath = os.path.splitext(markdown_filepath)[0] + '.json'
+        with open(pandoc_input_filepath, 'wb') as json_ast_file:
+            json_ast_file.write(apply_json_filters(json_ast, ['md2pdf_pandoc_filter'], 'latex', filter_metadata))
+        pandoc_options += ["--from", "json"]
+    else:
+        pandoc_input_filepath = markdown_filepath
+        pandoc_options += ["--from", MD2PDF_INNER_FORMAT, "--filter", "md2pdf_pandoc_filter"] + filter_metadata_options
+
     # If developer mode is on, convert temporal file to LaTeX.
     if developer_mode == True:
-        latex_filepath = os.path.join(tempfile.gettempdir(),'markdown_to_pdf_temp.tex')
+        latex_filepath = os.path.splitext(markdown_filepath)[0] + '.tex'
         print('Generating LaTeX (developer mode) ...')
-        call(["pandoc"] + pandoc_options + ["--output", latex_filepath, markdown_filepath])
+        call(["pandoc"] + pandoc_options + ["--output", latex_filepath, pandoc_input_filepath])
         print('LaTeX generated: [%s] (developer mode)' % latex_filepath)
 
+    if build_dirpath is not None:
+        generate_pdf_incrementally(pdf_filepath, pandoc_input_filepath, pandoc_options, build_dirpath, latex_shards, json_ast, latex_fragments_cache, jobs)
+        return
+
     # Generate PDF.
     print('Generating PDF...')
-    pandoc_call_return_value = call(["pandoc"] + pandoc_options + ["--output", pdf_filepath, markdown_filepath])
+    pandoc_call_return_value = call(["pandoc"] + pandoc_options + ["--output", pdf_filepath, pandoc_input_filepath])
 
     if pandoc_call_return_value != 0:
         raise RuntimeError(
@@ -292,8 +708,49 @@ def generate_pdf_from_markdown(pdf_filepath, markdown_filepath,developer_mode):
     print('Generating PDF...OK')
 
 
+def generate_pdf_incrementally(pdf_filepath, pandoc_input_filepath, pandoc_options, build_dirpath, latex_shards=1, json_ast=None, latex_fragments_cache=None, jobs=1):
+    """Generate a PDF converting the given file to LaTeX with Pandoc and 
+    compiling it in build_dirpath (see generate_pdf_from_markdown). If 
+    latex_fragments_cache is given, the LaTeX file is assembled from the 
+    fragments of the given (filtered) JSON AST instead (see 
+    latex_fragments)"""
+    make_dirs(build_dirpath)
+    latex_filepath = os.path.join(build_dirpath, LATEX_BUILD_JOBNAME + '.tex')
+
+    # Builds sharing the build directory wait for each other.
+    with file_lock(os.path.join(build_dirpath, '.lock')):
+        print('Generating LaTeX...')
+        if latex_fragments_cache is not None:
+            generate_latex_document(latex_filepath, json_ast, pandoc_options, jobs, latex_fragments_cache)
+        else:
+            pandoc_call_return_value = call(["pandoc"] + pandoc_options + ["--standalone", "--output", latex_filepath, pandoc_input_filepath])
+
+            if pandoc_call_return_value != 0:
+                raise RuntimeError(
+                    ( 
+                        'Conversion to LaTeX failed - ' +\
+                        'Pandoc failed with code: (%d)'
+                    ) % pandoc_call_return_value
+                )
+
+        latex_format_filepath = None
+        if is_latex_format_enabled():
+            latex_format_filepath = get_latex_format(latex_filepath)
+
+        print('Generating PDF...')
+        if latex_shards > 1:
+            rounds, passes = compile_latex_in_shards(latex_filepath, build_dirpath, latex_shards, latex_format_filepath)
+            print('Parallel compilation: %d rounds over %d shards' % (rounds, latex_shards))
+        else:
+            passes = compile_latex_incrementally(latex_filepath, build_dirpath, latex_format_filepath=latex_format_filepath)
+        shutil.copy2(os.path.join(build_dirpath, LATEX_BUILD_JOBNAME + '.pdf'), pdf_filepath)
+
+    print('Generating PDF...OK (%d xelatex passes)' % passes)
+
+
 def generate_md_cover(configuration_file_path, temp_cover_path):
     """Generate a MD cover using cover_metadata"""
+    import yaml
 
     with open(configuration_file_path, 'rU') as configuration_file:
         configuration_file_content = yaml.load(configuration_file)
@@ -333,6 +790,7 @@ def generate_md_cover(configuration_file_path, temp_cover_path):
 def generate_default_cover_file(input_conf_file, output_file):
     """ Generate the default metadata cover, try to get title from input file"""
     print ("Cover metadata not provided. Trying to generate it")
+    import yaml
     configuration = {}
     with open(input_conf_file, 'rU') as configuration_file:
         configuration_file_content = yaml.load(configuration_file)
@@ -374,7 +832,8 @@ def convert_from_GFM(original_md, converted_md):
 def render_pdf_cover(input_md_path, output_pdf_path):
     """ convert a MD cover to a PDF """
 
-    call(["pandoc", "--from", "markdown", "--output", output_pdf_path, input_md_path], cwd=tempfile.gettempdir())
+    # The cover images are copied next to the MD cover.
+    call(["pandoc", "--from", "markdown", "--output", output_pdf_path, input_md_path], cwd=os.path.dirname(input_md_path))
 
 
 def merge_cover_with_content(pdf_files_list, output_pdf):
@@ -410,27 +869,307 @@ def normalize_file_extension(filepath):
     return filename + file_extension
 
 
+def build_pdf(
+    input_conf_file, output_pdf_file, cover_metadata_file=None, jobs=1, 
+    preprocessing_cache=None, pandoc_backend=None, developer_mode=False, 
+    inprocess_filters=False, check_links=False, offline=False, 
+    image_report_filepath=None, build_dirpath=None, latex_shards=1, 
+    workdir=None, evict_cache=True
+):
+    """Generate the PDF of the given md2pdf configuration file (see main for
+    the options). The intermediate files are written to workdir (by default
+    the temporal directory). If cover_metadata_file is not given, the cover
+    metadata is generated from the configuration file. The report of the 
+    optimized images (see image_optimizer) is printed if 
+    image_report_filepath is given. The preprocessing and images caches are
+    evicted at the end of the build unless evict_cache is False (i.e. when
+    other documents are being built with them)"""
+    if workdir is None:
+        workdir = tempfile.gettempdir()
+    monolitic_markdown_filepath = os.path.join(workdir,'markdown_to_pdf_temp.md')
+    temp_cover_md_path = os.path.join(workdir,'markdown_to_pdf_cover_temp.md')
+    temp_pdf_path = os.path.join(workdir,'markdown_to_pdf_content_temp.pdf')
+    temp_cover_pdf_path = os.path.join(workdir,'markdown_to_pdf_cover_temp.pdf')
+
+    #check if cover metadata is provided
+    if cover_metadata_file is None:
+        cover_metadata_file = os.path.join(workdir,'default_cover_metadata.yml')
+        generate_default_cover_file(input_conf_file, cover_metadata_file)
+
+    cover_template_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'cover_template')
+
+    shutil.copy2(os.path.join(cover_template_dir, 'cover_img.png'), os.path.join(workdir,'cover_img.png'))
+
+    shutil.copy2(os.path.join(cover_template_dir, 'fiware_logo.png'), os.path.join(workdir,'fiware_logo.png'))
+
+    output_dir = os.path.dirname(output_pdf_file)
+    
+    if '' != output_dir:
+        try:
+            os.makedirs(output_dir)
+        except OSError as exception:
+            if exception.errno != errno.EEXIST:
+                raise
+
+    if image_report_filepath is not None and os.path.exists(image_report_filepath):
+        os.remove(image_report_filepath)
+
+    if preprocessing_cache is not None:
+        preprocessing_cache_hits = preprocessing_cache.hits
+        preprocessing_cache_misses = preprocessing_cache.misses
+
+    markdown_filepaths = get_markdown_filepaths(input_conf_file)
+
+    markdown_sections = build_monolitic_markdown_file(monolitic_markdown_filepath, markdown_filepaths, jobs, preprocessing_cache, pandoc_backend)
+
+    if preprocessing_cache is not None:
+        preprocessing_cache_hits = preprocessing_cache.hits - preprocessing_cache_hits
+        preprocessing_cache_misses = preprocessing_cache.misses - preprocessing_cache_misses
+
+    anchor_index_filepath = os.path.join(workdir, 'markdown_to_pdf_anchor_index.json')
+    check_local_links(monolitic_markdown_filepath, anchor_index_filepath)
+
+    local_image_paths = prefetch_remote_images(monolitic_markdown_filepath, offline)
+
+    if not offline:
+        check_remote_urls(monolitic_markdown_filepath, check_links, local_image_paths.keys())
+
+    # With the cache and incremental parsing, Pandoc parses the Markdown of 
+    # the changed files only.
+    json_ast = None
+    if preprocessing_cache is not None and is_incremental_parsing_enabled():
+        json_ast = build_json_ast(markdown_sections, jobs, preprocessing_cache, pandoc_backend)
+
+    # With the cache and a build directory, Pandoc converts to LaTeX the 
+    # changed files only.
+    latex_fragments_cache = None
+    if json_ast is not None and build_dirpath is not None:
+        latex_fragments_cache = preprocessing_cache
+
+    generate_pdf_from_markdown(temp_pdf_path, monolitic_markdown_filepath,developer_mode, inprocess_filters, build_dirpath, latex_shards, json_ast, latex_fragments_cache, jobs, anchor_index_filepath)
+
+    if image_report_filepath is not None:
+        print(
+            'Image optimization: %d images (%d cached), %d bytes saved, %.1f seconds' % 
+            read_image_optimization_report(image_report_filepath)
+        )
+
+    if generate_md_cover(cover_metadata_file, temp_cover_md_path):
+        render_pdf_cover(temp_cover_md_path, temp_cover_pdf_path)
+        merge_cover_with_content([temp_cover_pdf_path, temp_pdf_path], output_pdf_file)
+    else:
+        shutil.copy2(temp_pdf_path, output_pdf_file)
+
+    print('PDF generated [%s]' % output_pdf_file)
+
+    if preprocessing_cache is not None:
+        print(
+            'Preprocessing cache: %d hits, %d misses' % 
+            (preprocessing_cache_hits, preprocessing_cache_misses)
+        )
+
+    if evict_cache:
+        evict_build_caches(preprocessing_cache)
+
+
+def evict_build_caches(preprocessing_cache=None):
+    """Evict the given preprocessing cache and the images cache (see 
+    ImageOptimizer.close), once no document is being built with them"""
+    if preprocessing_cache is not None:
+        preprocessing_cache.evict()
+
+    image_optimizer = get_image_optimizer()
+    if image_optimizer is not None:
+        image_optimizer.close()
+
+
+def get_batch_documents(manifest_filepath):
+    """Return the (input configuration file, output PDF file, cover metadata
+    file) of every document of the given batch manifest. Paths are relative
+    to the manifest, and the cover metadata file is optional:
+
+        documents:
+          - input: orion/mkdocs.yml
+            output: pdf/orion.pdf
+            cover: orion/cover.yml
+    """
+    import yaml
+    manifest_dirpath = os.path.dirname(manifest_filepath)
+    with open(manifest_filepath, 'rU') as manifest_file:
+        manifest = yaml.load(manifest_file)
+
+    documents = []
+    try:
+        for document in manifest['documents']:
+            documents.append((
+                os.path.normpath(os.path.join(manifest_dirpath, document['input'])),
+                normalize_file_extension(os.path.normpath(os.path.join(manifest_dirpath, document['output']))),
+                os.path.normpath(os.path.join(manifest_dirpath, document['cover'])) if document.get('cover') else None
+            ))
+    except (KeyError, TypeError, AttributeError):
+        raise RuntimeError('Invalid batch manifest [%s]' % manifest_filepath)
+
+    return documents
+
+
+def build_batch(
+    documents, workdir, jobs=1, preprocessing_cache=None, pandoc_backend=None,
+    developer_mode=False, inprocess_filters=False, check_links=False, 
+    offline=False, build_dirpath=None, latex_shards=1
+):
+    """Generate the PDFs of the given documents (see get_batch_documents) in 
+    a single process. The files of all the documents are preprocessed first
+    with a shared pool of jobs processes, and then up to jobs documents are
+    converted to PDF at the same time. Return a list with the error of every
+    document (None for the documents generated)"""
+    # Files shared by several documents are preprocessed once.
+    preprocessing_cache = MemoryCache(preprocessing_cache)
+
+    markdown_filepaths = []
+    for input_conf_file, output_pdf_file, cover_metadata_file in documents:
+        try:
+            markdown_filepaths += get_markdown_filepaths(input_conf_file)
+        except Exception:
+            # Reported when the document is built.
+            pass
+    preprocess_markdown_files(markdown_filepaths, jobs, preprocessing_cache, pandoc_backend)
+
+    document_jobs = []
+    for index, (input_conf_file, output_pdf_file, cover_metadata_file) in enumerate(documents):
+        document_workdir = os.path.join(workdir, str(index))
+        os.makedirs(document_workdir)
+        if build_dirpath is not None:
+            document_build_dirpath = os.path.join(
+                build_dirpath, 
+                '%d-%s' % (index, os.path.splitext(os.path.basename(output_pdf_file))[0])
+            )
+        else:
+            document_build_dirpath = None
+
+        document_jobs.append((
+            input_conf_file, output_pdf_file, cover_metadata_file, 1, 
+            preprocessing_cache, pandoc_backend, developer_mode, 
+            inprocess_filters, check_links, offline, None, 
+            document_build_dirpath, latex_shards, document_workdir, False
+        ))
+
+    # Documents are converted in threads, as LaTeX runs in other processes.
+    pool = ThreadPool(min(jobs, len(document_jobs)) or 1)
+    try:
+        errors = pool.map(build_batch_document_job, document_jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+    # Evicted once all the documents are built, so no document drops the
+    # entries the others are using.
+    evict_build_caches(preprocessing_cache)
+
+    return errors
+
+
+def build_batch_document_job(build_pdf_args):
+    """Run build_pdf with the given arguments. Return the error raised, or 
+    None if the PDF was generated"""
+    try:
+        build_pdf(*build_pdf_args)
+    except Exception as error:
+        print_error('Document [%s] failed - %s' % (build_pdf_args[0], error))
+        return error
+    return None
+
+
+def print_batch_summary(documents, errors):
+    print('Batch summary:')
+    for (input_conf_file, output_pdf_file, cover_metadata_file), error in zip(documents, errors):
+        if error is None:
+            print('  OK      [%s]' % output_pdf_file)
+        else:
+            print('  FAILED  [%s] - %s' % (output_pdf_file, error))
+    print(
+        '%d documents generated, %d failed' % 
+        (errors.count(None), len(errors) - errors.count(None))
+    )
+
+
+def get_watched_filepaths(configuration_filepath, cover_metadata_filepath=None):
+    """Return the files the PDF is generated from: the configuration files,
+    the Markdown files and their local images"""
+    from url_checker import find_markdown_urls
+
+    watched_filepaths = [configuration_filepath]
+    if cover_metadata_filepath is not None:
+        watched_filepaths.append(cover_metadata_filepath)
+
+    try:
+        markdown_filepaths = get_markdown_filepaths(configuration_filepath)
+    except Exception:
+        # The configuration file is being edited.
+        return watched_filepaths
+
+    for markdown_filepath in markdown_filepaths:
+        watched_filepaths.append(markdown_filepath)
+        try:
+            markdown_content = read_markdown_file(markdown_filepath).decode('utf-8')
+        except (IOError, UnicodeDecodeError):
+            continue
+
+        watched_filepaths += [
+            os.path.normpath(os.path.join(os.path.dirname(markdown_filepath), image_path))
+            for image_path in find_markdown_urls(markdown_content)
+            if not is_an_url(image_path)
+        ]
+
+    return watched_filepaths
+
+
+MD2PDF_USAGE = 'Usage: \n\tmd2pdf -i <input-conf-file> -o <output-pdf-file> [-j <jobs>] [--no-cache [--incremental-parsing]] [--inprocess-filters] [--pandoc-backend=<oneshot|server|auto>] [--check-links] [--offline] [--optimize-images [--image-dpi=<dpi>]] [--build-dir=<dir> [--latex-shards=<shards>] [--latex-format]] [--watch] [--workdir=<dir>] [--keep-workdir] [--table-backend=<grid|latex>]\n\tmd2pdf --batch=<manifest-file> [options]\n\tmd2pdf serve [--host=<host>] [--port=<port>] [options]\n\tmd2pdf --version\n\tmd2pdf --help'
+
+
 def main():
-    #first check requirements
-    check_all_requirements()
     # Parse user arguments.
     try:
-        opts, args = getopt.getopt(sys.argv[1:],"i:o:c:",["input=","output=","cover=","develop"])
+        # "md2pdf serve [options]" runs the build server.
+        serve = sys.argv[1:2] == ['serve']
+        opts, args = getopt.getopt(sys.argv[2 if serve else 1:],"i:o:c:j:h",["help","version","input=","output=","cover=","develop","jobs=","no-cache","incremental-parsing","inprocess-filters","pandoc-backend=","check-links","offline","optimize-images","image-dpi=","build-dir=","latex-shards=","latex-format","watch","workdir=","keep-workdir","batch=","host=","port=","table-backend="])
     except getopt.GetoptError as error:
         print(str(error)) 
-        print('Usage: \n\tmd2pdf -i <input-conf-file> -o <output-pdf-file>')
+        print(MD2PDF_USAGE)
         sys.exit(2)
 
     # Default argument values.
     input_conf_file = 'md2pdf.yml'
     output_pdf_file = 'output.pdf'
     cover_metadata_file = None
-    generated_default_cover_metadata_file = os.path.join(tempfile.gettempdir(),'default_cover_metadata.yml')
     developer_mode = False
+    jobs = 1
+    use_cache = True
+    inprocess_filters = False
+    pandoc_backend_name = 'oneshot'
+    check_links = False
+    offline = False
+    optimize_images = False
+    image_dpi = DEFAULT_IMAGE_DPI
+    build_dirpath = None
+    latex_shards = 1
+    latex_format = False
+    incremental_parsing = False
+    watch = False
+    workdir = None
+    keep_workdir = False
+    batch_manifest_file = None
+    server_host = None
+    server_port = None
 
     # Process user arguments.
     for opt, arg in opts:
-        if opt in ("-i", "--input"):
+        if opt in ("-h", "--help"):
+            print(MD2PDF_USAGE)
+            sys.exit(0)
+        elif opt == "--version":
+            print('md2pdf %s' % __version__)
+            sys.exit(0)
+        elif opt in ("-i", "--input"):
             input_conf_file = arg
         elif opt in ("-o", "--output"):
             output_pdf_file = arg
@@ -438,59 +1177,249 @@ def main():
             developer_mode = True
         elif opt in ('--cover', "-c"):
             cover_metadata_file = arg
+        elif opt in ('--jobs', "-j"):
+            try:
+                jobs = int(arg)
+            except ValueError:
+                jobs = 0
+            if jobs < 1:
+                print('ERROR: invalid number of jobs [%s]' % (arg), file=sys.stderr)
+                sys.exit(2)
+        elif opt == '--no-cache':
+            use_cache = False
+        elif opt == '--incremental-parsing':
+            incremental_parsing = True
+            # Builds of the batch and server modes read it from the 
+            # environment too.
+            os.environ['MD2PDF_INCREMENTAL_PARSING'] = '1'
+        elif opt == '--inprocess-filters':
+            inprocess_filters = True
+        elif opt == '--pandoc-backend':
+            if arg not in PANDOC_BACKEND_NAMES:
+                print('ERROR: invalid Pandoc backend [%s]' % (arg), file=sys.stderr)
+                sys.exit(2)
+            pandoc_backend_name = arg
+        elif opt == '--check-links':
+            check_links = True
+        elif opt == '--offline':
+            offline = True
+            # Pandoc filters read it from the environment.
+            os.environ['MD2PDF_OFFLINE'] = '1'
+        elif opt == '--optimize-images':
+            optimize_images = True
+        elif opt == '--image-dpi':
+            try:
+                image_dpi = int(arg)
+            except ValueError:
+                image_dpi = 0
+            if image_dpi < 1:
+                print('ERROR: invalid image DPI [%s]' % (arg), file=sys.stderr)
+                sys.exit(2)
+        elif opt == '--build-dir':
+            build_dirpath = os.path.abspath(arg)
+        elif opt == '--latex-shards':
+            try:
+                latex_shards = int(arg)
+            except ValueError:
+                latex_shards = 0
+            if latex_shards < 1:
+                print('ERROR: invalid number of LaTeX shards [%s]' % (arg), file=sys.stderr)
+                sys.exit(2)
+        elif opt == '--latex-format':
+            latex_format = True
+            # Builds of the batch and server modes read it from the 
+            # environment too.
+            os.environ['MD2PDF_LATEX_FORMAT'] = '1'
+
+        elif opt == '--watch':
+            watch = True
+        elif opt == '--workdir':
+            workdir = arg
+        elif opt == '--keep-workdir':
+            keep_workdir = True
+        elif opt == '--table-backend':
+            if arg not in TABLE_BACKENDS:
+                print('ERROR: invalid table backend [%s]' % (arg), file=sys.stderr)
+                sys.exit(2)
+            # Preprocessing workers and Pandoc filters read it from the 
+            # environment.
+            os.environ['MD2PDF_TABLE_BACKEND'] = arg
+        elif opt == '--batch':
+            batch_manifest_file = arg
+        elif opt == '--host':
+            server_host = arg
+        elif opt == '--port':
+            try:
+                server_port = int(arg)
+            except ValueError:
+                server_port = -1
+            if not 0 <= server_port <= 65535:
+                print('ERROR: invalid port [%s]' % (arg), file=sys.stderr)
+                sys.exit(2)
+
+    if latex_shards > 1 and build_dirpath is None:
+        print('ERROR: --latex-shards requires --build-dir', file=sys.stderr)
+        sys.exit(2)
 
-    #check if cover metadata is provided
-    if cover_metadata_file is None:
-        generate_default_cover_file(input_conf_file, generated_default_cover_metadata_file)
-        cover_metadata_file = generated_default_cover_metadata_file
+    if incremental_parsing and not use_cache:
+        print('ERROR: --incremental-parsing can not be used with --no-cache', file=sys.stderr)
+        sys.exit(2)
+
+    if latex_format and build_dirpath is None:
+        print('ERROR: --latex-format requires --build-dir', file=sys.stderr)
+        sys.exit(2)
 
-    # Check that input file exists.
-    if not os.path.isfile(input_conf_file):
+    # Check requirements (their versions are cached, see ToolchainCache).
+    check_all_requirements(pandoc_backend_name)
+
+    # Check that input files exist.
+    if serve:
+        if watch or batch_manifest_file is not None:
+            print('ERROR: --watch and --batch can not be used with serve', file=sys.stderr)
+            sys.exit(2)
+    elif batch_manifest_file is not None:
+        if not os.path.isfile(batch_manifest_file):
+            print('ERROR: batch manifest [%s] not found' % (batch_manifest_file), file=sys.stderr)
+            sys.exit(2)
+        if watch:
+            print('ERROR: --watch can not be used with --batch', file=sys.stderr)
+            sys.exit(2)
+    elif not os.path.isfile(input_conf_file):
         print('ERROR: input file [%s] not found' % (input_conf_file), file=sys.stderr)
         sys.exit(2)
 
+    # Every build uses its own work directory, so concurrent builds do not 
+    # overwrite each other's files.
+    if workdir is None:
+        workdir = tempfile.mkdtemp(prefix='md2pdf-')
+        remove_workdir = not keep_workdir
+    else:
+        workdir = os.path.abspath(workdir)
+        if not os.path.isdir(workdir):
+            os.makedirs(workdir)
+        remove_workdir = False
+
     # Normalize output filepath
     output_pdf_file = normalize_file_extension(output_pdf_file)
 
     # Set auxiliar file paths.
-    temp_dirpath = tempfile.gettempdir()
-    monolitic_markdown_filepath = os.path.join(temp_dirpath,'markdown_to_pdf_temp.md')
-    temp_cover_md_path = os.path.join(temp_dirpath,'markdown_to_pdf_cover_temp.md')
-    temp_pdf_path = os.path.join(temp_dirpath,'markdown_to_pdf_content_temp.pdf')
-    temp_cover_pdf_path = os.path.join(temp_dirpath,'markdown_to_pdf_cover_temp.pdf')
-    cover_template_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'cover_template')
-
-    shutil.copy2(os.path.join(cover_template_dir, 'cover_img.png'), os.path.join(temp_dirpath,'cover_img.png'))
-
-    shutil.copy2(os.path.join(cover_template_dir, 'fiware_logo.png'), os.path.join(temp_dirpath,'fiware_logo.png'))
-    
-    output_dir = os.path.dirname(output_pdf_file)
-    
-    if '' != output_dir:
-        try:
-            os.makedirs(output_dir)
-        except OSError as exception:
-            if exception.errno != errno.EEXIST:
-                raise
+    image_report_path = None
     
+    if optimize_images:
+        if is_image_optimization_available():
+            # Pandoc filters read the configuration from the environment.
+            os.environ['MD2PDF_IMAGE_DPI'] = str(image_dpi)
+            if not serve:
+                image_report_path = os.path.join(workdir,'markdown_to_pdf_image_report.jsonl')
+                os.environ['MD2PDF_IMAGE_REPORT'] = image_report_path
+        else:
+            print_warning('Pillow is not installed, images will not be optimized')
 
-    try:
-        markdown_filepaths = get_markdown_filepaths(input_conf_file)
-
-        build_monolitic_markdown_file(monolitic_markdown_filepath, markdown_filepaths)
-
-        generate_pdf_from_markdown(temp_pdf_path, monolitic_markdown_filepath,developer_mode)
+    if watch and build_dirpath is None:
+        # LaTeX is compiled incrementally in a build directory of the project.
+        build_dirpath = os.path.join(
+            get_cache_dirpath(), 'builds', generate_cache_key(os.path.abspath(output_pdf_file))
+        )
 
-        if generate_md_cover(cover_metadata_file, temp_cover_md_path):
-            render_pdf_cover(temp_cover_md_path, temp_cover_pdf_path)
-            merge_cover_with_content([temp_cover_pdf_path, temp_pdf_path], output_pdf_file)
+    pandoc_backend = None
+    try:
+        if use_cache:
+            preprocessing_cache = FileCache(os.path.join(get_cache_dirpath(), 'files'))
         else:
-            shutil.copy2(temp_pdf_path, output_pdf_file)
-
-        print('PDF generated [%s]' % output_pdf_file)
+            preprocessing_cache = None
+
+        if watch or serve:
+            # Per-file results are kept in memory between rebuilds.
+            preprocessing_cache = MemoryCache(preprocessing_cache)
+
+        pandoc_backend = create_pandoc_backend(pandoc_backend_name, inprocess_filters)
+
+        if serve:
+            def build_job_pdf(input_conf_file, output_pdf_file, cover_metadata_file, job_workdir):
+                # Documents built from a path of the server reuse their 
+                # LaTeX build directory (uploaded ones have a new path).
+                if build_dirpath is not None and not input_conf_file.startswith(job_workdir):
+                    job_build_dirpath = os.path.join(
+                        build_dirpath, generate_cache_key(os.path.abspath(input_conf_file))
+                    )
+                else:
+                    job_build_dirpath = None
+                build_pdf(
+                    input_conf_file, output_pdf_file, cover_metadata_file,
+                    1, preprocessing_cache, pandoc_backend, developer_mode, 
+                    inprocess_filters, check_links, offline, None, 
+                    job_build_dirpath, latex_shards if job_build_dirpath else 1, 
+                    job_workdir, evict_cache=False
+                )
+
+            # Jobs run at the same time share the caches, so they are 
+            # evicted when the server has no job left (see BuildServer).
+            def evict_server_caches():
+                evict_build_caches(preprocessing_cache)
+
+            from build_server import BUILD_SERVER_DEFAULT_HOST, BUILD_SERVER_DEFAULT_PORT, run_build_server
+            run_build_server(
+                (
+                    server_host if server_host is not None else BUILD_SERVER_DEFAULT_HOST,
+                    server_port if server_port is not None else BUILD_SERVER_DEFAULT_PORT
+                ),
+                build_job_pdf, workdir, jobs, evict_server_caches
+            )
+
+        if batch_manifest_file is not None:
+            documents = get_batch_documents(batch_manifest_file)
+            errors = build_batch(
+                documents, workdir, jobs, preprocessing_cache, pandoc_backend,
+                developer_mode, inprocess_filters, check_links, offline, 
+                build_dirpath, latex_shards
+            )
+            if image_report_path is not None:
+                print(
+                    'Image optimization: %d images (%d cached), %d bytes saved, %.1f seconds' % 
+                    read_image_optimization_report(image_report_path)
+                )
+            print_batch_summary(documents, errors)
+            if errors.count(None) != len(errors):
+                exit(1)
+
+        while batch_manifest_file is None and not serve:
+            watched_filepaths_state = get_filepaths_state(
+                get_watched_filepaths(input_conf_file, cover_metadata_file)
+            )
+
+            try:
+                build_pdf(
+                    input_conf_file, output_pdf_file, cover_metadata_file,
+                    jobs, preprocessing_cache, pandoc_backend, developer_mode, 
+                    inprocess_filters, check_links, offline, image_report_path, 
+                    build_dirpath, latex_shards, workdir
+                )
+            except Exception as error:
+                # Keep watching after failed builds (i.e. a file being edited).
+                if not watch:
+                    raise
+                print_error(error)
+
+            if not watch:
+                break
+
+            print('Watching %d files for changes (press Ctrl+C to stop)...' % len(watched_filepaths_state))
+            for changed_filepath in wait_for_changes(watched_filepaths_state):
+                print('File changed [%s]' % changed_filepath)
     except RuntimeError as error:
         print_error(error)
         exit(1)
+    except KeyboardInterrupt:
+        if not (watch or serve):
+            raise
+    finally:
+        if pandoc_backend is not None:
+            pandoc_backend.close()
+
+        if remove_workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+        else:
+            print('Work directory kept [%s]' % workdir)
 
 
 if __name__ == "__main__":
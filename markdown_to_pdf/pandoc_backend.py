@@ -0,0 +1,208 @@
+"""Backends running the Pandoc conversions of md2pdf.
+
+OneShotPandocBackend launches a new Pandoc process for every conversion.
+ServerPandocBackend keeps a warm Pandoc server (\"pandoc server\", available
+since Pandoc 3.0) and sends the conversions to it over HTTP, so the Pandoc 
+startup is paid only once per run. Both have the same interface: convert,
+convert_text and close.
+
+Pandoc can not run several conversions in the same process from the command
+line, so there is no pool of warm Pandoc processes.
+"""
+from __future__ import print_function
+import json
+import os
+import socket
+import subprocess
+import threading
+import time
+
+from check_requirements import get_pandoc_version_number, PANDOC_SERVER_MIN_VERSION
+from inprocess_filters import apply_json_filters
+from links_processing import print_warning
+
+
+# Seconds to wait for the Pandoc server to start.
+PANDOC_SERVER_STARTUP_TIMEOUT = 10
+
+PANDOC_BACKEND_NAMES = ['oneshot', 'server', 'auto']
+
+
+def convert_with_inprocess_filters(pandoc_backend, source, to, format, filters, extra_args=()):
+    """Convert the given text with the given Pandoc backend, applying the
+    filters in this process to the Pandoc JSON AST"""
+    json_ast = pandoc_backend.convert_text(source, 'json', format)
+    json_ast = apply_json_filters(json_ast, filters, to)
+    return pandoc_backend.convert_text(json_ast, to, 'json', extra_args=extra_args)
+
+
+class OneShotPandocBackend(object):
+    """Run every conversion in a new Pandoc process.
+
+    When inprocess_filters is True the filters are applied in this process 
+    to the Pandoc JSON AST.
+    """
+    name = 'oneshot'
+    supports_lua_filters = True
+
+    def __init__(self, inprocess_filters=False):
+        self.inprocess_filters = inprocess_filters
+
+    def convert(self, source, to, format, filters=None, extra_args=()):
+        """Convert the given text with Pandoc (as pypandoc.convert does)"""
+        if filters and self.inprocess_filters:
+            return convert_with_inprocess_filters(self, source, to, format, filters, extra_args)
+        else:
+            return self.convert_text(source, to, format, filters, extra_args)
+
+    def convert_text(self, source, to, format, filters=None, extra_args=()):
+        """Run a single Pandoc conversion"""
+        # Imported here because importing pypandoc slows down the start of
+        # md2pdf.
+        import pypandoc
+        return pypandoc.convert(source, to, format=format, filters=filters, extra_args=extra_args)
+
+    def close(self):
+        pass
+
+
+class ServerPandocBackend(object):
+    """Run the conversions in a long-lived Pandoc server.
+
+    The server does not run filters nor accept command line arguments, so 
+    filters are always applied in-process and Lua filters are not supported.
+    Instances can be pickled and passed to worker processes, which then 
+    share the server started by the main process.
+    """
+    name = 'server'
+    supports_lua_filters = False
+
+    def __init__(self, port, process=None):
+        self.port = port
+        self.process = process
+        self.connections = threading.local()
+
+    def __getstate__(self):
+        return {'port': self.port}
+
+    def __setstate__(self, state):
+        self.__init__(state['port'])
+
+    @classmethod
+    def start(cls):
+        """Start a Pandoc server and return a backend using it"""
+        if get_pandoc_version_number() < PANDOC_SERVER_MIN_VERSION:
+            raise RuntimeError('Pandoc server requires Pandoc >= 3.0')
+
+        port = get_free_port()
+        with open(os.devnull, 'w') as devnull:
+            process = subprocess.Popen(
+                ["pandoc", "server", "--port", str(port)],
+                stdout=devnull,
+                stderr=devnull
+            )
+        backend = cls(port, process)
+
+        # Imported here because httplib is slow to import and only the server
+        # backend needs it.
+        import httplib
+
+        # Wait until the server answers a real conversion.
+        start_time = time.time()
+        while True:
+            try:
+                backend.convert_text(u'md2pdf', 'markdown', 'markdown')
+                return backend
+            except (RuntimeError, socket.error, httplib.HTTPException) as error:
+                if process.poll() is not None or time.time() - start_time > PANDOC_SERVER_STARTUP_TIMEOUT:
+                    backend.close()
+                    raise RuntimeError('Pandoc server failed to start - %s' % error)
+                time.sleep(0.1)
+
+    def get_connection(self):
+        # A persistent HTTP connection per thread.
+        if getattr(self.connections, 'connection', None) is None:
+            import httplib
+            self.connections.connection = httplib.HTTPConnection('127.0.0.1', self.port)
+        return self.connections.connection
+
+    def convert(self, source, to, format, filters=None, extra_args=()):
+        """Convert the given text with Pandoc (as pypandoc.convert does)"""
+        if filters:
+            return convert_with_inprocess_filters(self, source, to, format, filters, extra_args)
+        else:
+            return self.convert_text(source, to, format, extra_args=extra_args)
+
+    def convert_text(self, source, to, format, filters=None, extra_args=()):
+        """Run a single Pandoc conversion in the server"""
+        if filters or extra_args:
+            raise ValueError('Pandoc server does not support filters nor extra arguments')
+
+        if isinstance(source, str):
+            source = source.decode('utf-8')
+
+        # The Pandoc command line converts tabs before reading its input. 
+        request_body = json.dumps({
+            'text': source.expandtabs(4),
+            'from': format,
+            'to': to
+        })
+
+        connection = self.get_connection()
+        try:
+            connection.request(
+                'POST', '/', request_body,
+                {'Content-Type': 'application/json', 'Accept': 'application/json'}
+            )
+            response = connection.getresponse()
+            response_body = response.read()
+        except:
+            connection.close()
+            self.connections.connection = None
+            raise
+
+        if response.status != 200:
+            raise RuntimeError(
+                'Pandoc server failed with status "%s" during conversion: %s' % 
+                (response.status, response_body)
+            )
+
+        output = json.loads(response_body)['output']
+        # The Pandoc command line ends its output with a new line.
+        if not output.endswith('\n'):
+            output += '\n'
+        return output
+
+    def close(self):
+        if self.process is not None:
+            if self.process.poll() is None:
+                self.process.terminate()
+            self.process.wait()
+            self.process = None
+
+
+def get_free_port():
+    """Return a free TCP port of the local host"""
+    free_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    free_socket.bind(('127.0.0.1', 0))
+    port = free_socket.getsockname()[1]
+    free_socket.close()
+    return port
+
+
+def create_pandoc_backend(backend_name='oneshot', inprocess_filters=False):
+    """Return the Pandoc backend with the given name (see 
+    PANDOC_BACKEND_NAMES).
+
+    "server" and "auto" fall back to OneShotPandocBackend when the Pandoc 
+    server can not be started ("server" prints a warning).
+    """
+    if backend_name in ('server', 'auto'):
+        try:
+            return ServerPandocBackend.start()
+        except (RuntimeError, OSError) as error:
+            if backend_name == 'server':
+                print_warning(str(error))
+                print_warning('Using one Pandoc process per conversion')
+
+    return OneShotPandocBackend(inprocess_filters)
@@ -1,7 +1,9 @@
 #!/usr/bin/env python
 
 from pandocfilters import *
+from json_ast import run_json_filter
 import re
+import copy
 from links_processing import *
 
 
@@ -77,20 +79,23 @@ def header_children_filter(key, value, format, meta):
 
 def pandoc_filter(key, value, format, meta):
     """Filter applied by Pandoc when converting from Mardown to PDF"""
+    # Links and images have attributes before their content and target
+    # since Pandoc 1.16, so both are read from the end of their value.
     if key == 'Link':
-        value[1][0] = process_link_destination(value[1][0], pandoc_filter.current_file)
-        if len(value[1][0]) == 0:
+        value[-1][0] = resolve_link_destination(value[-1][0], meta)
+        if len(value[-1][0]) == 0:
             print_warning(
                 "Found empty link ([%s]()) in file [%s]" % 
-                (stringify(value[0]), pandoc_filter.current_file)
+                (stringify(value[-2]), pandoc_filter.current_file)
             )
         # Process link children in AST tree
-        value[0] = walk(value[0],pandoc_filter,format,meta)
-        return Link(value[0],value[1])
+        value[-2] = walk(value[-2],pandoc_filter,format,meta)
+        return {'t': 'Link', 'c': value}
     elif key == 'Image':
-        src_image_path = value[1][0]
-        value[1][0] = make_image_path_absolute(value[1][0], pandoc_filter.current_file)
-        if is_image_broken(value[1][0]):
+        src_image_path = value[-1][0]
+        value[-1][0] = make_image_path_absolute(value[-1][0], pandoc_filter.current_file)
+        value[-1][0] = get_prefetched_image_path(value[-1][0])
+        if is_image_broken(value[-1][0]):
             print_warning(
                 (
                 'Ignoring local image not found [%s] in file [%s]' +
@@ -102,9 +107,21 @@ def pandoc_filter(key, value, format, meta):
             )
             return RawInline('tex', print_image_not_found(src_image_path.encode('utf-8')))
         else:
-            return Image(value[0],value[1])
+            return {'t': 'Image', 'c': value}
     elif key == 'Header':
         return header_filter(value,format,meta,pandoc_filter.current_file)
+    elif key == 'Table' and get_filter_table_backend() == 'latex':
+        # Imported here because it imports the hyphenator, which would slow
+        # down the start of the filter for documents without tables.
+        from latex_tables import table_to_latex
+
+        # The filter changes links and images in place, so a copy of the 
+        # table is walked: tables which can not be rendered as longtables 
+        # (table_to_latex returns None) are left untouched to Pandoc, and
+        # their children are filtered once, as any other node.
+        latex_table = table_to_latex(walk(copy.deepcopy(value), pandoc_filter, format, meta))
+        if latex_table is not None:
+            return RawBlock('latex', latex_table)
     elif key == 'RawInline' and value[0] == 'html':
         html_filter_result = html_inline_filter(value, pandoc_filter.current_file,True)
         if html_filter_result is not None:
@@ -116,10 +133,51 @@ def pandoc_filter(key, value, format, meta):
             return None
     
 pandoc_filter.current_file = ''
+pandoc_filter.table_backend = None
+pandoc_filter.anchor_index = None
+
+
+def get_filter_anchor_index(meta):
+    """Return the AnchorIndex of the document, read once per document from 
+    the file given in its metadata, or None if md2pdf gives none"""
+    if pandoc_filter.anchor_index is None and ANCHOR_INDEX_METADATA_FIELD in meta:
+        # Imported here because documents not built by md2pdf have no index.
+        from anchor_index import load_anchor_index
+        pandoc_filter.anchor_index = load_anchor_index(meta[ANCHOR_INDEX_METADATA_FIELD]['c'])
+    return pandoc_filter.anchor_index
+
+
+def resolve_link_destination(link_destination, meta):
+    """Return the destination of the given link of the current file in the 
+    document, looked up in the anchor index of the document if any"""
+    anchor_index = get_filter_anchor_index(meta)
+    if anchor_index is None:
+        return process_link_destination(link_destination, pandoc_filter.current_file)
+    return anchor_index.resolve_link(pandoc_filter.current_file, link_destination)
+
+
+def get_filter_table_backend():
+    """Return the table backend (see get_table_backend), read once per 
+    document by the filter"""
+    if pandoc_filter.table_backend is None:
+        # Imported here because the filter starts for every conversion, 
+        # and documents without tables never need it.
+        from convert_md_tables import get_table_backend
+        pandoc_filter.table_backend = get_table_backend()
+    return pandoc_filter.table_backend
+
+
+def reset_filter_state():
+    """Reset the state kept by the filter between Pandoc nodes, so it can be 
+    applied again to another document in the same process"""
+    pandoc_filter.current_file = ''
+    pandoc_filter.table_backend = None
+    pandoc_filter.anchor_index = None
+    header_filter.used_ids = {}
 
 
 def main():
-    toJSONFilter(pandoc_filter)
+    run_json_filter(pandoc_filter)
 
 
 if __name__ == "__main__":
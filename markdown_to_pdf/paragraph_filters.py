@@ -1,10 +1,7 @@
 #!/usr/bin/env python
 
 from pandocfilters import *
-import re
-from links_processing import *
-import pprint
-
+from json_ast import run_json_filter
 
 
 def pandoc_filter(key, value, format, meta):
@@ -37,7 +34,7 @@ pandoc_filter.current_file = ''
 
 
 def main():
-    toJSONFilter(pandoc_filter)
+    run_json_filter(pandoc_filter)
 
 
 if __name__ == "__main__":
@@ -1,7 +1,77 @@
 #!/usr/bin/env python
 
 import unittest
+import shutil
+import subprocess
+import json
+import threading
+import BaseHTTPServer
+import httplib
+import io
+import tarfile
+import SocketServer
+import time
+import tempfile
 from markdown_to_pdf import *
+from url_checker import *
+from asset_cache import *
+from image_optimizer import *
+from latex_shards import *
+from watch import *
+from build_server import *
+from line_preprocessor import *
+from latex_tables import *
+from anchor_index import *
+from json_ast import *
+from latex_fragments import *
+from latex_format import *
+from hyphenate import *
+from version import __version__
+
+MARKDOWN_EXAMPLES_DIRPATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'markdown_examples'
+)
+
+
+def get_markdown_examples():
+    """Return the distinct contents of the Markdown files in markdown_examples/"""
+    markdown_examples = {}
+    for dirpath, dirnames, filenames in os.walk(MARKDOWN_EXAMPLES_DIRPATH):
+        for filename in sorted(filenames):
+            if filename.endswith('.md'):
+                markdown_content = read_markdown_file(os.path.join(dirpath, filename))
+                markdown_examples[markdown_content] = os.path.join(dirpath, filename)
+    return [(filepath, content) for content, filepath in sorted(markdown_examples.items())]
+
+
+def is_pandoc_version_available(min_version):
+    try:
+        return get_pandoc_version_number() >= min_version
+    except (OSError, subprocess.CalledProcessError):
+        return False
+
+
+class FakePandocBackend(object):
+    """Pandoc backend returning the text given (pickable, so it can be used
+    by worker processes)"""
+    supports_lua_filters = False
+
+    def convert(self, source, to, format, filters=None, extra_args=()):
+        return source
+
+    def close(self):
+        pass
+
+
+class FailingPandocBackend(FakePandocBackend):
+    """Pandoc backend failing to convert the texts containing "fail" 
+    (pickable, see FakePandocBackend)"""
+    def convert(self, source, to, format, filters=None, extra_args=()):
+        if 'fail' in source:
+            raise RuntimeError('Pandoc failed')
+        return source
+
 
 def local_link_callback(link, markdown_filepath):
     if link[0] == '#':
@@ -35,6 +105,101 @@ class TestMarkdownToPdf( unittest.TestCase ):
         self.assertEqual( slugify_string( 'String' ), 'string' )
         self.assertEqual( slugify_string( 'String with spaces' ), 'string-with-spaces' )
         self.assertEqual( slugify_string( '1?2<3>4?5(6)7&8"9\'10=11/12' ), '123456789101112' )
+        self.assertEqual( slugify_string( '\xc3\x87a va? S\xc3\xad_se\xc3\xb1or  #1' ), 'ca-va-si-senor-1' )
+        self.assertEqual( slugify( u'\xc7a va? S\xed_se\xf1or  #1', '_' ), u'ca_va_si_senor_1' )
+        self.assertEqual( slugify( u'  --A -- b--  ', '-' ), u'-a-b-' )
+
+
+    def test_pandoc_filters_startup_imports(self):
+        # Pandoc launches the filters for every conversion, so they must not
+        # import heavy modules until a node needs them.
+        imported_modules = subprocess.check_output(
+            [
+                sys.executable, '-c',
+                'import sys, pandoc_filters, paragraph_filters; ' +
+                'print(" ".join(sorted(module for module in ("markdown", "hyphenate", "urllib2", "pprint", "tempfile", "convert_md_tables", "latex_tables") if module in sys.modules)))'
+            ],
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        )
+        self.assertEqual(imported_modules.strip(), '')
+
+
+    def test_md2pdf_version_and_help(self):
+        # --version and --help neither import heavy modules nor check the
+        # required tools.
+        for option, expected_output in (('--version', 'md2pdf %s' % __version__), ('--help', 'Usage:')):
+            output = subprocess.check_output(
+                [
+                    sys.executable, '-c',
+                    'import sys, markdown_to_pdf\nsys.argv = ["md2pdf", "%s"]\n' % option +
+                    'try:\n    markdown_to_pdf.main()\nexcept SystemExit:\n    pass\n' +
+                    'print("Imported: " + " ".join(sorted(module for module in ("yaml", "pypandoc", "urllib2", "httplib", "PIL") if module in sys.modules)))'
+                ],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                env=dict(os.environ, PATH='')
+            )
+            self.assertIn(expected_output, output)
+            self.assertEqual(output.splitlines()[-1].strip(), 'Imported:')
+
+
+    def test_get_tool_version(self):
+        temp_dirpath = tempfile.mkdtemp()
+        original_environ = dict(os.environ)
+        os.environ['MD2PDF_CACHE_DIR'] = os.path.join(temp_dirpath, 'cache')
+        os.environ['PATH'] = temp_dirpath
+        try:
+            tool_filepath = os.path.join(temp_dirpath, 'fake-tool')
+            calls_filepath = os.path.join(temp_dirpath, 'calls')
+            def write_tool(version):
+                with open(tool_filepath, 'w') as tool_file:
+                    tool_file.write('#!/bin/sh\necho >> %s\necho\necho "fake-tool %s"\necho "Copyright"\n' % (calls_filepath, version))
+                os.chmod(tool_filepath, 0755)
+            def count_calls():
+                with open(calls_filepath) as calls_file:
+                    return len(calls_file.readlines())
+
+            get_toolchain_cache.cache = None
+            write_tool('1.0')
+            self.assertEqual(get_tool_version('fake-tool'), 'fake-tool 1.0')
+            self.assertEqual(get_tool_version('fake-tool'), 'fake-tool 1.0')
+            self.assertEqual(count_calls(), 1)
+
+            # The version is cached across processes.
+            get_toolchain_cache.cache = None
+            self.assertEqual(get_tool_version('fake-tool'), 'fake-tool 1.0')
+            self.assertEqual(count_calls(), 1)
+
+            # Updated tools are run again.
+            write_tool('2.0')
+            os.utime(tool_filepath, (0, 0))
+            self.assertEqual(get_tool_version('fake-tool'), 'fake-tool 2.0')
+            self.assertEqual(count_calls(), 2)
+
+            self.assertIsNone(get_tool_version('missing-tool'))
+        finally:
+            get_toolchain_cache.cache = None
+            os.environ.clear()
+            os.environ.update(original_environ)
+            shutil.rmtree(temp_dirpath)
+
+
+    def test_check_pandoc_backend_supported(self):
+        original_pandoc_version = get_pandoc_version.version
+        original_stdout = sys.stdout
+        try:
+            sys.stdout = io.BytesIO()
+            get_pandoc_version.version = 'pandoc 1.15.1'
+            with self.assertRaises(SystemExit):
+                check_pandoc_backend_supported('server')
+            self.assertIn('--pandoc-backend=server requires Pandoc >= 3.0 (installed: pandoc 1.15.1)', sys.stdout.getvalue())
+            check_pandoc_backend_supported('auto')
+            check_pandoc_backend_supported('oneshot')
+
+            get_pandoc_version.version = 'pandoc 3.1.2'
+            check_pandoc_backend_supported('server')
+        finally:
+            sys.stdout = original_stdout
+            get_pandoc_version.version = original_pandoc_version
 
 
     def test_prevent_latex_images_floating(self):
@@ -68,6 +233,98 @@ class TestMarkdownToPdf( unittest.TestCase ):
         self.assertEqual( user_ids, { 'header': 3, 'new-header': 2 } )
 
 
+    def test_build_anchor_index(self):
+        markdown_content = u'\n'.join([
+            u'<md2pdf:file:doc/a.md/>', u'', u'\\newpage', u'', u'\\anchor{docamd}', u'',
+            u'# T\xedtulo con `c\xf3digo` y [enlace](b.md)', u'',
+            u'A [link to b](b.md#second-header) and [self](#t\xedtulo-con-c\xf3digo-y-enlace), [a',
+            u'wrapped link](#dup).', u'',
+            u'## Dup', u'', u'## Dup', u'',
+            u'[Second dup](#dup-1), [missing](#nope), <a name="custom"></a> [anchor](#custom).', u'',
+            u'```', u'[fenced code](#in-code)', u'# Not a header', u'```', u'',
+            u'    [indented code](#in-indented-code)', u'',
+            u'- item with [link](b.md)', u'',
+            u'    paragraph in the item with [link](#dup)', u'',
+            u'        [code in the item](#in-item-code)', u'',
+            u'[![image](image.png)](#dup) `[code](#in-code-span)` [mail](mailto:a@b.c) [web](http://www.example.com)', u'',
+            u'<md2pdf:file:doc/b.md/>', u'', u'\\newpage', u'', u'\\anchor{docbmd}', u'',
+            u'Title B', u'=======', u'',
+            u'Second header \\*', u'----------------', u'',
+            u'[back](a.md#dup) [gone](c.md)'
+        ])
+        anchor_index = build_anchor_index(markdown_content)
+
+        self.assertEqual(anchor_index.anchors, set([
+            'docamd', 'docamdtitulo-con-codigo-y-enlace', 'docamddup', 'docamddup-1', 'docamdcustom',
+            'docbmd', 'docbmdtitle-b', 'docbmdsecond-header'
+        ]))
+        self.assertEqual(
+            [(filepath, link_destination) for filepath, link_destination, label in anchor_index.links],
+            [
+                (u'doc/a.md', u'b.md'), (u'doc/a.md', u'b.md#second-header'),
+                (u'doc/a.md', u'#t\xedtulo-con-c\xf3digo-y-enlace'), (u'doc/a.md', u'#dup'),
+                (u'doc/a.md', u'#dup-1'), (u'doc/a.md', u'#nope'), (u'doc/a.md', u'#custom'),
+                (u'doc/a.md', u'b.md'), (u'doc/a.md', u'#dup'), (u'doc/a.md', u'#dup'),
+                (u'doc/a.md', u'mailto:a@b.c'), (u'doc/b.md', u'a.md#dup'), (u'doc/b.md', u'c.md')
+            ]
+        )
+        self.assertEqual(
+            anchor_index.get_broken_links(),
+            [(u'doc/a.md', u'#nope'), (u'doc/a.md', u'mailto:a@b.c'), (u'doc/b.md', u'c.md')]
+        )
+
+
+    def test_build_anchor_index_header_in_code_block(self):
+        markdown_content = u'\n'.join([
+            u'<md2pdf:file:a.md/>', u'',
+            u'## Dup', u'',
+            u'```', u'## Dup', u'```', u'',
+            u'```bash', u'Not a header', u'------------', u'```', u'',
+            u'[first](#dup) [second](#dup-1) [code](#not-a-header)'
+        ])
+        anchor_index = build_anchor_index(markdown_content)
+
+        # Headers inside code blocks are not headers for Pandoc.
+        self.assertEqual(anchor_index.anchors, set(['amd', 'amddup']))
+        self.assertEqual(
+            anchor_index.get_broken_links(),
+            [(u'a.md', u'#dup-1'), (u'a.md', u'#not-a-header')]
+        )
+
+
+    def test_pandoc_filter_anchor_index(self):
+        temp_dirpath = tempfile.mkdtemp()
+        try:
+            anchor_index = build_anchor_index(u'<md2pdf:file:doc/a.md/>\n\n# A\n\n[self](#a) [b](b.md)\n')
+            # The filter looks the links up in the saved index.
+            anchor_index.links[0] = (u'doc/a.md', u'#a', u'indexed')
+            anchor_index_filepath = os.path.join(temp_dirpath, 'anchor_index.json')
+            anchor_index.save(anchor_index_filepath)
+            self.assertEqual(load_anchor_index(anchor_index_filepath).link_labels, {
+                (u'doc/a.md', u'#a'): u'indexed', (u'doc/a.md', u'b.md'): u'docbmd'
+            })
+
+            def link(destination):
+                return {'t': 'Link', 'c': [['', [], []], [{'t': 'Str', 'c': 'text'}], [destination, '']]}
+            json_ast = {'pandoc-api-version': [1, 23], 'meta': {}, 'blocks': [{'t': 'Para', 'c': [
+                {'t': 'RawInline', 'c': ['html', '<md2pdf:file:doc/a.md/>']},
+                link(u'#a'), link(u'b.md'), link(u'#not-indexed')
+            ]}]}
+            filtered_json_ast = apply_document_filters(
+                json_ast, ['md2pdf_pandoc_filter'], 'latex',
+                {ANCHOR_INDEX_METADATA_FIELD: {'t': 'MetaString', 'c': anchor_index_filepath}}
+            )
+
+            self.assertEqual(
+                [inline['c'][2][0] for inline in filtered_json_ast['blocks'][0]['c'][1:]],
+                [u'#indexed', u'#docbmd', process_link_destination(u'#not-indexed', u'doc/a.md')]
+            )
+            # The index is not kept in the metadata of the document.
+            self.assertEqual(filtered_json_ast['meta'], {})
+        finally:
+            shutil.rmtree(temp_dirpath)
+
+
     def test_make_image_path_absolute(self):
         prefix = os.path.join(os.getcwd(),'rel-dir')
 
@@ -162,7 +419,165 @@ class TestMarkdownToPdf( unittest.TestCase ):
             False
         )
 
-   
+
+    def test_hyphenator(self):
+        hyphenator = Hyphenator(
+            '.ach4 .ad4der 4ab. a5bal a5ban hy3ph he2n hena4 hen5at 1na n2at 1tio 2io o2n',
+            'ta-ble',
+            memo_size=2
+        )
+        self.assertEqual(hyphenator.hyphenate_word('hyphenation'), ['hy', 'phen', 'ation'])
+        self.assertEqual(hyphenator.hyphenate_word('Tables'), ['Tables'])
+        self.assertEqual(hyphenator.hyphenate_word('table'), ['ta', 'ble'])
+        self.assertEqual(hyphenator.hyphenate_word('word'), ['word'])
+
+        # Only the most recently used words are remembered.
+        self.assertEqual(list(hyphenator.memo.keys()), ['Tables', 'table'])
+        hyphenator.hyphenate_word('Tables')
+        hyphenator.hyphenate_word('hyphenation')
+        self.assertEqual(list(hyphenator.memo.keys()), ['Tables', 'hyphenation'])
+
+        # The compiled patterns give the same pieces.
+        compiled_hyphenator = Hyphenator.from_compiled(hyphenator.compile())
+        self.assertEqual(compiled_hyphenator.hyphenate_word('hyphenation'), ['hy', 'phen', 'ation'])
+        self.assertEqual(compiled_hyphenator.hyphenate_word('table'), ['ta', 'ble'])
+        self.assertRaises(ValueError, Hyphenator.from_compiled, 'foo')
+
+
+    def test_load_hyphenator(self):
+        cache_dirpath = tempfile.mkdtemp()
+        original_cache_dirpath = os.environ.get('MD2PDF_CACHE_DIR')
+        os.environ['MD2PDF_CACHE_DIR'] = cache_dirpath
+        try:
+            self.assertEqual(
+                load_hyphenator('hy3ph he2n hena4 hen5at 1na n2at 1tio 2io o2n', '').hyphenate_word('hyphenation'),
+                ['hy', 'phen', 'ation']
+            )
+            hyphenation_dirpath = os.path.join(cache_dirpath, 'hyphenation')
+            self.assertEqual(len(os.listdir(hyphenation_dirpath)), 1)
+
+            # The next loads use the compiled patterns.
+            compiled_patterns_filepath = os.path.join(hyphenation_dirpath, os.listdir(hyphenation_dirpath)[0])
+            with open(compiled_patterns_filepath, 'wb') as compiled_patterns_file:
+                compiled_patterns_file.write(Hyphenator('hy1phen1ation', '').compile())
+            self.assertEqual(
+                load_hyphenator('hy3ph he2n hena4 hen5at 1na n2at 1tio 2io o2n', '').hyphenate_word('hyphenation'),
+                ['hy', 'phen', 'ation']
+            )
+            self.assertEqual(
+                load_hyphenator('hy3ph he2n hena4 hen5at 1na n2at 1tio 2io o2n', '').patterns,
+                Hyphenator('hy1phen1ation', '').patterns
+            )
+
+            # Invalid compiled patterns are replaced.
+            with open(compiled_patterns_filepath, 'wb') as compiled_patterns_file:
+                compiled_patterns_file.write('foo')
+            self.assertEqual(
+                load_hyphenator('hy3ph he2n hena4 hen5at 1na n2at 1tio 2io o2n', '').patterns,
+                Hyphenator('hy3ph he2n hena4 hen5at 1na n2at 1tio 2io o2n', '').patterns
+            )
+        finally:
+            if original_cache_dirpath is None:
+                del os.environ['MD2PDF_CACHE_DIR']
+            else:
+                os.environ['MD2PDF_CACHE_DIR'] = original_cache_dirpath
+            shutil.rmtree(cache_dirpath)
+
+
+    def test_translate_md_tables_latex_backend(self):
+        # Tables are kept as pipe tables, with missing cells filled.
+        self.assertEqual(
+            translate_md_tables(
+                'Text\n| Name | Value |\n|:---|---:|\n| a | 1 |\n| b |\nText',
+                'latex'
+            ),
+            'Text\n| Name | Value |\n|:---|---:|\n| a | 1 |\n| b ||\nText'
+        )
+
+        # The grid backend is the default one.
+        self.assertEqual(
+            translate_md_tables('| a |\n|---|\n| b |\n'),
+            translate_md_tables('| a |\n|---|\n| b |\n', 'grid')
+        )
+        self.assertTrue(translate_md_tables('| a |\n|---|\n| b |\n').startswith('+---'))
+
+
+    def test_table_to_latex(self):
+        def cell(*inlines):
+            return [{'t': 'Plain', 'c': list(inlines)}]
+
+        # Pandoc < 2.10 table (caption, alignments, widths, header, rows).
+        table = [
+            [],
+            [{'t': 'AlignLeft'}, {'t': 'AlignRight'}],
+            [0, 0],
+            [cell({'t': 'Str', 'c': 'Name'}), cell({'t': 'Str', 'c': 'Cost'})],
+            [
+                [
+                    cell({'t': 'Code', 'c': [['', [], []], 'a_b']}),
+                    cell({'t': 'Str', 'c': '50%'}, {'t': 'Space', 'c': []}, {'t': 'Emph', 'c': [{'t': 'Str', 'c': '&'}]})
+                ],
+                [
+                    cell({'t': 'Link', 'c': [[{'t': 'Str', 'c': 'x'}], ['#anchor', '']]}),
+                    cell({'t': 'Link', 'c': [[{'t': 'Str', 'c': 'y'}], ['http://a.org/#b', '']]})
+                ]
+            ]
+        ]
+        self.assertEqual(
+            table_to_latex(table),
+            '\\begin{longtable}[]{@{}p{0.422\\columnwidth}p{0.528\\columnwidth}@{}}\n'
+            '\\toprule\n'
+            '\\raggedright \\BreakableChar{}Name & \\raggedleft \\BreakableChar{}Cost \\tabularnewline\n'
+            '\\midrule\n'
+            '\\endhead\n'
+            '\\raggedright \\texttt{a\\_b} & \\raggedleft \\BreakableChar{}50\\% \\emph{\\BreakableChar{}\\&} \\tabularnewline\n'
+            '\\raggedright \\hyperref[anchor]{\\BreakableChar{}x} & \\raggedleft \\href{http://a.org/\\#b}{\\BreakableChar{}y} \\tabularnewline\n'
+            '\\bottomrule\n'
+            '\\end{longtable}'
+        )
+
+        # Column widths are proportional to the visible text.
+        table[4][0][0] = cell({'t': 'Str', 'c': 'x' * 30})
+        self.assertTrue(table_to_latex(table).startswith(
+            '\\begin{longtable}[]{@{}p{0.814\\columnwidth}p{0.136\\columnwidth}@{}}'
+        ))
+
+        # Pandoc >= 2.10 table (attributes, caption, column specs, head,
+        # bodies, foot).
+        def row(*cells):
+            return [['', [], []], [[['', [], []], {'t': 'AlignDefault'}, 1, 1, cell_blocks] for cell_blocks in cells]]
+
+        table = [
+            ['', [], []],
+            [None, []],
+            [[{'t': 'AlignCenter'}, {'t': 'ColWidthDefault'}]],
+            [['', [], []], [row(cell({'t': 'Str', 'c': 'Name'}))]],
+            [[['', [], []], 0, [], [row(cell({'t': 'Str', 'c': 'a'}))]]],
+            [['', [], []], []]
+        ]
+        self.assertEqual(
+            table_to_latex(table),
+            '\\begin{longtable}[]{@{}p{0.970\\columnwidth}@{}}\n'
+            '\\toprule\n'
+            '\\centering \\BreakableChar{}Name \\tabularnewline\n'
+            '\\midrule\n'
+            '\\endhead\n'
+            '\\centering \\BreakableChar{}a \\tabularnewline\n'
+            '\\bottomrule\n'
+            '\\end{longtable}'
+        )
+
+        # Tables with merged cells, captions or images are left to Pandoc.
+        table[4][0][3][0][1][0][2] = 2
+        self.assertIsNone(table_to_latex(table))
+        table[4][0][3][0][1][0][2] = 1
+        table[1][1] = [{'t': 'Plain', 'c': [{'t': 'Str', 'c': 'Caption'}]}]
+        self.assertIsNone(table_to_latex(table))
+        table[1][1] = []
+        table[4][0][3][0][1][0][4] = cell({'t': 'Image', 'c': [[], ['a.png', '']]})
+        self.assertIsNone(table_to_latex(table))
+
+
     def test_remove_code_from_line(self):
         test_cases = [
             [
@@ -217,6 +632,17 @@ class TestMarkdownToPdf( unittest.TestCase ):
         self.assertEqual(fix_special_characters_inside_links('http://www.test.com/a\\>aa'),'http://www.test.com/a\\>aa')
         self.assertEqual(fix_special_characters_inside_links('http://www.test.com/a>aa'),'http://www.test.com/a\>aa')
         self.assertEqual(fix_special_characters_inside_links('http://www.test.com/aaa'),'http://www.test.com/aaa')
+        self.assertEqual(fix_special_characters_inside_links('<http://a.com/<b> HTTPS://c.com/>\nhttp:/d.com/<'),'<http://a.com/\<b\> HTTPS://c.com/\>\nhttp:/d.com/<')
+
+
+    def test_fix_special_characters_inside_links_stress(self):
+        # Documents with many URLs are processed in a single pass (without
+        # recursion).
+        markdown_content = '\n'.join('[link %d](http://www.test.com/%d?a<b>)' % (i, i) for i in range(100000))
+        self.assertEqual(
+            fix_special_characters_inside_links(markdown_content),
+            '\n'.join('[link %d](http://www.test.com/%d?a\<b\>)' % (i, i) for i in range(100000))
+        )
 
         
 
@@ -250,6 +676,48 @@ class TestMarkdownToPdf( unittest.TestCase ):
         self.assertEqual(separate_latex_anchors('\\anchor{aaaa}\\anchor'),'\\anchor{aaaa}\\anchor')
 
 
+    def test_fix_markdown_lines(self):
+        self.assertEqual(
+            fix_markdown_lines(u'text\n  ![alt](img.png)\ntext <a href="y" id="x">\n# Title\n  \n  \n\u2003\n'),
+            u'text\n\n  ![alt](img.png)\n\ntext <a href="y" >\n\n# Title\n\n\n\n'
+        )
+        # Code blocks are not modified.
+        self.assertEqual(
+            fix_markdown_lines(u'text\n  ```\n<a id="x">\n# comment\n![alt](img.png)\n  \n   ```\n![alt](img.png)'),
+            u'text\n```\n<a id="x">\n# comment\n![alt](img.png)\n  \n```\n\n![alt](img.png)'
+        )
+
+
+    def test_fix_markdown_lines_examples(self):
+        # Same output than the chain of fixes, but for lines with only
+        # whitespace (some of them were not emptied).
+        for markdown_filepath, markdown_content in get_markdown_examples():
+            markdown_content = markdown_content.decode('utf-8')
+            fixed_markdown_content = fix_empty_lines(markdown_content)
+            fixed_markdown_content = fix_blanck_spaces_before_code_tag(fixed_markdown_content)
+            fixed_markdown_content = remove_ids_from_a(fixed_markdown_content)
+            fixed_markdown_content = fix_html_before_title(fixed_markdown_content)
+            fixed_markdown_content = fix_img_in_new_line(fixed_markdown_content)
+            fixed_markdown_content = fix_new_line_after_img(fixed_markdown_content)
+            self.assertEqual(
+                re.sub(r'(?m)^[ \t]+$', '', fix_markdown_lines(markdown_content)),
+                re.sub(r'(?m)^[ \t]+$', '', fixed_markdown_content),
+                'Fixes differ for [%s]' % markdown_filepath
+            )
+
+
+    def test_fix_normalized_markdown_lines(self):
+        self.assertEqual(
+            fix_normalized_markdown_lines('![a](b.png)\n\\anchor{a}\n\\anchor{b}\n\\anchor{c}\n<a name="x"></a>  \n\nTitle\n====='),
+            '![a](b.png)\\ \n\\anchor{a}\n\n\\anchor{b}\n\n\\anchor{c}\n<a name="x"></a>Title\n====='
+        )
+        # Code blocks are not modified.
+        self.assertEqual(
+            fix_normalized_markdown_lines('```\n![a](b.png)\n\\anchor{a}\n\\anchor{b}\n<a name="x"></a>\nTitle\n-----\n```'),
+            '```\n![a](b.png)\n\\anchor{a}\n\\anchor{b}\n<a name="x"></a>\nTitle\n-----\n```'
+        )
+
+
     def test_add_newlines_before_markdown_headers(self):
         self.assertEqual(add_newlines_before_markdown_headers('text\n```code\n#title asdfs \n asdfasdf\n```'),'text\n```code\n#title asdfs \n asdfasdf\n```')
 
@@ -261,6 +729,517 @@ class TestMarkdownToPdf( unittest.TestCase ):
 
         self.assertEqual(add_newlines_before_markdown_headers('text\n#title asdfs \n asdfasdf'),'text\n\n\n#title asdfs \n asdfasdf')
 
+        self.assertEqual(add_newlines_before_markdown_headers('text\nTitle\n=====\n- item\n--'),'text\n\n\nTitle\n=====\n- item\n--')
+
+        self.assertEqual(add_newlines_before_markdown_headers('#title'),'\n\n#title')
+
+
+    def test_generate_file_section(self):
+        self.assertEqual(
+            generate_file_section('dir/file.md', 'content'),
+            '\n<md2pdf:file:dir/file.md/>\n\n\\newpage\n\n\\anchor{dirfilemd}\n\ncontent\n'
+        )
+
+
+    def test_file_cache(self):
+        cache_dirpath = tempfile.mkdtemp()
+        try:
+            cache = FileCache(cache_dirpath, max_size=10)
+            self.assertEqual(cache.get('a'), None)
+            cache.put('a', '12345')
+            cache.put('b', '12345')
+            self.assertEqual(cache.get('a'), '12345')
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+            # Least recently used entries are evicted first.
+            os.utime(os.path.join(cache_dirpath, 'b'), (0, 0))
+            cache.put('c', '12345')
+            cache.evict()
+            self.assertEqual(cache.get('b'), None)
+            self.assertEqual(cache.get('a'), '12345')
+            self.assertEqual(cache.get('c'), '12345')
+        finally:
+            shutil.rmtree(cache_dirpath)
+
+
+    def test_make_dirs(self):
+        root_dirpath = tempfile.mkdtemp()
+        try:
+            dirpath = os.path.join(root_dirpath, 'cache', 'images')
+            make_dirs(dirpath)
+            # Already created, i.e. by another process.
+            make_dirs(dirpath)
+            self.assertTrue(os.path.isdir(dirpath))
+
+            filepath = os.path.join(root_dirpath, 'file')
+            open(filepath, 'wb').close()
+            self.assertRaises(OSError, make_dirs, os.path.join(filepath, 'cache'))
+        finally:
+            shutil.rmtree(root_dirpath)
+
+
+    def test_file_lock(self):
+        lock_dirpath = tempfile.mkdtemp()
+        try:
+            lock_filepath = os.path.join(lock_dirpath, 'cache', '.lock')
+            events = []
+
+            def lock_file():
+                with file_lock(lock_filepath):
+                    events.append('locked by thread')
+
+            with file_lock(lock_filepath):
+                lock_thread = threading.Thread(target=lock_file)
+                lock_thread.start()
+                time.sleep(0.1)
+                events.append('unlocked')
+            lock_thread.join()
+
+            self.assertEqual(events, ['unlocked', 'locked by thread'])
+        finally:
+            shutil.rmtree(lock_dirpath)
+
+
+    def test_remote_asset_cache_save(self):
+        cache_dirpath = tempfile.mkdtemp()
+        try:
+            # Entries saved by other processes are kept.
+            asset_caches = [RemoteAssetCache(cache_dirpath), RemoteAssetCache(cache_dirpath)]
+            asset_caches[0].save({'http://host/a.png': {'key': 'a'}})
+            asset_caches[1].save({'http://host/b.png': {'key': 'b'}})
+            self.assertEqual(
+                sorted(RemoteAssetCache(cache_dirpath).index.keys()),
+                ['http://host/a.png', 'http://host/b.png']
+            )
+        finally:
+            shutil.rmtree(cache_dirpath)
+
+
+    def test_memory_cache(self):
+        cache_dirpath = tempfile.mkdtemp()
+        try:
+            backing_cache = FileCache(cache_dirpath)
+            backing_cache.put('a', '1')
+            cache = MemoryCache(backing_cache)
+            self.assertEqual(cache.get('a'), '1')
+            cache.put('b', '2')
+            self.assertEqual(backing_cache.get('b'), '2')
+
+            # Entries not used since the previous eviction are removed.
+            cache.evict()
+            self.assertEqual(cache.get('b'), '2')
+            cache.evict()
+            self.assertEqual(sorted(cache.entries.keys()), ['b'])
+            self.assertEqual((cache.hits, cache.misses), (2, 0))
+        finally:
+            shutil.rmtree(cache_dirpath)
+
+
+    def test_build_monolitic_markdown_file_jobs(self):
+        temp_dirpath = tempfile.mkdtemp()
+        try:
+            markdown_filepaths = []
+            for index in range(6):
+                markdown_filepaths.append(os.path.join(temp_dirpath, '%d.md' % index))
+                with open(markdown_filepaths[-1], 'wb') as markdown_file:
+                    markdown_file.write('# File %d\n\n[Link](%d.md) text\\\n' % (index, (index + 1) % 6) * (index + 1))
+
+            monolitic_markdown_files = []
+            for jobs in (1, 4):
+                monolitic_markdown_filepath = os.path.join(temp_dirpath, 'monolitic-%d.md' % jobs)
+                markdown_sections = build_monolitic_markdown_file(monolitic_markdown_filepath, markdown_filepaths, jobs, None, FakePandocBackend())
+                with open(monolitic_markdown_filepath, 'rb') as monolitic_markdown_file:
+                    monolitic_markdown_files.append(monolitic_markdown_file.read())
+
+                # Sections are in the order of the files.
+                self.assertEqual(
+                    [markdown_section.split('\n')[1] for markdown_section in markdown_sections],
+                    ['<md2pdf:file:%s/>' % markdown_filepath for markdown_filepath in markdown_filepaths]
+                )
+            self.assertEqual(monolitic_markdown_files[0], monolitic_markdown_files[1])
+        finally:
+            shutil.rmtree(temp_dirpath)
+
+
+    def test_build_monolitic_markdown_file_jobs_error(self):
+        temp_dirpath = tempfile.mkdtemp()
+        try:
+            markdown_filepaths = []
+            for index, markdown_content in enumerate(('a\n', 'b\n', 'fail\n', 'd\n')):
+                markdown_filepaths.append(os.path.join(temp_dirpath, '%d.md' % index))
+                with open(markdown_filepaths[-1], 'wb') as markdown_file:
+                    markdown_file.write(markdown_content)
+
+            # Errors of the worker processes are raised, naming the file.
+            for jobs in (1, 4):
+                with self.assertRaises(RuntimeError) as context:
+                    build_monolitic_markdown_file(os.path.join(temp_dirpath, 'monolitic.md'), markdown_filepaths, jobs, None, FailingPandocBackend())
+                self.assertIn('Processing file [%s] failed - Pandoc failed' % markdown_filepaths[2], str(context.exception))
+        finally:
+            shutil.rmtree(temp_dirpath)
+
+
+    def test_build_monolitic_markdown_file_keeps_cache(self):
+        temp_dirpath = tempfile.mkdtemp()
+        original_pandoc_version = get_pandoc_version.version
+        get_pandoc_version.version = 'pandoc 1.15.1'
+        try:
+            markdown_filepath = os.path.join(temp_dirpath, 'a.md')
+            with open(markdown_filepath, 'wb') as markdown_file:
+                markdown_file.write('# A\n')
+
+            # Entries of other documents built at the same time (see 
+            # build_batch) are not evicted by the build of this one.
+            cache = MemoryCache()
+            cache.put('other document', '1')
+            cache.evict()
+            cache.put(get_preprocessing_cache_key('# A\n'), 'A\n=\n')
+            build_monolitic_markdown_file(os.path.join(temp_dirpath, 'monolitic.md'), [markdown_filepath], 1, cache)
+            self.assertEqual(sorted(cache.entries.keys()), sorted(['other document', get_preprocessing_cache_key('# A\n')]))
+        finally:
+            get_pandoc_version.version = original_pandoc_version
+            shutil.rmtree(temp_dirpath)
+
+
+    def test_get_watched_filepaths(self):
+        temp_dirpath = tempfile.mkdtemp()
+        try:
+            configuration_filepath = os.path.join(temp_dirpath, 'md2pdf.yml')
+            with open(configuration_filepath, 'wb') as configuration_file:
+                configuration_file.write('files_order:\n  - doc/a.md\n  - missing.md\n')
+            os.makedirs(os.path.join(temp_dirpath, 'doc'))
+            with open(os.path.join(temp_dirpath, 'doc', 'a.md'), 'wb') as markdown_file:
+                markdown_file.write('![local](img/a.png) ![remote](http://host/b.png)\n')
+
+            self.assertEqual(get_watched_filepaths(configuration_filepath, 'cover.yml'), [
+                configuration_filepath,
+                'cover.yml',
+                os.path.join(temp_dirpath, 'doc', 'a.md'),
+                os.path.join(temp_dirpath, 'doc', 'img', 'a.png'),
+                os.path.join(temp_dirpath, 'missing.md')
+            ])
+        finally:
+            shutil.rmtree(temp_dirpath)
+
+
+    def test_get_batch_documents(self):
+        temp_dirpath = tempfile.mkdtemp()
+        try:
+            manifest_filepath = os.path.join(temp_dirpath, 'batch.yml')
+            with open(manifest_filepath, 'wb') as manifest_file:
+                manifest_file.write(
+                    'documents:\n' +
+                    '  - input: orion/md2pdf.yml\n    output: pdf/orion\n' +
+                    '  - input: iota/md2pdf.yml\n    output: pdf/iota.pdf\n    cover: iota/cover.yml\n'
+                )
+
+            self.assertEqual(get_batch_documents(manifest_filepath), [
+                (os.path.join(temp_dirpath, 'orion', 'md2pdf.yml'), os.path.join(temp_dirpath, 'pdf', 'orion.pdf'), None),
+                (
+                    os.path.join(temp_dirpath, 'iota', 'md2pdf.yml'),
+                    os.path.join(temp_dirpath, 'pdf', 'iota.pdf'),
+                    os.path.join(temp_dirpath, 'iota', 'cover.yml')
+                )
+            ])
+
+            with open(manifest_filepath, 'wb') as manifest_file:
+                manifest_file.write('documents:\n  - output: pdf/orion.pdf\n')
+            self.assertRaises(RuntimeError, get_batch_documents, manifest_filepath)
+        finally:
+            shutil.rmtree(temp_dirpath)
+
+
+    def test_preprocess_markdown_files(self):
+        temp_dirpath = tempfile.mkdtemp()
+        original_pandoc_version = get_pandoc_version.version
+        get_pandoc_version.version = 'pandoc 1.15.1'
+        try:
+            markdown_filepaths = [os.path.join(temp_dirpath, name) for name in ['a.md', 'b.md', 'c.md', 'missing.md']]
+            for markdown_filepath, markdown_content in zip(markdown_filepaths, ['# Title\n', '# Title\n', '<a id="x">C</a>\n']):
+                with open(markdown_filepath, 'wb') as markdown_file:
+                    markdown_file.write(markdown_content)
+
+            # Files with the same content are preprocessed once, as without
+            # the cache.
+            pandoc_backend = FakePandocBackend()
+            cache = FileCache(os.path.join(temp_dirpath, 'cache'))
+            self.assertEqual(preprocess_markdown_files(markdown_filepaths, 2, cache, pandoc_backend), 2)
+            for markdown_content in ['# Title\n', '<a id="x">C</a>\n']:
+                self.assertEqual(
+                    cache.get(get_preprocessing_cache_key(markdown_content)),
+                    preprocess_markdown_content(markdown_content.decode('utf-8'), pandoc_backend).encode('utf-8')
+                )
+
+            # Already preprocessed contents and missing files are skipped.
+            cache_hits = cache.hits
+            self.assertEqual(preprocess_markdown_files(markdown_filepaths, 2, cache, pandoc_backend), 0)
+            self.assertEqual(cache.hits - cache_hits, 3)
+
+            cache = MemoryCache()
+            cache.put(get_preprocessing_cache_key('# Title\n'), 'Title\n=====\n')
+            self.assertEqual(preprocess_markdown_files(markdown_filepaths[:2], 2, cache), 0)
+            self.assertEqual(cache.get(get_preprocessing_cache_key('# Title\n')), 'Title\n=====\n')
+        finally:
+            get_pandoc_version.version = original_pandoc_version
+            shutil.rmtree(temp_dirpath)
+
+
+    def test_wait_for_changes(self):
+        temp_dirpath = tempfile.mkdtemp()
+        try:
+            filepaths = [os.path.join(temp_dirpath, name) for name in ['a.md', 'b.md', 'c.md']]
+            for filepath in filepaths[:2]:
+                with open(filepath, 'wb') as watched_file:
+                    watched_file.write('a')
+            filepaths_state = get_filepaths_state(filepaths)
+
+            def save_files():
+                for filepath in filepaths[1:]:
+                    time.sleep(0.05)
+                    with open(filepath, 'wb') as watched_file:
+                        watched_file.write('changed')
+            save_thread = threading.Thread(target=save_files)
+            save_thread.start()
+
+            # Both saves are reported together.
+            self.assertEqual(wait_for_changes(filepaths_state, interval=0.01, debounce=0.2), filepaths[1:])
+            save_thread.join()
+        finally:
+            shutil.rmtree(temp_dirpath)
+
+
+    def test_generate_cache_key(self):
+        self.assertEqual(generate_cache_key('a', 'b'), generate_cache_key('a', u'b'))
+        self.assertNotEqual(generate_cache_key('a', 'b'), generate_cache_key('ab'))
+        self.assertNotEqual(generate_cache_key('a', 'b'), generate_cache_key('b', 'a'))
+
+
+    def test_apply_json_filters(self):
+        paragraph = [
+            {'t': 'Str', 'c': 'a'},
+            {'t': 'Space', 'c': []},
+            {'t': 'Str', 'c': 'abc\\'},
+            {'t': 'LineBreak', 'c': []},
+            {'t': 'Str', 'c': 'd\\'}
+        ]
+        json_ast = json.dumps([{'unMeta': {}}, [{'t': 'Para', 'c': paragraph}]])
+
+        filtered_paragraph = json.loads(
+            apply_json_filters(json_ast, ['md2pdf_pandoc_paragraph_filter'], 'markdown_github')
+        )[1][0]['c']
+
+        self.assertEqual(filtered_paragraph[2]['c'], 'abc')
+        self.assertEqual(filtered_paragraph[4]['c'], 'd\\')
+
+
+    def test_pandoc_filter_pandoc_1_16_ast(self):
+        # Since Pandoc 1.16, Space has no content and links have attributes.
+        link = {'t': 'Link', 'c': [
+            ['', [], []], [{'t': 'Str', 'c': 'B'}, {'t': 'Space'}, {'t': 'Str', 'c': 'C'}], ['b.md', '']
+        ]}
+        json_ast = {'pandoc-api-version': [1, 17, 0, 4], 'meta': {}, 'blocks': [
+            {'t': 'Header', 'c': [1, ['', [], []], [{'t': 'Str', 'c': 'A'}, {'t': 'Space'}, {'t': 'Str', 'c': 'B'}]]},
+            {'t': 'Para', 'c': [link]}
+        ]}
+
+        filtered_json_ast = json.loads(
+            apply_json_filters(json.dumps(json_ast), ['md2pdf_pandoc_filter', 'md2pdf_pandoc_paragraph_filter'], 'latex')
+        )
+        # The filter executable reads the same AST.
+        filter_process = subprocess.Popen(
+            [sys.executable, 'pandoc_filters.py', 'latex'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        )
+        filter_output = filter_process.communicate(json.dumps(json_ast))[0]
+        self.assertEqual(filter_process.returncode, 0)
+        self.assertEqual(json.loads(filter_output)['blocks'], filtered_json_ast['blocks'])
+
+        header_content = filtered_json_ast['blocks'][0]['c'][2]
+        self.assertEqual(header_content[-1]['t'], 'RawInline')
+        self.assertIn('a-b', header_content[-1]['c'][1])
+        filtered_link = filtered_json_ast['blocks'][1]['c'][0]['c']
+        self.assertEqual(filtered_link[2][0], process_link_destination('b.md', ''))
+        self.assertEqual(filtered_link[1][1], {'t': 'Space', 'c': []})
+
+
+    def test_pandoc_filter_latex_tables(self):
+        def table(caption):
+            link = {'t': 'Link', 'c': [[{'t': 'Str', 'c': 'B'}], ['b.md', '']]}
+            return {'t': 'Table', 'c': [
+                caption, [{'t': 'AlignDefault', 'c': []}], [0],
+                [[{'t': 'Plain', 'c': [{'t': 'Str', 'c': 'A'}]}]],
+                [[[{'t': 'Plain', 'c': [link]}]]]
+            ]}
+        json_ast = [{'unMeta': {}}, [table([]), table([{'t': 'Str', 'c': 'Caption'}])]]
+
+        original_table_backend = os.environ.get('MD2PDF_TABLE_BACKEND')
+        os.environ['MD2PDF_TABLE_BACKEND'] = 'latex'
+        try:
+            blocks = apply_document_filters(json_ast, ['md2pdf_pandoc_filter'], 'latex')[1]
+        finally:
+            if original_table_backend is None:
+                del os.environ['MD2PDF_TABLE_BACKEND']
+            else:
+                os.environ['MD2PDF_TABLE_BACKEND'] = original_table_backend
+
+        link_destination = process_link_destination('b.md', '')
+        self.assertEqual(blocks[0]['t'], 'RawBlock')
+        self.assertIn('\\hyperref[%s]' % link_destination[1:], blocks[0]['c'][1])
+        # Tables with captions are left to Pandoc, with their links 
+        # processed once.
+        self.assertEqual(blocks[1]['t'], 'Table')
+        self.assertEqual(blocks[1]['c'][4][0][0][0]['c'][0]['c'][1][0], link_destination)
+
+
+    def test_pandoc_filter_latex_tables_pandoc_1_16_ast(self):
+        def table():
+            link = {'t': 'Link', 'c': [
+                ['', [], []], [{'t': 'Str', 'c': 'B'}, {'t': 'Space'}, {'t': 'Str', 'c': 'C'}], ['b.md', '']
+            ]}
+            return {'t': 'Table', 'c': [
+                [], [{'t': 'AlignDefault'}], [0],
+                [[{'t': 'Plain', 'c': [{'t': 'Str', 'c': 'A'}, {'t': 'Space'}, {'t': 'Str', 'c': 'D'}]}]],
+                [[[{'t': 'Plain', 'c': [link]}]]]
+            ]}
+        json_ast = {'pandoc-api-version': [1, 17, 0, 4], 'meta': {}, 'blocks': [table(), table()]}
+
+        # The table backend is read once per document.
+        import convert_md_tables
+        table_backend_reads = []
+        original_get_table_backend = convert_md_tables.get_table_backend
+        def get_table_backend():
+            table_backend_reads.append(None)
+            return 'latex'
+        convert_md_tables.get_table_backend = get_table_backend
+        try:
+            blocks = apply_document_filters(json_ast, ['md2pdf_pandoc_filter'], 'latex')['blocks']
+        finally:
+            convert_md_tables.get_table_backend = original_get_table_backend
+
+        self.assertEqual(len(table_backend_reads), 1)
+        link_destination = process_link_destination('b.md', '')
+        for block in blocks:
+            self.assertEqual(block['t'], 'RawBlock')
+            self.assertIn('A \\BreakableChar{}D', block['c'][1])
+            self.assertIn('\\hyperref[%s]{\\BreakableChar{}B \\BreakableChar{}C}' % link_destination[1:], block['c'][1])
+
+
+    def test_merge_json_asts(self):
+        def header(identifier, *words):
+            header_content = []
+            for word in words:
+                header_content += [{'t': 'Str', 'c': word}, {'t': 'Space', 'c': []}]
+            return {'t': 'Header', 'c': [2, [identifier, [], []], header_content[:-1]]}
+
+        json_asts = [
+            {'pandoc-api-version': [1, 23], 'meta': {'title': 'A'}, 'blocks': [
+                header('', u'Intro'), header('', u'Intro'), header('intro-2', u'Explicit')
+            ]},
+            {'pandoc-api-version': [1, 23], 'meta': {'title': 'B', 'author': 'C'}, 'blocks': [
+                header('', u'Intro'), header('', u'1.', u'Intro', u'\xbfQu\xe9?'), header('', u'?')
+            ]}
+        ]
+        json_ast = make_header_identifiers_unique(merge_json_asts(json_asts))
+
+        self.assertEqual(json_ast['pandoc-api-version'], [1, 23])
+        self.assertEqual(json_ast['meta'], {'title': 'A', 'author': 'C'})
+        self.assertEqual(
+            [block['c'][1][0] for block in json_ast['blocks']],
+            ['intro', 'intro-1', 'intro-2', 'intro-3', u'intro-qu\xe9', 'section']
+        )
+
+
+    def test_build_json_ast(self):
+        class FakePandocBackend(object):
+            def __init__(self):
+                self.parsed_sections = []
+
+            def convert_text(self, source, to, format, filters=None, extra_args=()):
+                self.parsed_sections.append(source)
+                return json.dumps([{'unMeta': {}}, [
+                    {'t': 'Header', 'c': [1, ['', [], []], [{'t': 'Str', 'c': source}]]}
+                ]])
+
+        temp_dirpath = tempfile.mkdtemp()
+        original_pandoc_version = get_pandoc_version.version
+        get_pandoc_version.version = 'pandoc 1.15.1'
+        try:
+            cache = FileCache(temp_dirpath)
+            pandoc_backend = FakePandocBackend()
+            self.assertEqual(
+                build_json_ast([u'A', u'B', u'A'], 2, cache, pandoc_backend),
+                [{'unMeta': {}}, [
+                    {'t': 'Header', 'c': [1, [u'a', [], []], [{'t': 'Str', 'c': u'A'}]]},
+                    {'t': 'Header', 'c': [1, [u'b', [], []], [{'t': 'Str', 'c': u'B'}]]},
+                    {'t': 'Header', 'c': [1, [u'a-1', [], []], [{'t': 'Str', 'c': u'A'}]]}
+                ]]
+            )
+            self.assertEqual(sorted(pandoc_backend.parsed_sections), [u'A', u'A', u'B'])
+
+            # Only the sections not cached are parsed.
+            pandoc_backend.parsed_sections = []
+            build_json_ast([u'A', u'C'], 1, cache, pandoc_backend)
+            self.assertEqual(pandoc_backend.parsed_sections, [u'C'])
+        finally:
+            get_pandoc_version.version = original_pandoc_version
+            shutil.rmtree(temp_dirpath)
+
+
+    @unittest.skipUnless(is_image_optimization_available(), 'Pillow is not installed')
+    def test_image_optimizer(self):
+        Image = get_pil_image_module()
+        temp_dirpath = tempfile.mkdtemp()
+        try:
+            big_image_path = os.path.join(temp_dirpath, 'big.png')
+            Image.new('RGB', (3000, 100), (255, 0, 0)).save(big_image_path, dpi=(72, 72))
+            small_image_path = os.path.join(temp_dirpath, 'small.png')
+            Image.new('RGB', (100, 100), (255, 0, 0)).save(small_image_path, dpi=(72, 72))
+
+            optimizer = ImageOptimizer(os.path.join(temp_dirpath, 'cache'), dpi=150)
+
+            # Images wider than the text are downscaled keeping their size in the page.
+            optimized_image_path = optimizer.get_optimized_image_path(big_image_path)
+            self.assertNotEqual(optimized_image_path, big_image_path)
+            optimized_image = Image.open(optimized_image_path)
+            self.assertEqual(optimized_image.size[0], 975)
+            self.assertAlmostEqual(optimized_image.info['dpi'][0], 23.4, delta=1)
+            self.assertEqual(optimizer.get_optimized_image_path(big_image_path), optimized_image_path)
+            self.assertEqual(optimizer.images.hits, 1)
+
+            # Small images are only recompressed.
+            optimized_image_path = optimizer.get_optimized_image_path(small_image_path)
+            self.assertEqual(Image.open(optimized_image_path).size, (100, 100))
+
+            # Files which are not images are used as they are.
+            text_path = os.path.join(temp_dirpath, 'file.png')
+            with open(text_path, 'wb') as text_file:
+                text_file.write('not an image')
+            self.assertEqual(optimizer.get_optimized_image_path(text_path), text_path)
+            self.assertEqual(optimizer.get_optimized_image_path(text_path), text_path)
+        finally:
+            shutil.rmtree(temp_dirpath)
+
+
+    def test_image_optimizer_close(self):
+        temp_dirpath = tempfile.mkdtemp()
+        try:
+            cache_dirpath = os.path.join(temp_dirpath, 'images')
+            optimizer = ImageOptimizer(cache_dirpath)
+            optimizer.images.max_size = 10
+            optimizer.images.put('a.png', '12345')
+            optimizer.images.put('b.png', '12345')
+            optimizer.images.put('c.png.original', '')
+            os.utime(os.path.join(cache_dirpath, 'a.png'), (0, 0))
+
+            # The images cache is evicted at the end of the build.
+            optimizer.images.put('d.png', '12345')
+            optimizer.close()
+            self.assertEqual(sorted(os.listdir(cache_dirpath)), ['b.png', 'c.png.original', 'd.png'])
+        finally:
+            shutil.rmtree(temp_dirpath)
+
 
     def test_remove_ids_from_a(self):
         self.assertEqual(remove_ids_from_a('<a href=#link id="identifier">text</a>'),'<a href=#link >text</a>')
@@ -301,5 +1280,781 @@ class TestMarkdownToPdf( unittest.TestCase ):
 
 
 
+class FakePandocServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Pandoc server stand-in which upper-cases the given text"""
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.server.requests.append(request)
+        if request['from'] == 'unknown':
+            response_status, response_body = 500, 'Unknown input format'
+        else:
+            response_status, response_body = 200, json.dumps({'output': request['text'].upper(), 'base64': False})
+        self.send_response(response_status)
+        self.send_header('Content-Length', str(len(response_body)))
+        self.end_headers()
+        self.wfile.write(response_body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestServerPandocBackend( unittest.TestCase ):
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), FakePandocServerHandler)
+        self.server.requests = []
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.start()
+        self.backend = ServerPandocBackend(self.server.server_address[1])
+
+
+    def tearDown(self):
+        self.backend.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.server_thread.join()
+
+
+    def test_convert(self):
+        self.assertEqual(self.backend.convert(u'text\ta', 'markdown', 'markdown_github'), u'TEXT    A\n')
+        self.assertEqual(self.backend.convert('other', 'json', 'markdown'), u'OTHER\n')
+        self.assertEqual(
+            self.server.requests,
+            [
+                {'text': 'text    a', 'from': 'markdown_github', 'to': 'markdown'},
+                {'text': 'other', 'from': 'markdown', 'to': 'json'}
+            ]
+        )
+
+
+    def test_convert_error(self):
+        self.assertRaises(RuntimeError, self.backend.convert, u'text', 'markdown', 'unknown')
+
+
+class FakeWebServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Web server stand-in used for checking remote URLs"""
+    def do_HEAD(self):
+        if self.path == '/no-head':
+            self.send_response(405)
+        else:
+            self.do_GET()
+
+    def do_GET(self):
+        self.server.requests.append((self.command, self.path, self.headers.get('If-None-Match')))
+        if self.path == '/slow':
+            time.sleep(1)
+
+        response_body = ''
+        if self.path == '/image.png' and self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+        elif self.path in ('/image.png', '/no-head', '/slow'):
+            self.send_response(200)
+            self.send_header('ETag', '"v1"')
+            response_body = 'image data'
+        elif self.path == '/image':
+            self.send_response(200)
+            response_body = '\x89PNG\r\n\x1a\nimage data'
+        else:
+            self.send_response(404)
+        self.send_header('Content-Length', str(len(response_body)))
+        self.end_headers()
+        if self.command == 'GET':
+            self.wfile.write(response_body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeWebServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class TestUrlChecker( unittest.TestCase ):
+    def setUp(self):
+        self.server = FakeWebServer(('127.0.0.1', 0), FakeWebServerHandler)
+        self.server.requests = []
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.start()
+        self.base_url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self.cache_dirpath = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.server_thread.join()
+        shutil.rmtree(self.cache_dirpath)
+
+
+    def test_check_urls(self):
+        self.assertEqual(
+            check_urls(
+                [
+                    self.base_url + '/image.png',
+                    self.base_url + '/missing.png',
+                    self.base_url + '/no-head',
+                    self.base_url + '/slow',
+                    'http://127.0.0.1:1/refused.png'
+                ],
+                timeout=0.5
+            ),
+            {
+                self.base_url + '/image.png': True,
+                self.base_url + '/missing.png': False,
+                self.base_url + '/no-head': True,
+                self.base_url + '/slow': None,
+                'http://127.0.0.1:1/refused.png': None
+            }
+        )
+        self.assertTrue(('HEAD', '/image.png', None) in self.server.requests)
+        self.assertTrue(('GET', '/no-head', None) in self.server.requests)
+
+
+    def test_remote_asset_cache(self):
+        image_url = self.base_url + '/image.png'
+        missing_image_url = self.base_url + '/missing.png'
+
+        asset_cache = RemoteAssetCache(self.cache_dirpath)
+        local_paths = asset_cache.fetch([image_url, missing_image_url])
+        self.assertEqual(local_paths.keys(), [image_url])
+        self.assertTrue(local_paths[image_url].endswith('.png'))
+        with open(local_paths[image_url], 'rb') as image_file:
+            self.assertEqual(image_file.read(), 'image data')
+
+        # Recently validated images are not requested again.
+        requests_count = len(self.server.requests)
+        asset_cache = RemoteAssetCache(self.cache_dirpath)
+        self.assertEqual(asset_cache.fetch([image_url]), local_paths)
+        self.assertEqual(len(self.server.requests), requests_count)
+
+        # Older ones are revalidated with their ETag.
+        asset_cache = RemoteAssetCache(self.cache_dirpath, ttl=0)
+        self.assertEqual(asset_cache.fetch([image_url]), local_paths)
+        self.assertEqual(self.server.requests[-1], ('GET', '/image.png', '"v1"'))
+
+        # Offline, only cached images are available and nothing is requested.
+        requests_count = len(self.server.requests)
+        self.assertEqual(asset_cache.fetch([image_url, missing_image_url], offline=True), local_paths)
+        self.assertEqual(len(self.server.requests), requests_count)
+
+        # Images no longer found are removed from the cache.
+        asset_cache.save({missing_image_url: asset_cache.index[image_url]})
+        asset_cache = RemoteAssetCache(self.cache_dirpath, ttl=0)
+        self.assertEqual(asset_cache.fetch([missing_image_url], offline=True).keys(), [missing_image_url])
+        self.assertEqual(asset_cache.fetch([missing_image_url]), {})
+        self.assertNotIn(missing_image_url, RemoteAssetCache(self.cache_dirpath).index)
+
+        # The extension of images without one is guessed from their content.
+        self.assertTrue(asset_cache.fetch([self.base_url + '/image'])[self.base_url + '/image'].endswith('.png'))
+
+
+    def test_get_asset_extension(self):
+        self.assertEqual(get_asset_extension('http://host/a.JPEG?size=2', 'image/png'), '.jpeg')
+        self.assertEqual(get_asset_extension('http://host/a', 'image/png; charset=binary'), '.png')
+        self.assertEqual(get_asset_extension('http://host/a', 'application/octet-stream', 'GIF89a...'), '.gif')
+        self.assertEqual(get_asset_extension('http://host/a', None, '\xff\xd8\xff\xe0'), '.jpg')
+        self.assertEqual(get_asset_extension('http://host/a', None, 'text'), '')
+
+
+    def test_url_status_cache(self):
+        cache_filepath = os.path.join(self.cache_dirpath, 'url_status.json')
+        url_status_cache = UrlStatusCache(cache_filepath, ttl=60)
+        url_status_cache.update({'http://a': True, 'http://b': False, 'http://c': None})
+
+        url_status_cache = UrlStatusCache(cache_filepath, ttl=60)
+        self.assertEqual(url_status_cache.get('http://a'), True)
+        self.assertEqual(url_status_cache.get('http://b'), False)
+        self.assertEqual(url_status_cache.get('http://c'), None)
+
+        # Expired entries are not returned.
+        url_status_cache.statuses['http://a']['time'] -= 120
+        self.assertEqual(url_status_cache.get('http://a'), None)
+
+
+    def test_find_remote_urls(self):
+        markdown_content = (
+            '![image](http://host/image.png) [link](https://host/page)\n'
+            '![titled image](www.host.com/image.png "Title") ![local](image.png)'
+        )
+        self.assertEqual(
+            find_markdown_urls(markdown_content),
+            ['http://host/image.png', 'www.host.com/image.png', 'image.png']
+        )
+        self.assertEqual(
+            find_markdown_urls(markdown_content, include_links=True),
+            ['http://host/image.png', 'https://host/page', 'www.host.com/image.png', 'image.png']
+        )
+        # Local paths are not remote URLs.
+        self.assertEqual(
+            find_remote_urls(markdown_content, include_links=True),
+            ['http://host/image.png', 'https://host/page', normalize_remote_url('www.host.com/image.png')]
+        )
+
+
+# Fake xelatex which increments a counter in the .aux file until it reaches 2,
+# so documents converge after 3 passes. It fails for documents containing
+# "fail".
+FAKE_XELATEX_SCRIPT = """#!/bin/sh
+aux="$4/document.aux"
+n=$(cat "$aux" 2>/dev/null || echo 0)
+if [ "$n" -lt 2 ]; then n=$((n+1)); fi
+echo $n > "$aux"
+if grep -q fail "$5"; then exit 1; fi
+exit 0
+"""
+
+FAKE_XELATEX_DUMP_SCRIPT = """#!/bin/sh
+if [ "$1" = "--version" ]; then echo "XeTeX 3.14"; exit 0; fi
+echo "$*" >> "$(dirname "$0")/xelatex_calls"
+for arg; do
+  case "$previous" in -output-directory) outdir="$arg";; esac
+  case "$arg" in -jobname=*) jobname="${arg#-jobname=}";; esac
+  previous="$arg"
+  latex="$arg"
+done
+printf 'PWD %s\\nINPUT %s\\nINPUT package.sty\\n' "$(dirname "$latex")" "$latex" > "$outdir/$jobname.fls"
+if grep -q fail "$latex"; then exit 1; fi
+echo format > "$outdir/$jobname.fmt"
+"""
+
+
+class TestLatexBuild( unittest.TestCase ):
+    def setUp(self):
+        self.temp_dirpath = tempfile.mkdtemp()
+        fake_xelatex_path = os.path.join(self.temp_dirpath, 'xelatex')
+        with open(fake_xelatex_path, 'wb') as fake_xelatex_file:
+            fake_xelatex_file.write(FAKE_XELATEX_SCRIPT)
+        os.chmod(fake_xelatex_path, 0o755)
+        self.original_path = os.environ['PATH']
+        os.environ['PATH'] = self.temp_dirpath + os.pathsep + self.original_path
+
+        self.build_dirpath = os.path.join(self.temp_dirpath, 'build')
+        os.makedirs(self.build_dirpath)
+        self.latex_filepath = os.path.join(self.build_dirpath, 'document.tex')
+
+
+    def tearDown(self):
+        os.environ['PATH'] = self.original_path
+        shutil.rmtree(self.temp_dirpath)
+
+
+    def write_latex_file(self, content):
+        with open(self.latex_filepath, 'wb') as latex_file:
+            latex_file.write(content)
+
+
+    def test_compile_latex_incrementally(self):
+        self.write_latex_file('document')
+        self.assertEqual(compile_latex_incrementally(self.latex_filepath, self.build_dirpath), 3)
+        # Unchanged documents only need one pass.
+        self.assertEqual(compile_latex_incrementally(self.latex_filepath, self.build_dirpath), 1)
+
+        remove_latex_aux_files(self.build_dirpath)
+        self.assertEqual(compile_latex_incrementally(self.latex_filepath, self.build_dirpath, max_passes=2), 2)
+
+
+    def test_compile_latex_incrementally_error(self):
+        self.write_latex_file('fail')
+        self.assertRaises(RuntimeError, compile_latex_incrementally, self.latex_filepath, self.build_dirpath)
+        self.assertFalse(os.path.exists(os.path.join(self.build_dirpath, 'document.aux')))
+
+
+    def test_get_latex_format(self):
+        fake_xelatex_path = os.path.join(self.temp_dirpath, 'xelatex')
+        with open(fake_xelatex_path, 'wb') as fake_xelatex_file:
+            fake_xelatex_file.write(FAKE_XELATEX_DUMP_SCRIPT)
+        original_cache_dirpath = os.environ.get('MD2PDF_CACHE_DIR')
+        os.environ['MD2PDF_CACHE_DIR'] = os.path.join(self.temp_dirpath, 'cache')
+        get_toolchain_cache.cache = None
+
+        def write_package(content):
+            with open(os.path.join(self.build_dirpath, 'package.sty'), 'wb') as package_file:
+                package_file.write(content)
+        def count_dumps():
+            with open(os.path.join(self.temp_dirpath, 'xelatex_calls'), 'rb') as calls_file:
+                return len(calls_file.readlines())
+
+        try:
+            write_package('package')
+            self.write_latex_file('\\documentclass{article}\n' + LATEX_FORMAT_MARKER + '\n\\begin{document}\nA\n\\end{document}\n')
+            latex_format_filepath = get_latex_format(self.latex_filepath)
+            self.assertTrue(os.path.exists(latex_format_filepath + '.fmt'))
+            self.assertEqual(get_latex_format(self.latex_filepath), latex_format_filepath)
+            self.assertEqual(count_dumps(), 1)
+
+            # Only the static preamble is precompiled.
+            self.write_latex_file('\\documentclass{article}\n' + LATEX_FORMAT_MARKER + '\n\\begin{document}\nB\n\\end{document}\n')
+            self.assertEqual(get_latex_format(self.latex_filepath), latex_format_filepath)
+            self.assertEqual(count_dumps(), 1)
+
+            # Formats are dumped again when the files they read change.
+            write_package('package updated')
+            self.assertEqual(get_latex_format(self.latex_filepath), latex_format_filepath)
+            self.assertEqual(count_dumps(), 2)
+
+            # Failed dumps are not retried.
+            self.write_latex_file('\\documentclass{article}\n% fail\n' + LATEX_FORMAT_MARKER + '\n\\begin{document}\n\\end{document}\n')
+            self.assertIsNone(get_latex_format(self.latex_filepath))
+            self.assertIsNone(get_latex_format(self.latex_filepath))
+            self.assertEqual(count_dumps(), 3)
+
+            self.write_latex_file('\\documentclass{article}\n\\begin{document}\n' + LATEX_FORMAT_MARKER + '\n\\end{document}\n')
+            self.assertIsNone(get_latex_format(self.latex_filepath))
+            self.assertEqual(count_dumps(), 3)
+        finally:
+            get_toolchain_cache.cache = None
+            if original_cache_dirpath is None:
+                del os.environ['MD2PDF_CACHE_DIR']
+            else:
+                os.environ['MD2PDF_CACHE_DIR'] = original_cache_dirpath
+
+
+FAKE_PANDOC_SCRIPT = """#!/bin/sh
+echo "$*" >> "$(dirname "$0")/pandoc_calls"
+case "$*" in
+*fragment_template.tex*) echo '%md2pdf-fragment: tables'; cat;;
+*) echo "$*" | grep -o -- '-V [a-z]*'; echo '%md2pdf-body';;
+esac
+"""
+
+
+class TestLatexFragments( unittest.TestCase ):
+    def setUp(self):
+        self.temp_dirpath = tempfile.mkdtemp()
+        fake_pandoc_path = os.path.join(self.temp_dirpath, 'pandoc')
+        with open(fake_pandoc_path, 'wb') as fake_pandoc_file:
+            fake_pandoc_file.write(FAKE_PANDOC_SCRIPT)
+        os.chmod(fake_pandoc_path, 0o755)
+        self.original_path = os.environ['PATH']
+        os.environ['PATH'] = self.temp_dirpath + os.pathsep + self.original_path
+        self.original_pandoc_version = get_pandoc_version.version
+        get_pandoc_version.version = 'pandoc 1.15.1'
+
+        self.template_filepath = os.path.join(self.temp_dirpath, 'template.tex')
+        self.write_template('$body$')
+        self.json_ast = {'pandoc-api-version': [1, 23], 'meta': {}, 'blocks': [
+            {'t': 'Para', 'c': [{'t': 'RawInline', 'c': ['html', '<md2pdf:file:a.md/>']}]},
+            {'t': 'Header', 'c': [1, ['a', [], []], [{'t': 'Str', 'c': 'A'}]]},
+            {'t': 'Para', 'c': [{'t': 'Str', 'c': '<md2pdf:file:b.md/>'}]},
+            {'t': 'Para', 'c': [{'t': 'Str', 'c': 'B'}]}
+        ]}
+
+
+    def tearDown(self):
+        os.environ['PATH'] = self.original_path
+        get_pandoc_version.version = self.original_pandoc_version
+        shutil.rmtree(self.temp_dirpath)
+
+
+    def write_template(self, content):
+        with open(self.template_filepath, 'wb') as template_file:
+            template_file.write(content)
+
+
+    def pop_pandoc_calls(self):
+        pandoc_calls_filepath = os.path.join(self.temp_dirpath, 'pandoc_calls')
+        with open(pandoc_calls_filepath, 'rb') as pandoc_calls_file:
+            pandoc_calls = len(pandoc_calls_file.readlines())
+        os.remove(pandoc_calls_filepath)
+        return pandoc_calls
+
+
+    def test_split_json_ast(self):
+        files_json_asts = split_json_ast(self.json_ast)
+        self.assertEqual([len(file_json_ast['blocks']) for file_json_ast in files_json_asts], [2, 2])
+        self.assertEqual(files_json_asts[1]['pandoc-api-version'], [1, 23])
+
+        # Space has no content since Pandoc 1.16.
+        self.assertTrue(is_a_file_marker_block({'t': 'Para', 'c': [
+            {'t': 'Str', 'c': '<md2pdf:file:my'}, {'t': 'Space'}, {'t': 'Str', 'c': 'doc.md/>'}
+        ]}))
+
+        self.assertEqual(
+            parse_latex_fragment('%md2pdf-fragment: tables graphics\n\\section{A}\n\n'),
+            (['tables', 'graphics'], '\\section{A}')
+        )
+        self.assertRaises(RuntimeError, parse_latex_fragment, '\\section{A}\n')
+
+
+    def test_generate_latex_document(self):
+        latex_filepath = os.path.join(self.temp_dirpath, 'document.tex')
+        pandoc_options = ['--template', self.template_filepath, '--from', 'json']
+        cache = FileCache(os.path.join(self.temp_dirpath, 'cache'))
+
+        generate_latex_document(latex_filepath, self.json_ast, pandoc_options, 2, cache)
+        self.assertEqual(self.pop_pandoc_calls(), 3)
+        with open(latex_filepath, 'rb') as latex_file:
+            self.assertEqual(
+                latex_file.read(),
+                '-V tables\n' + '\n\n'.join(json.dumps(file_json_ast) for file_json_ast in split_json_ast(self.json_ast)) + '\n'
+            )
+
+        # Only the changed files are converted again.
+        self.json_ast['blocks'][3]['c'][0]['c'] = 'C'
+        generate_latex_document(latex_filepath, self.json_ast, pandoc_options, 1, cache)
+        self.assertEqual(self.pop_pandoc_calls(), 2)
+
+        self.write_template('\\begin{document}\n$body$')
+        generate_latex_document(latex_filepath, self.json_ast, pandoc_options, 1, cache)
+        self.assertEqual(self.pop_pandoc_calls(), 3)
+
+
+# Writes a label per \anchor and, in shards, the page counter.
+FAKE_XELATEX_SHARDS_SCRIPT = r"""
+import os, re, sys
+output_dirpath, latex_filepath = sys.argv[-2], sys.argv[-1]
+with open(os.path.join(os.path.dirname(sys.argv[0]), 'xelatex_calls'), 'ab') as calls_file:
+    calls_file.write(os.path.basename(latex_filepath) + '\n')
+with open(latex_filepath, 'rb') as latex_file:
+    latex_content = latex_file.read()
+if 'fail' in latex_content:
+    sys.exit(1)
+aux_lines = ['\\relax'] + ['\\newlabel{%s}{}' % label for label in re.findall(r'\\anchor\{([^}]*)\}', latex_content)]
+if '\\mdtopdfcounter' in latex_content:
+    aux_lines.append('\\mdtopdfcounter{page}{2}{0}')
+jobname = os.path.splitext(os.path.basename(latex_filepath))[0]
+with open(os.path.join(output_dirpath, jobname + '.aux'), 'wb') as aux_file:
+    aux_file.write(''.join(line + '\n' for line in aux_lines))
+"""
+
+
+class TestLatexShards( unittest.TestCase ):
+    def test_split_latex_document(self):
+        latex_content = (
+            '\\documentclass{article}\n\\begin{document}\n\\tableofcontents\n\n' +
+            '\\newpage\n\n\\anchor{amd}\n\n\\section{A}\n\n' +
+            '\\newpage\n\\anchor{bmd}\n\n\\section{B}\n\\newpage\n\n' +
+            '\\end{document}\n'
+        )
+        preamble, front, sections, end = split_latex_document(latex_content)
+        self.assertEqual(preamble, '\\documentclass{article}\n')
+        self.assertEqual(front, '\n\\tableofcontents\n\n')
+        self.assertEqual(sections, [
+            '\\newpage\n\n\\anchor{amd}\n\n\\section{A}\n\n',
+            '\\newpage\n\\anchor{bmd}\n\n\\section{B}\n\\newpage\n\n'
+        ])
+        self.assertEqual(end, '\\end{document}\n')
+        self.assertEqual(split_latex_document('\\begin{document}\n\\newpage\n\\end{document}'), None)
+
+
+    def test_group_latex_sections(self):
+        self.assertEqual(group_latex_sections(['a', 'b', 'c', 'd'], 2), ['ab', 'cd'])
+        self.assertEqual(group_latex_sections(['aaaa', 'b', 'c', 'd'], 2), ['aaaa', 'bcd'])
+        self.assertEqual(group_latex_sections(['aaaa', 'b', 'c', 'd'], 3), ['aaaa', 'bc', 'd'])
+        self.assertEqual(group_latex_sections(['a', 'b'], 4), ['a', 'b'])
+        self.assertEqual(group_latex_sections(['a', 'b', 'c'], 1), ['abc'])
+
+
+    def test_get_shards_start_counters(self):
+        used_start_counters = [{}, {'page': 1, 'section': 0}, {'page': 1, 'section': 0}]
+        end_counters = [
+            {'page': (3, False), 'section': (0, False)},
+            {'page': (11, False), 'section': (2, False), 'subsection': (1, True)},
+            {'page': (6, False), 'section': (1, False)}
+        ]
+        self.assertEqual(
+            get_shards_start_counters(used_start_counters, end_counters),
+            [{}, {'page': 3, 'section': 0}, {'page': 13, 'section': 2, 'subsection': 1}]
+        )
+
+
+    def test_read_shard_counters(self):
+        aux_content = '\\relax\n\\mdtopdfcounter{page}{12}{0}\n\\mdtopdfcounter{subsection}{2}{1}\n'
+        self.assertEqual(read_shard_counters(aux_content), {'page': (12, False), 'subsection': (2, True)})
+
+
+    def test_compile_latex_in_shards(self):
+        temp_dirpath = tempfile.mkdtemp()
+        original_path = os.environ['PATH']
+        try:
+            fake_xelatex_path = os.path.join(temp_dirpath, 'xelatex')
+            with open(fake_xelatex_path, 'wb') as fake_xelatex_file:
+                fake_xelatex_file.write('#!' + sys.executable + '\n' + FAKE_XELATEX_SHARDS_SCRIPT)
+            os.chmod(fake_xelatex_path, 0o755)
+            os.environ['PATH'] = temp_dirpath + os.pathsep + original_path
+
+            build_dirpath = os.path.join(temp_dirpath, 'build')
+            os.makedirs(build_dirpath)
+            latex_filepath = os.path.join(build_dirpath, 'document.tex')
+            def write_latex_file(sections):
+                with open(latex_filepath, 'wb') as latex_file:
+                    latex_file.write(
+                        '\\documentclass{article}\n\\begin{document}\n' +
+                        ''.join('\\newpage\n\\anchor{%s}\n\n' % section for section in sections) +
+                        '\\end{document}\n'
+                    )
+            def read_calls():
+                with open(os.path.join(temp_dirpath, 'xelatex_calls'), 'rb') as calls_file:
+                    calls = calls_file.read().split()
+                os.remove(os.path.join(temp_dirpath, 'xelatex_calls'))
+                return calls
+
+            # Once the shards converge, the whole document is compiled once.
+            write_latex_file(['amd', 'bmd', 'cmd'])
+            self.assertEqual(compile_latex_in_shards(latex_filepath, build_dirpath, 2), (3, 1))
+            calls = read_calls()
+            self.assertEqual(calls[-1], 'document.tex')
+            self.assertEqual(sorted(calls[:-1]), ['shard0.tex'] * 3 + ['shard1.tex'] * 3 + ['shard2.tex'] * 3)
+            with open(os.path.join(build_dirpath, 'document.aux'), 'rb') as aux_file:
+                self.assertEqual(aux_file.read(), '\\relax\n\\newlabel{amd}{}\n\\newlabel{bmd}{}\n\\newlabel{cmd}{}\n')
+
+            # Unchanged documents are not split again.
+            self.assertEqual(compile_latex_in_shards(latex_filepath, build_dirpath, 2), (0, 1))
+            self.assertEqual(read_calls(), ['document.tex'])
+
+            # Failed shards fall back to compiling the whole document.
+            write_latex_file(['amd', 'fail'])
+            self.assertRaises(RuntimeError, compile_latex_in_shards, latex_filepath, build_dirpath, 2)
+            self.assertEqual(sorted(read_calls()), ['document.tex', 'shard0.tex', 'shard1.tex', 'shard2.tex'])
+            self.assertFalse(os.path.exists(os.path.join(build_dirpath, 'document.aux')))
+        finally:
+            os.environ['PATH'] = original_path
+            shutil.rmtree(temp_dirpath)
+
+
+    def test_merge_latex_aux_files(self):
+        header = '\\relax\n\\providecommand\\hyper@newdestlabel[2]{}\n'
+        shard_aux_contents = [
+            {
+                '.aux': header + '\\mdtopdfcounter{page}{3}{0}\n\\gdef \\@abspage@last{2}\n',
+                '.toc': ''
+            },
+            {
+                '.aux': header + '\\newlabel{a}{{1}{3}}\n\\gdef \\@abspage@last{4}\n',
+                '.toc': '\\contentsline {section}{A}{3}\n',
+                '.out': '\\BOOKMARK [1][-]{section.1}{A}{}% 1\n'
+            },
+            {
+                '.aux': header + '\\newlabel{b}{{2}{7}}\n\\gdef \\@abspage@last{1}\n',
+                '.toc': '\\contentsline {section}{B}{7}\n',
+                '.out': '\\BOOKMARK [1][-]{section.2}{B}{}% 1\n'
+            }
+        ]
+        self.assertEqual(merge_latex_aux_files(shard_aux_contents), {
+            '.aux': header + '\\newlabel{a}{{1}{3}}\n\\newlabel{b}{{2}{7}}\n\\gdef \\@abspage@last{7}\n',
+            '.toc': '\\contentsline {section}{A}{3}\n\\contentsline {section}{B}{7}\n',
+            '.out': '\\BOOKMARK [1][-]{section.1}{A}{}% 1\n\\BOOKMARK [1][-]{section.2}{B}{}% 2\n'
+        })
+
+
+def fake_build_job_pdf(input_conf_file, output_pdf_file, cover_metadata_file, workdir):
+    with open(input_conf_file, 'rb') as configuration_file:
+        configuration = configuration_file.read()
+    if 'fail' in configuration:
+        raise RuntimeError('Build failed')
+    with open(output_pdf_file, 'wb') as pdf_file:
+        pdf_file.write('%PDF ' + configuration)
+
+
+class TestBuildServer( unittest.TestCase ):
+    def setUp(self):
+        self.temp_dirpath = tempfile.mkdtemp()
+        self.server = BuildServer(('127.0.0.1', 0), fake_build_job_pdf, self.temp_dirpath, max_finished_jobs=2)
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.start()
+
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.server_thread.join()
+        shutil.rmtree(self.temp_dirpath)
+
+
+    def request(self, method, path, body=None, headers={}):
+        connection = httplib.HTTPConnection('127.0.0.1', self.server.server_address[1])
+        try:
+            connection.request(method, path, body, headers)
+            response = connection.getresponse()
+            return response.status, response.read()
+        finally:
+            connection.close()
+
+
+    def wait_for_job(self, job_id):
+        while True:
+            status, body = self.request('GET', '/jobs/' + job_id)
+            job = json.loads(body)
+            if job['status'] in ('done', 'failed'):
+                return job
+            time.sleep(0.01)
+
+
+    def test_configuration_file_job(self):
+        configuration_filepath = os.path.join(self.temp_dirpath, 'md2pdf.yml')
+        with open(configuration_filepath, 'wb') as configuration_file:
+            configuration_file.write('document')
+
+        status, body = self.request('POST', '/jobs', json.dumps({'input': configuration_filepath}), {'Content-Type': 'application/json'})
+        self.assertEqual(status, 202)
+        job = self.wait_for_job(json.loads(body)['id'])
+        self.assertEqual(job['status'], 'done')
+        self.assertEqual(self.request('GET', '/jobs/%s/pdf' % job['id']), (200, '%PDF document'))
+
+        self.assertEqual(self.request('DELETE', '/jobs/' + job['id'])[0], 200)
+        self.assertEqual(self.request('GET', '/jobs/' + job['id'])[0], 404)
+
+        status, body = self.request('POST', '/jobs', json.dumps({'input': 'missing.yml'}), {'Content-Type': 'application/json'})
+        self.assertEqual(status, 400)
+
+
+    def test_tarball_job(self):
+        tarball = io.BytesIO()
+        with tarfile.open(fileobj=tarball, mode='w:gz') as tar:
+            for name, content in [('doc/conf.yml', 'tarball document'), ('doc/fail.yml', 'fail')]:
+                member = tarfile.TarInfo(name)
+                member.size = len(content)
+                tar.addfile(member, io.BytesIO(content))
+
+        status, body = self.request('POST', '/jobs?input=doc/conf.yml', tarball.getvalue(), {'Content-Type': 'application/gzip'})
+        self.assertEqual(status, 202)
+        job = self.wait_for_job(json.loads(body)['id'])
+        self.assertEqual(self.request('GET', '/jobs/%s/pdf' % job['id']), (200, '%PDF tarball document'))
+
+        status, body = self.request('POST', '/jobs?input=doc/fail.yml', tarball.getvalue(), {'Content-Type': 'application/gzip'})
+        job = self.wait_for_job(json.loads(body)['id'])
+        self.assertEqual((job['status'], job['error']), ('failed', 'Build failed'))
+        self.assertEqual(self.request('GET', '/jobs/%s/pdf' % job['id'])[0], 409)
+
+        self.assertEqual(self.request('POST', '/jobs', 'not a tarball', {'Content-Type': 'application/gzip'})[0], 400)
+
+
+    def test_extract_tarball(self):
+        tarball = io.BytesIO()
+        with tarfile.open(fileobj=tarball, mode='w') as tar:
+            tar.addfile(tarfile.TarInfo('../outside.md'), io.BytesIO(''))
+        tarball.seek(0)
+        self.assertRaises(ValueError, extract_tarball, tarball, self.temp_dirpath)
+        self.assertFalse(os.path.exists(os.path.join(os.path.dirname(self.temp_dirpath), 'outside.md')))
+
+
+    def test_finished_jobs_limit(self):
+        configuration_filepath = os.path.join(self.temp_dirpath, 'md2pdf.yml')
+        with open(configuration_filepath, 'wb') as configuration_file:
+            configuration_file.write('document')
+
+        job_ids = []
+        for index in range(3):
+            status, body = self.request('POST', '/jobs', json.dumps({'input': configuration_filepath}), {'Content-Type': 'application/json'})
+            job_ids.append(json.loads(body)['id'])
+            self.wait_for_job(job_ids[-1])
+
+        status, body = self.request('GET', '/jobs')
+        self.assertEqual([job['id'] for job in json.loads(body)], job_ids[1:])
+
+
+    def test_queue_limit(self):
+        server = BuildServer(('127.0.0.1', 0), fake_build_job_pdf, self.temp_dirpath, workers=0, max_queued_jobs=1)
+        try:
+            configuration_filepath = os.path.join(self.temp_dirpath, 'md2pdf.yml')
+            with open(configuration_filepath, 'wb') as configuration_file:
+                configuration_file.write('document')
+            self.assertTrue(server.queue_job(server.create_job(configuration_filepath)))
+            self.assertFalse(server.queue_job(server.create_job(configuration_filepath)))
+        finally:
+            server.server_close()
+
+
+    def test_idle_function(self):
+        slow_job_event = threading.Event()
+        def build_job_pdf(input_conf_file, output_pdf_file, cover_metadata_file, workdir):
+            if input_conf_file.endswith('slow.yml'):
+                slow_job_event.wait()
+            fake_build_job_pdf(input_conf_file, output_pdf_file, cover_metadata_file, workdir)
+        idle_calls = []
+        server = BuildServer(('127.0.0.1', 0), build_job_pdf, self.temp_dirpath, workers=2, idle_function=lambda: idle_calls.append(None))
+        try:
+            jobs = []
+            for name in ('slow.yml', 'fast.yml'):
+                configuration_filepath = os.path.join(self.temp_dirpath, name)
+                with open(configuration_filepath, 'wb') as configuration_file:
+                    configuration_file.write('document')
+                jobs.append(server.create_job(configuration_filepath))
+                self.assertTrue(server.queue_job(jobs[-1]))
+
+            # The shared state is not cleaned up while a job is running.
+            while jobs[1].status != 'done':
+                time.sleep(0.01)
+            with server.jobs_lock:
+                self.assertEqual(len(idle_calls), 0)
+
+            slow_job_event.set()
+            while jobs[0].status != 'done':
+                time.sleep(0.01)
+            with server.jobs_lock:
+                self.assertEqual(len(idle_calls), 1)
+        finally:
+            slow_job_event.set()
+            server.server_close()
+
+
+class TestPandocNormalization( unittest.TestCase ):
+    def setUp(self):
+        if not is_pandoc_version_available(NORMALIZE_MARKDOWN_LUA_FILTER_PANDOC_VERSION):
+            self.skipTest('Pandoc >= %s not available' % '.'.join(str(n) for n in NORMALIZE_MARKDOWN_LUA_FILTER_PANDOC_VERSION))
+
+
+    def test_normalize_markdown_content_line_breaks(self):
+        markdown_content = u'Line\\\nother line\\\nlast line\\\n\nab\\\nc\\\n'
+        self.assertEqual(
+            normalize_markdown_content(markdown_content),
+            normalize_markdown_content_with_pandoc_chain(markdown_content)
+        )
+
+
+    def test_normalize_markdown_content_examples(self):
+        # The single Pandoc process normalization must give the same output
+        # than the chain of Pandoc conversions.
+        for markdown_filepath, markdown_content in get_markdown_examples():
+            markdown_content = markdown_content.decode('utf-8')
+            self.assertEqual(
+                normalize_markdown_content(markdown_content),
+                normalize_markdown_content_with_pandoc_chain(markdown_content),
+                'Normalization differs for [%s]' % markdown_filepath
+            )
+
+
+    def test_fix_normalized_markdown_lines_examples(self):
+        # Same output than the chain of fixes on normalized contents.
+        for markdown_filepath, markdown_content in get_markdown_examples():
+            markdown_content = normalize_markdown_content(fix_markdown_lines(markdown_content.decode('utf-8')))
+            markdown_content = add_newlines_before_markdown_headers(markdown_content)
+            fixed_markdown_content = prevent_latex_images_floating(markdown_content)
+            fixed_markdown_content = separate_latex_anchors(fixed_markdown_content)
+            fixed_markdown_content = collapse_anchors_before_titles(fixed_markdown_content)
+            self.assertEqual(
+                fix_normalized_markdown_lines(markdown_content), fixed_markdown_content,
+                'Fixes differ for [%s]' % markdown_filepath
+            )
+
+
 if __name__ == "__main__":
     unittest.main()
+
+
+class TestPandocJsonAst( unittest.TestCase ):
+    def setUp(self):
+        if not is_pandoc_version_available((1, 0)):
+            self.skipTest('Pandoc not available')
+
+
+    def test_header_identifiers(self):
+        """The header identifiers of the AST assembled from the ASTs of the
+        files are the ones Pandoc generates for the monolitic file"""
+        markdown_sections = [
+            generate_file_section('a.md', u'# Intro\n\n# Intro\n\n## \xbfQu\xe9 es *esto*? [link](a.md)\n\n# 1. N\xfameros y `c\xf3digo`\n\n# Intro {#intro-2}\n\n# \xdcber-Gr\xf6\xdfe_x.y\n\n# ?\n'),
+            generate_file_section('b.md', u'# Intro\n\n# ?\n\n> # \xbfQu\xe9 es *esto*? [link](a.md)\n\n# \u0395\u03bb\u03bb\u03b7\u03bd\u03b9\u03ba\u03ac \u65e5\u672c\u8a9e\n\n#    Spaces   --  dashes\n')
+        ] + [
+            generate_file_section(filepath, markdown_content.decode('utf-8'))
+            for filepath, markdown_content in get_markdown_examples()
+        ]
+
+        def get_header_identifiers(json_ast):
+            return [header[1][0] for header in get_headers(get_json_ast_blocks(json_ast))]
+
+        monolitic_json_ast = json.loads(
+            OneShotPandocBackend().convert_text(u''.join(markdown_sections), 'json', MD2PDF_INNER_FORMAT)
+        )
+        self.assertEqual(
+            get_header_identifiers(build_json_ast(markdown_sections)),
+            get_header_identifiers(monolitic_json_ast)
+        )
@@ -0,0 +1,175 @@
+"""Concurrent checks of the remote URLs of a document.
+
+The URLs found in the document are checked before running Pandoc and the 
+results are stored in a persistent cache with a TTL. The Pandoc filter reads
+that cache (see links_processing.exists_url) instead of requesting every 
+remote image while the document is converted.
+"""
+from __future__ import print_function
+import json
+import os
+import re
+import socket
+import tempfile
+import time
+import urllib2
+import httplib
+from multiprocessing.pool import ThreadPool
+
+from file_cache import get_cache_dirpath, file_lock
+from links_processing import is_an_url, normalize_remote_url
+
+
+# Seconds a cached URL status is valid.
+URL_STATUS_CACHE_TTL = 24 * 60 * 60
+
+# Seconds to wait for every request.
+URL_CHECK_TIMEOUT = 10
+
+# Maximum number of simultaneous requests.
+URL_CHECK_MAX_CONNECTIONS = 8
+
+
+class HeadRequest(urllib2.Request):
+    def get_method(self):
+        return 'HEAD'
+
+
+def check_url(url, timeout=URL_CHECK_TIMEOUT):
+    """Return True if the given URL exists, False if the server answers 
+    with an HTTP error. Network errors are raised.
+
+    A HEAD request is used. If the server does not allow it, the URL is 
+    requested with GET.
+    """
+    try:
+        urllib2.urlopen(HeadRequest(url.encode('utf-8')), timeout=timeout).close()
+        return True
+    except urllib2.HTTPError as error:
+        if error.code not in (405, 501):
+            return False
+
+    try:
+        urllib2.urlopen(url.encode('utf-8'), timeout=timeout).close()
+        return True
+    except urllib2.HTTPError:
+        return False
+
+
+def check_url_job(job):
+    """Return (url, status) for the given (url, timeout). Status is None 
+    when the URL could not be checked because of a network error."""
+    url, timeout = job
+    try:
+        return url, check_url(url, timeout)
+    except (urllib2.URLError, httplib.HTTPException, socket.error, ValueError):
+        return url, None
+
+
+def check_urls(urls, timeout=URL_CHECK_TIMEOUT, max_connections=URL_CHECK_MAX_CONNECTIONS):
+    """Check the given URLs concurrently. Return a dictionary associating 
+    every URL to its status (see check_url_job)"""
+    urls = sorted(set(urls))
+    if len(urls) == 0:
+        return {}
+
+    pool = ThreadPool(min(max_connections, len(urls)))
+    try:
+        return dict(pool.map(check_url_job, [(url, timeout) for url in urls]))
+    finally:
+        pool.close()
+        pool.join()
+
+
+class UrlStatusCache(object):
+    """Persistent cache of URL statuses (a JSON file) whose entries expire
+    after ttl seconds"""
+    def __init__(self, cache_filepath, ttl=URL_STATUS_CACHE_TTL):
+        self.cache_filepath = cache_filepath
+        self.ttl = ttl
+        self.statuses = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.cache_filepath, 'rb') as cache_file:
+                self.statuses = json.load(cache_file)
+        except (IOError, ValueError):
+            self.statuses = {}
+
+    def get(self, url):
+        """Return the cached status of the given URL or None if it is not 
+        cached or it has expired"""
+        url_status = self.statuses.get(url)
+        if url_status is None or time.time() - url_status['time'] > self.ttl:
+            return None
+        return url_status['exists']
+
+    def update(self, url_statuses):
+        """Store the given statuses (see check_urls) and save the cache"""
+        with file_lock(self.cache_filepath + '.lock'):
+            # Merge with the entries saved meanwhile by other processes.
+            self.load()
+
+            now = time.time()
+            for url, exists in url_statuses.iteritems():
+                # Network errors are not cached, so they are retried next time.
+                if exists is not None:
+                    self.statuses[url] = {'exists': exists, 'time': now}
+
+            cache_dirpath = os.path.dirname(self.cache_filepath)
+            cache_fd, cache_temp_filepath = tempfile.mkstemp(dir=cache_dirpath, prefix='.tmp-')
+            with os.fdopen(cache_fd, 'wb') as cache_file:
+                json.dump(self.statuses, cache_file)
+            os.rename(cache_temp_filepath, self.cache_filepath)
+
+
+def get_url_status_cache():
+    """Return the URL status cache shared by md2pdf and its Pandoc filters"""
+    if get_url_status_cache.cache is None:
+        get_url_status_cache.cache = UrlStatusCache(
+            os.path.join(get_cache_dirpath(), 'url_status.json')
+        )
+    return get_url_status_cache.cache
+get_url_status_cache.cache = None
+
+
+def find_markdown_urls(markdown_content, include_links=False):
+    """Return the targets of the images (and links, if include_links) in 
+    the given Markdown content, as written: remote URLs and local paths"""
+    # Images and links as written by Pandoc: ![text](url "title")
+    link_regex = r'(!?)\[(?:[^\[\]]|\[[^\[\]]*\])*\]\(<?([^()\s<>]+)>?(?:\s+"[^"]*")?\)'
+
+    urls = []
+    for match in re.finditer(link_regex, markdown_content):
+        is_image = match.group(1) == '!'
+        if is_image or include_links:
+            urls.append(match.group(2))
+    return urls
+
+
+def find_remote_urls(markdown_content, include_links=False):
+    """Return the remote URLs of the images (and links, if include_links) in
+    the given Markdown content, normalized (see normalize_remote_url)"""
+    return [
+        normalize_remote_url(url)
+        for url in find_markdown_urls(markdown_content, include_links)
+        if is_an_url(url)
+    ]
+
+
+def prefetch_url_statuses(markdown_content, include_links=False, excluded_urls=()):
+    """Check the remote URLs of the given Markdown content which are not in 
+    the URL status cache and store the results. Return a dictionary with the
+    status of every URL found (see check_url_job)."""
+    url_status_cache = get_url_status_cache()
+    urls = set(find_remote_urls(markdown_content, include_links))
+    urls.difference_update(excluded_urls)
+
+    url_statuses = dict((url, url_status_cache.get(url)) for url in urls)
+    url_statuses.update(
+        check_urls([url for url, exists in url_statuses.iteritems() if exists is None])
+    )
+    url_status_cache.update(url_statuses)
+
+    return url_statuses
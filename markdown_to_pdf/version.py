@@ -0,0 +1,3 @@
+# Version of md2pdf. It is also used by setup.py and for invalidating the
+# cached files generated by previous versions.
+__version__ = '0.2.2'
@@ -0,0 +1,55 @@
+"""Polling of the files of a document, for rebuilding it when they change.
+
+Files are polled (instead of using inotify or similar) so it works the 
+same on every platform and with network filesystems.
+"""
+import os
+import time
+
+
+# Seconds between two checks of the watched files.
+WATCH_POLL_INTERVAL = 0.5
+
+# Seconds without changes waited before rebuilding, so a burst of saves 
+# (i.e. an editor saving all its buffers) triggers a single rebuild.
+WATCH_DEBOUNCE_DELAY = 1.0
+
+
+def get_filepaths_state(filepaths):
+    """Return a dictionary with the modification time and size of the given
+    files (None for missing files)"""
+    filepaths_state = {}
+    for filepath in filepaths:
+        try:
+            file_stat = os.stat(filepath)
+            filepaths_state[filepath] = (file_stat.st_mtime, file_stat.st_size)
+        except OSError:
+            filepaths_state[filepath] = None
+    return filepaths_state
+
+
+def get_changed_filepaths(filepaths_state, new_filepaths_state):
+    return set(
+        filepath for filepath in filepaths_state
+        if new_filepaths_state.get(filepath) != filepaths_state[filepath]
+    )
+
+
+def wait_for_changes(filepaths_state, interval=WATCH_POLL_INTERVAL, debounce=WATCH_DEBOUNCE_DELAY):
+    """Block until some of the given files (see get_filepaths_state) change
+    and no more changes happen during `debounce` seconds. Return the sorted 
+    list of changed files"""
+    changed_filepaths = set()
+    last_change_time = None
+
+    while True:
+        time.sleep(interval)
+        new_filepaths_state = get_filepaths_state(filepaths_state.keys())
+        new_changed_filepaths = get_changed_filepaths(filepaths_state, new_filepaths_state)
+
+        if len(new_changed_filepaths) > 0:
+            changed_filepaths |= new_changed_filepaths
+            last_change_time = time.time()
+            filepaths_state = new_filepaths_state
+        elif len(changed_filepaths) > 0 and time.time() - last_change_time >= debounce:
+            return sorted(changed_filepaths)
@@ -13,8 +13,16 @@ def get_packages(package):
             if os.path.exists(os.path.join(dirpath, '__init__.py'))]
 
 
+def get_version():
+    """Return the version defined in markdown_to_pdf/version.py"""
+    version = {}
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'markdown_to_pdf', 'version.py')) as version_file:
+        exec(version_file.read(), version)
+    return version['__version__']
+
+
 setup(name='markdown_to_pdf',
-      version='0.2.2',
+      version=get_version(),
       description='Python module for generating a PDF document from a set of Markdown files',
       url='https://github.com/Fiware/tools.Md2pdf',
       author='FIWARE ULPGC',
@@ -24,7 +32,6 @@ setup(name='markdown_to_pdf',
       include_package_data=True,
       install_requires=[
         'pyyaml>=3.11',
-        'markdown>=2.6.2',
         'pypandoc>=0.9.9',
         'pandocfilters<=1.2.4'
       ],